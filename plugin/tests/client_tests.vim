@@ -2,6 +2,9 @@ execute("source " . expand("<sfile>:p:h") . "/test_tools.vim")
 execute("source " . expand("<sfile>:p:h") . "/../vimpair.vim")
 
 call g:VimpairRunPython("from mock import Mock")
+call g:VimpairRunPython("from connectors import SingleThreadedServerConnector")
+
+call g:VimpairRunPython("ServerConnector = SingleThreadedServerConnector")
 
 let g:VimpairShowStatusMessages = 0
 let g:VimpairTimerInterval = 1
@@ -11,9 +14,9 @@ function! _VPClientTest_set_up()
   let g:VPClientTest_SentMessages = []
   call g:VimpairRunPython(
         \ "fake_socket = Mock(sendall=lambda b: vim.command(" .
-        \ "    'call add(g:VPClientTest_SentMessages, \"%s\")' % str(b)))"
+        \ "    'call add(g:VPClientTest_SentMessages, \"%s\")' % b.decode('utf-8')))"
         \)
-  call g:VimpairRunPython("client_socket_factory = lambda: fake_socket")
+  call g:VimpairRunPython("client_socket_factory = lambda _settings: fake_socket")
   VimpairClientStart
 endfunction
 
@@ -27,7 +30,7 @@ function! s:VPClientTest_set_received_messages(messages)
   let g:VPClientTest_ReceivedMessages = a:messages
   call g:VimpairRunPython(
         \ "received_messages = list(vim.eval('g:VPClientTest_ReceivedMessages'))")
-  call g:VimpairRunPython("fake_socket.recv = lambda *a: received_messages.pop()")
+  call g:VimpairRunPython("fake_socket.recv = lambda *a: received_messages.pop().encode('utf-8')")
   unlet g:VPClientTest_ReceivedMessages
 endfunction
 
@@ -50,10 +53,23 @@ function! s:VPClientTest_assert_has_sent_message(expected)
   call assert_report("Expected message has not been sent: " . a:expected)
 endfunction
 
+function! s:VPClientTest_sent_messages_except_limits()
+  return filter(copy(g:VPClientTest_SentMessages), 'v:val !~ "^VIMPAIR_LIMITS|"')
+endfunction
+
 function! s:VPClientTest_wait_for_timer()
   sleep 3m
 endfunction
 
+function! s:VPClientTest_apply_updates(number_of_updates)
+  call g:VimpairRunPython(
+        \ "for index in range(" . a:number_of_updates . "):                \n" .
+        \ "    contents = '\\n'.join(50 * ['Update %d' % index])          \n" .
+        \ "    sessions.current().message_handler.process(                                  \n" .
+        \ "        ['VIMPAIR_FULL_UPDATE|%d|%s' % (len(contents), contents)])"
+        \)
+endfunction
+
 
 function! VPClientTest_applies_received_contents_updates()
   call s:VPClientTest_set_received_messages(["VIMPAIR_FULL_UPDATE|16|This is line one"])
@@ -73,10 +89,45 @@ function! VPClientTest_received_contents_updates_overwrite_existing_contents()
   call s:VPClientTest_assert_buffer_has_contents(["This is line one"])
 endfunction
 
+function! VPClientTest_applies_received_visible_lines_before_contents_update()
+  call s:VPClientTest_set_received_messages(["VIMPAIR_VISIBLE_LINES|1|3|8|Line two"])
+
+  call s:VPClientTest_wait_for_timer()
+
+  call s:VPClientTest_assert_buffer_has_contents(["", "Line two", ""])
+endfunction
+
+function! VPClientTest_applied_updates_dont_grow_undo_history()
+  call s:VPClientTest_apply_updates(1000)
+
+  call assert_equal(0, undotree().seq_last)
+endfunction
+
+function! VPClientTest_applied_updates_add_no_undo_steps()
+  execute("normal iA local change")
+  let l:seq_last = undotree().seq_last
+  let l:change_number = changenr()
+
+  call s:VPClientTest_apply_updates(1000)
+
+  call assert_equal(
+        \ [l:seq_last, l:change_number],
+        \ [undotree().seq_last, changenr()])
+endfunction
+
+function! VPClientTest_undo_after_applied_update_doesnt_restore_stale_contents()
+  execute("normal iA local change")
+  call s:VPClientTest_apply_updates(1)
+
+  silent! undo
+
+  call s:VPClientTest_assert_buffer_has_contents(repeat(["Update 0"], 50))
+endfunction
+
 function! VPClientTest_received_cursor_position_is_applied()
   execute("normal iThis is line one")
   execute("normal oThis is line two")
-  call s:VPClientTest_set_received_messages(["VIMPAIR_CURSOR_POSITION|0|8"])
+  call s:VPClientTest_set_received_messages(["VIMPAIR_CURSOR_POSITION|0|1|8"])
 
   call s:VPClientTest_wait_for_timer()
 
@@ -88,7 +139,7 @@ function! VPClientTest_received_cursor_position_is_retained_after_full_update()
   execute("normal iOne")
   execute("normal oTwo")
   execute("normal oThree")
-  call s:VPClientTest_set_received_messages(["VIMPAIR_CURSOR_POSITION|2|3"])
+  call s:VPClientTest_set_received_messages(["VIMPAIR_CURSOR_POSITION|2|1|3"])
   call s:VPClientTest_wait_for_timer()
 
   call s:VPClientTest_set_received_messages(["VIMPAIR_FULL_UPDATE|18|One\nTwo\nThree\nFour"])
@@ -188,7 +239,7 @@ function! VPClientTest_send_cursor_position_after_taking_control()
   " so we need to manually trigger it
   execute("doautocmd CursorMoved")
 
-  call s:VPClientTest_assert_has_sent_message("VIMPAIR_CURSOR_POSITION|0|8")
+  call s:VPClientTest_assert_has_sent_message("VIMPAIR_CURSOR_POSITION|0|1|8")
 endfunction
 
 function! VPClientTest_doesnt_apply_received_contents_updates_after_taking_control()
@@ -210,19 +261,94 @@ function! VPClientTest_creates_new_buffer_with_filename_on_receiving_file_change
   call g:VimpairRunPython(
         \  "vim.command(" .
         \  "   'let g:VPServerTests_expected = \"%s\"'" .
-        \  "   % session.prepend_folder('SomeFile.py')" .
+        \  "   % sessions.current().folder.prepend_folder('SomeFile.py')" .
         \  ")"
         \)
   call assert_match(".*" . g:VPServerTests_expected, expand("%"))
   unlet g:VPServerTests_expected
 endfunction
 
+function! VPClientTest_switches_to_registered_file_on_receiving_file_id()
+  call s:VPClientTest_set_received_messages(["VIMPAIR_FILE_REGISTER|3|11|SomeFile.py"])
+  call s:VPClientTest_wait_for_timer()
+  call s:VPClientTest_set_received_messages(["VIMPAIR_FILE_REGISTER|4|12|OtherFile.py"])
+  call s:VPClientTest_wait_for_timer()
+
+  call s:VPClientTest_set_received_messages(["VIMPAIR_FILE_SWITCH|1|3"])
+  call s:VPClientTest_wait_for_timer()
+
+  call assert_match(".*SomeFile.py", expand("%"))
+endfunction
+
 function! VPClientTest_doesnt_send_file_change_on_change_after_taking_control()
   call s:VPClientTest_take_control()
 
   execute("silent e " . expand("%:p:h") . "/../README.md")
 
-  call assert_equal([], g:VPClientTest_SentMessages)
+  call assert_equal([], s:VPClientTest_sent_messages_except_limits())
+endfunction
+
+function! s:VPClientTest_receive_hash_tree_of(lines)
+  let g:VPClientTest_EditorLines = a:lines
+  call g:VimpairRunPython(
+        \  "from protocol import HashTree, generate_hash_tree_message     \n" .
+        \  "tree = HashTree(vim.eval('g:VPClientTest_EditorLines'))        \n" .
+        \  "sessions.current().message_handler.process([generate_hash_tree_message(\n" .
+        \  "    tree.number_of_lines, tree.levels, tree.root)])"
+        \)
+  unlet g:VPClientTest_EditorLines
+endfunction
+
+function! VPClientTest_sends_limits_on_connection()
+  call s:VPClientTest_wait_for_timer()
+
+  call s:VPClientTest_assert_has_sent_message("VIMPAIR_LIMITS|8|67108864")
+endfunction
+
+function! VPClientTest_doesnt_request_anything_for_matching_hash_tree()
+  call s:VPClientTest_set_received_messages(["VIMPAIR_FULL_UPDATE|4|Same"])
+  call s:VPClientTest_wait_for_timer()
+
+  call s:VPClientTest_receive_hash_tree_of(["Same"])
+
+  call assert_equal([], s:VPClientTest_sent_messages_except_limits())
+endfunction
+
+function! VPClientTest_requests_block_for_mismatching_hash_tree()
+  execute("normal iLocal change")
+
+  call s:VPClientTest_receive_hash_tree_of(["Editor line"])
+
+  call s:VPClientTest_assert_has_sent_message("VIMPAIR_BLOCK_REQUEST|1|0")
+endfunction
+
+function! s:VPClientTest_return_to_registered_file()
+  call s:VPClientTest_set_received_messages(["VIMPAIR_FILE_REGISTER|3|11|SomeFile.py"])
+  call s:VPClientTest_wait_for_timer()
+  call s:VPClientTest_set_received_messages(["VIMPAIR_FILE_REGISTER|4|12|OtherFile.py"])
+  call s:VPClientTest_wait_for_timer()
+  call s:VPClientTest_set_received_messages(["VIMPAIR_FILE_SWITCH|1|3"])
+  call s:VPClientTest_wait_for_timer()
+endfunction
+
+function! VPClientTest_applies_delta_for_sent_signatures()
+  call s:VPClientTest_return_to_registered_file()
+
+  " The empty buffer has no signatures, their checksum is 0
+  call s:VPClientTest_set_received_messages(["VIMPAIR_DELTA|3|256|0|8|L5|Hello"])
+  call s:VPClientTest_wait_for_timer()
+
+  call s:VPClientTest_assert_buffer_has_contents(["Hello"])
+endfunction
+
+function! VPClientTest_requests_resync_for_delta_of_other_signatures()
+  call s:VPClientTest_return_to_registered_file()
+
+  call s:VPClientTest_set_received_messages(["VIMPAIR_DELTA|3|256|1|8|L5|Hello"])
+  call s:VPClientTest_wait_for_timer()
+
+  call s:VPClientTest_assert_buffer_has_contents([""])
+  call s:VPClientTest_assert_has_sent_message("VIMPAIR_RESYNC_REQUEST")
 endfunction
 
 function! VPClientTest_saves_current_file_when_receiving_save_message()
@@ -239,7 +365,7 @@ function! VPClientTest_saves_current_file_when_receiving_save_message()
   call g:VimpairRunPython(
         \  "vim.command(" .
         \  "   'let g:VPServerTests_expected = \"%s\"'" .
-        \  "   % session.prepend_folder('Folder/SomeFile.py')" .
+        \  "   % sessions.current().folder.prepend_folder('Folder/SomeFile.py')" .
         \  ")"
         \)
   call assert_false(empty(glob(g:VPServerTests_expected)))
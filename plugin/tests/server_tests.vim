@@ -16,11 +16,11 @@ function! _VPServerTest_set_up()
   let g:VPServerTest_SentMessages = []
   call g:VimpairRunPython(
         \  "fake_socket = Mock(sendall=lambda b: vim.command(" .
-        \  "    'call add(g:VPServerTest_SentMessages, \"%s\")' % str(b)))"
+        \  "    'call add(g:VPServerTest_SentMessages, \"%s\")' % b.decode('utf-8')))"
         \)
   call g:VimpairRunPython(
         \  "server_socket_factory =" .
-        \  "     lambda: Mock(get_client_connection=lambda: fake_socket)"
+        \  "     lambda _settings: Mock(get_client_connection=lambda: fake_socket)"
         \)
   VimpairServerStart
 endfunction
@@ -55,6 +55,12 @@ function! s:VPServerTest_assert_has_not_sent_message(unexpected)
   endfor
 endfunction
 
+function! s:VPServerTest_assert_has_not_sent_message_starting_with(unexpected)
+  for message in g:VPServerTest_SentMessages
+    call assert_notmatch(a:unexpected . ".*", message, "Unexpected message has been sent: " . message)
+  endfor
+endfunction
+
 function! s:VPServerTest_assert_buffer_has_contents(expected)
   let l:actual = getline(1, '$')
   call assert_equal(a:expected, l:actual)
@@ -70,11 +76,15 @@ function! VPServerTest_sends_buffer_contents_on_connection()
 endfunction
 
 function! VPServerTest_sends_cursor_position_on_connection()
-  call s:VPServerTest_assert_has_sent_message("VIMPAIR_CURSOR_POSITION|0|0")
+  call s:VPServerTest_assert_has_sent_message("VIMPAIR_CURSOR_POSITION|0|1|0")
 endfunction
 
 function! VPServerTest_sends_file_change_on_connection()
-  call s:VPServerTest_assert_has_sent_message("VIMPAIR_FILE_CHANGE|0|")
+  call s:VPServerTest_assert_has_sent_message("VIMPAIR_FILE_REGISTER|0|0|")
+endfunction
+
+function! VPServerTest_sends_limits_on_connection()
+  call s:VPServerTest_assert_has_sent_message("VIMPAIR_LIMITS|8|67108864")
 endfunction
 
 function! VPServerTest_sends_buffer_contents_on_change()
@@ -93,7 +103,18 @@ function! VPServerTest_sends_cursor_position_on_change()
   " so we need to manually trigger it
   execute("doautocmd CursorMoved")
 
-  call s:VPServerTest_assert_has_sent_message("VIMPAIR_CURSOR_POSITION|0|8")
+  call s:VPServerTest_assert_has_sent_message("VIMPAIR_CURSOR_POSITION|0|1|8")
+endfunction
+
+function! VPServerTest_doesnt_send_unchanged_cursor_position_again()
+  execute("normal iThis is line one")
+  execute("normal gg0w")
+  execute("doautocmd CursorMoved")
+  let g:VPServerTest_SentMessages = []
+
+  execute("doautocmd CursorMoved")
+
+  call s:VPServerTest_assert_has_not_sent_message("VIMPAIR_CURSOR_POSITION|0|1|5")
 endfunction
 
 function! VPServerTest_sends_long_buffer_contents_in_chunks()
@@ -138,14 +159,23 @@ function! VPServerTest_sends_long_buffer_contents_in_chunks()
     \ "VIMPAIR_CONTENTS_END|25|5678901234567890123456789")
 endfunction
 
-function! VPServerTest_sends_buffer_contents_on_copy_paste()
+function! VPServerTest_sends_only_changed_lines_on_copy_paste()
   execute("normal iThis is just some text")
 
   execute("normal yyp")
   execute("doautocmd TextChanged")
 
-  call s:VPServerTest_assert_has_sent_message(
-    \ "VIMPAIR_FULL_UPDATE|45|This is just some text\nThis is just some text")
+  call s:VPServerTest_assert_has_sent_message_starting_with(
+    \ "VIMPAIR_LINES_DELTA|[0-9]\\+|1|0|1|22|This is just some text")
+  call s:VPServerTest_assert_has_not_sent_message_starting_with(
+    \ "VIMPAIR_FULL_UPDATE|45|")
+endfunction
+
+function! VPServerTest_sends_contents_version_after_full_update()
+  execute("normal iThis is just some text")
+
+  call s:VPServerTest_assert_has_sent_message_starting_with(
+    \ "VIMPAIR_CONTENTS_VERSION|[0-9]\\+|[0-9]\\+$")
 endfunction
 
 function! VPServerTest_sends_take_control_message_for_handover()
@@ -154,6 +184,13 @@ function! VPServerTest_sends_take_control_message_for_handover()
   call s:VPServerTest_assert_has_sent_message("VIMPAIR_TAKE_CONTROL")
 endfunction
 
+function! VPServerTest_sends_sync_state_for_handover()
+  VimpairHandover
+
+  call s:VPServerTest_assert_has_sent_message_starting_with(
+    \ "VIMPAIR_SYNC_STATE|[0-9]\\+|40|")
+endfunction
+
 function! VPServerTest_does_not_send_updates_after_handover()
   VimpairHandover
 
@@ -166,7 +203,7 @@ endfunction
 function! VPServerTest_applies_received_updates_after_handover()
   VimpairHandover
   call g:VimpairRunPython("received_messages = [\"VIMPAIR_FULL_UPDATE|16|This is line one\"]")
-  call g:VimpairRunPython("fake_socket.recv = lambda *a: received_messages.pop()")
+  call g:VimpairRunPython("fake_socket.recv = lambda *a: received_messages.pop().encode('utf-8')")
 
   call s:VPServerTest_wait_for_timer()
 
@@ -179,16 +216,43 @@ function! VPServerTest_sends_file_change_on_buffer_name_change()
   execute("doautocmd BufWritePost")
 
   let file_path = expand("%:p")
-  call s:VPServerTest_assert_has_sent_message(
-    \ "VIMPAIR_FILE_CHANGE|" . printf("%d", strlen(file_path)) . "|" . file_path)
+  call s:VPServerTest_assert_has_sent_message_starting_with(
+    \ "VIMPAIR_FILE_REGISTER|\\d\\+|" . printf("%d", strlen(file_path)) . "|" . file_path)
 endfunction
 
 function! VPServerTest_sends_file_change_on_change()
   execute("silent e " . expand("%:p:h") . "/../README.md")
 
   let file_path = expand("%:p")
-  call s:VPServerTest_assert_has_sent_message(
-    \ "VIMPAIR_FILE_CHANGE|" . printf("%d", strlen(file_path)) . "|" . file_path)
+  call s:VPServerTest_assert_has_sent_message_starting_with(
+    \ "VIMPAIR_FILE_REGISTER|\\d\\+|" . printf("%d", strlen(file_path)) . "|" . file_path)
+endfunction
+
+function! VPServerTest_sends_only_file_id_when_returning_to_a_file()
+  call s:VPServerTest_wait_for_timer()
+  execute("silent e " . expand("%:p:h") . "/../README.md")
+  let l:readme_buffer = bufnr("%")
+  execute("silent e " . expand("%:p:h") . "/../.gitignore")
+  let g:VPServerTest_SentMessages = []
+
+  execute("silent b " . l:readme_buffer)
+
+  call s:VPServerTest_assert_has_sent_message("VIMPAIR_FILE_SWITCH|1|0")
+  call s:VPServerTest_assert_has_not_sent_message_starting_with("VIMPAIR_FILE_REGISTER")
+endfunction
+
+function! VPServerTest_waits_for_signatures_when_returning_to_a_file()
+  call s:VPServerTest_wait_for_timer()
+  execute("silent e " . expand("%:p:h") . "/../README.md")
+  let l:readme_buffer = bufnr("%")
+  execute("silent e " . expand("%:p:h") . "/../.gitignore")
+  let g:VPServerTest_SentMessages = []
+
+  execute("silent b " . l:readme_buffer)
+
+  call s:VPServerTest_assert_has_sent_message_starting_with("VIMPAIR_VISIBLE_LINES|")
+  call s:VPServerTest_assert_has_not_sent_message_starting_with("VIMPAIR_FULL_UPDATE")
+  call s:VPServerTest_assert_has_not_sent_message_starting_with("VIMPAIR_CONTENTS_START")
 endfunction
 
 function! VPServerTest_sends_file_contents_on_file_change()
@@ -11,6 +11,10 @@ function! g:VimpairRunPython(command)
   execute(s:VimpairPythonCommand . " " . a:command)
 endfunction
 
+function! g:VimpairEvalPython(expression)
+  return call(s:VimpairPythonCommand == "python3" ? "py3eval" : "pyeval", [a:expression])
+endfunction
+
 call g:VimpairRunPython("import sys, os, vim")
 call g:VimpairRunPython(
       \  "sys.path.append(os.path.abspath(os.path.join('" .
@@ -19,36 +23,102 @@ call g:VimpairRunPython(
 
 call g:VimpairRunPython(
       \  "import vimpair                                                    \n" .
+      \  "from binascii import b2a_hex                                      \n" .
+      \  "from functools import partial                                     \n" .
       \  "from connection import create_client_socket, create_server_socket \n" .
+      \  "from connection import create_relay_socket                       \n" .
+      \  "from connection import connection_factory                        \n" .
       \  "from connectors import ClientConnector, ServerConnector           \n" .
+      \  "from metrics import Metrics                                       \n" .
+      \  "from profiling import profiler                                    \n" .
       \  "from protocol import MessageHandler                               \n" .
+      \  "from protocol import generate_join_session_message               \n" .
+      \  "from protocol import generate_sequence_message                   \n" .
+      \  "from registry import SessionRegistry                              \n" .
       \  "from session import Session"
       \)
 
 call g:VimpairRunPython(
-      \  "server_socket_factory = create_server_socket   \n" .
-      \  "client_socket_factory = create_client_socket   \n" .
-      \  "session = None                                 \n" .
-      \  "message_handler = None                         \n" .
-      \  "vim_call = lambda f: vim.command('call %s()' % f)"
+      \  "read_transport_settings = lambda port: dict(                     \n" .
+      \  "    transport=vim.eval('g:VimpairTransport'),                     \n" .
+      \  "    socket_path=vim.eval('g:VimpairSocketPath'),                  \n" .
+      \  "    port=port or None,                                            \n" .
+      \  ")                                                                 \n" .
+      \  "read_relay_settings = lambda: dict(                               \n" .
+      \  "    address=vim.eval('g:VimpairRelayAddress'),                    \n" .
+      \  "    session_id=vim.eval('g:VimpairSessionId'),                    \n" .
+      \  "    secret=vim.eval('g:VimpairSessionSecret')                     \n" .
+      \  "        or b2a_hex(os.urandom(16)).decode('ascii'),               \n" .
+      \  ")                                                                 \n" .
+      \  "server_socket_factory = lambda settings: create_server_socket(   \n" .
+      \  "    **settings)                                                   \n" .
+      \  "client_socket_factory = lambda settings: create_client_socket(   \n" .
+      \  "    **settings)                                                   \n" .
+      \  "relay_socket_factory = lambda settings, is_host: create_relay_socket(\n" .
+      \  "    settings['address'],                                          \n" .
+      \  "    generate_join_session_message(                                \n" .
+      \  "        settings['session_id'], is_host, settings['secret']))     \n" .
+      \  "socket_factory_for = lambda settings, is_server: (                \n" .
+      \  "    partial(relay_socket_factory, read_relay_settings(), is_server)\n" .
+      \  "    if settings['transport'] == 'relay' else                      \n" .
+      \  "    partial(server_socket_factory if is_server else client_socket_factory,\n" .
+      \  "            settings))                                            \n" .
+      \  "connections_for = lambda settings, is_server: connection_factory( \n" .
+      \  "    settings['transport'], is_server, metrics=sessions.metrics,   \n" .
+      \  "    sequence_message=generate_sequence_message                    \n" .
+      \  "        if int(vim.eval('g:VimpairBulkConnection')) else None)    \n" .
+      \  "create_metrics = lambda: Metrics(                                 \n" .
+      \  "    vim.eval('g:VimpairMetricsFile'),                             \n" .
+      \  "    interval=int(vim.eval('g:VimpairMetricsInterval')) / 1000.,   \n" .
+      \  ") if vim.eval('g:VimpairMetricsFile') else None                   \n" .
+      \  "sessions = SessionRegistry()"
       \)
 
 
 let g:VimpairConcealFilePaths = 1
+let g:VimpairSocketPath = ""
 let g:VimpairShowStatusMessages = 1
 let g:VimpairTimerInterval = 200
-
+let g:VimpairTransport = "tcp"
+let g:VimpairBulkConnection = 0
+let g:VimpairProcessTimeBudget = 50
+let g:VimpairObserverUndoHistory = 0
+let g:VimpairConsistencyCheckInterval = 5000
+let g:VimpairPrefetchProject = 0
+let g:VimpairStreamKeystrokes = 0
+let g:VimpairRelayAddress = "localhost:50008"
+let g:VimpairSessionId = "vimpair"
+let g:VimpairSessionSecret = ""
+let g:VimpairProfileReport = ""
+let g:VimpairMetricsFile = ""
+let g:VimpairMetricsInterval = 60000
+let g:VimpairMaxMessageSize = 64 * 1024 * 1024
+
+
+function! s:VimpairRunAsEditor(python_expression)
+  call g:VimpairRunPython(
+        \  "sessions.as_editor(lambda: " . a:python_expression . ")")
+endfunction
 
 function! s:VimpairStartObserving()
+  " Each change is sent by the session of the window it was made in
   augroup VimpairEditorObservers
-    autocmd TextChanged * call g:VimpairRunPython("vimpair.send_contents_update()")
-    autocmd TextChangedI * call g:VimpairRunPython("vimpair.send_contents_update()")
-    autocmd InsertLeave * call g:VimpairRunPython("vimpair.update_contents_and_cursor()")
-    autocmd CursorMoved * call g:VimpairRunPython("vimpair.send_cursor_position()")
-    autocmd CursorMovedI * call g:VimpairRunPython("vimpair.send_cursor_position()")
-    autocmd BufEnter * call g:VimpairRunPython("vimpair.send_file_change()")
-    autocmd BufWritePost * call g:VimpairRunPython(
-          \ "vimpair.send_file_change(); vimpair.send_save_file()")
+    autocmd!
+    autocmd TextChanged * call s:VimpairRunAsEditor("vimpair.send_contents_update()")
+    autocmd TextChangedI * call s:VimpairRunAsEditor("vimpair.send_contents_update()")
+    autocmd InsertLeave * call s:VimpairRunAsEditor("vimpair.update_contents_and_cursor()")
+    autocmd CursorMoved * call s:VimpairRunAsEditor("vimpair.send_cursor_position()")
+    autocmd CursorMovedI * call s:VimpairRunAsEditor("vimpair.send_cursor_position()")
+    autocmd BufEnter * call s:VimpairRunAsEditor("vimpair.send_file_change()")
+    autocmd BufWritePost * call s:VimpairRunAsEditor(
+          \ "(vimpair.send_file_change(), vimpair.send_save_file())")
+    if g:VimpairStreamKeystrokes
+      " Replacing and other modes are left to the contents updates
+      autocmd InsertCharPre * if v:insertmode ==# 'i' |
+            \ call s:VimpairRunAsEditor(
+            \   "vimpair.send_inserted_text(vim.eval('v:char'))") |
+            \ endif
+    endif
   augroup END
 endfunction
 
@@ -61,13 +131,15 @@ endfunction
 
 let s:VimpairTimer = ""
 
-function! s:VimpairStartTimer(python_command)
-  let l:timer_command = "call g:VimpairRunPython(\"" . a:python_command . "\")"
-  let s:VimpairTimer = timer_start(
-        \  g:VimpairTimerInterval,
-        \  {-> execute(l:timer_command, "")},
-        \  {'repeat': -1}
-        \)
+function! s:VimpairStartTimer()
+  " A single timer services the connections of all sessions
+  if s:VimpairTimer == ""
+    let s:VimpairTimer = timer_start(
+          \  g:VimpairTimerInterval,
+          \  {-> execute("call g:VimpairRunPython('sessions.poll()')", "")},
+          \  {'repeat': -1}
+          \)
+  endif
 endfunction
 
 function! s:VimpairStopTimer()
@@ -78,36 +150,61 @@ function! s:VimpairStopTimer()
 endfunction
 
 
-function! s:VimpairStartReceivingMessagesTimer()
-  call s:VimpairStartTimer(
-        \  "message_handler.process(vimpair.connector.connection.received_messages)"
-        \)
-endfunction
-
-function! s:VimpairTakeControl()
-  call s:VimpairStopTimer()
-  call s:VimpairStartObserving()
-endfunction
-
-function! s:VimpairReleaseControl()
-  call s:VimpairStopObserving()
-  call s:VimpairStartReceivingMessagesTimer()
-endfunction
-
+function! s:VimpairStartSession(is_server, arguments)
+  " The first session decides whether metrics are collected for all of them
+  call g:VimpairRunPython(
+        \  "if not len(sessions): sessions.metrics = create_metrics()")
+  if !g:VimpairEvalPython(
+        \  "sessions.start(" . (a:is_server ? "True" : "False") . ") is not None")
+    call g:VimpairRunPython(
+          \  "vimpair.show_status_message('This window is in a session already')")
+    return 0
+  endif
 
-function! s:VimpairInitialize()
   augroup VimpairCleanup
+    autocmd!
     autocmd VimLeavePre * call s:VimpairCleanup()
   augroup END
 
+  call g:VimpairRunPython("pairing = sessions.current()")
+  if !a:is_server
+    call g:VimpairRunPython("pairing.folder = Session()")
+  endif
+  " Settings are read once, as connecting happens in the background
   call g:VimpairRunPython(
-        \  "message_handler = MessageHandler(" .
+        \  "settings = read_transport_settings(" .
+        \  (len(a:arguments) ? str2nr(a:arguments[0]) : 0) . ")")
+  call g:VimpairRunPython(
+        \  "vimpair.max_message_size = int(vim.eval('g:VimpairMaxMessageSize'))")
+  call g:VimpairRunPython(
+        \  "vimpair.send_hash_tree.interval =" .
+        \  "    int(vim.eval('g:VimpairConsistencyCheckInterval')) / 1000."
+        \)
+  call g:VimpairRunPython(
+        \  "pairing.message_handler = MessageHandler(" .
         \  "    callbacks=vimpair.MessageCallbacks(" .
-        \  "        take_control=lambda: vim_call('s:VimpairTakeControl')," .
-        \  "        session=session," .
-        \  "    )" .
+        \  "        take_control=pairing.take_control," .
+        \  "        session=pairing.folder," .
+        \  "        keep_undo_history=" .
+        \  "            int(vim.eval('g:VimpairObserverUndoHistory')) != 0," .
+        \  "    )," .
+        \  "    time_budget=int(vim.eval('g:VimpairProcessTimeBudget')) or None," .
+        \  "    metrics=sessions.metrics," .
+        \  "    max_message_size=vimpair.max_message_size," .
         \  ")"
         \)
+
+  call s:VimpairStartTimer()
+  call s:VimpairStartObserving()
+  return 1
+endfunction
+
+function! s:VimpairStopSession()
+  call g:VimpairRunPython(
+        \  "if sessions.current(): sessions.stop(sessions.current())")
+  if !g:VimpairEvalPython("len(sessions)")
+    call s:VimpairCleanup()
+  endif
 endfunction
 
 function! s:VimpairCleanup()
@@ -118,21 +215,27 @@ function! s:VimpairCleanup()
     autocmd!
   augroup END
 
-  call g:VimpairRunPython("message_handler = None")
-  call g:VimpairRunPython("vimpair.connector.disconnect()")
+  call g:VimpairRunPython("sessions.stop_all()")
 endfunction
 
 
-function! VimpairServerStart()
-  call s:VimpairInitialize()
+function! VimpairServerStart(...)
+  if !s:VimpairStartSession(1, a:000)
+    return
+  endif
 
-  call g:VimpairRunPython("vimpair.connector = ClientConnector(server_socket_factory)")
+  if g:VimpairTransport ==# "relay"
+    " Through a relay, the Editor connects just like the Observers
+    call g:VimpairRunPython("vimpair.connector = ServerConnector(" .
+          \  "    socket_factory_for(settings, True), connections_for(settings, True))")
+  else
+    call g:VimpairRunPython("vimpair.connector = ClientConnector(" .
+          \  "    socket_factory_for(settings, True), connections_for(settings, True))")
+  endif
 
-  call s:VimpairStartTimer(
-        \  "if vimpair.check_for_new_client(): vim_call('s:VimpairStopTimer')"
-        \)
-  call s:VimpairStartObserving()
   call g:VimpairRunPython(
+        \  "vimpair.send_project.enabled =" .
+        \  "    int(vim.eval('g:VimpairPrefetchProject')) != 0 \n" .
         \  "vimpair.send_file_change.enabled = True \n" .
         \  "vimpair.send_file_change.should_conceal_path =" .
         \  "    lambda: int(vim.eval('g:VimpairConcealFilePaths')) != 0 \n" .
@@ -141,36 +244,60 @@ function! VimpairServerStart()
 endfunction
 
 function! VimpairServerStop()
-  call s:VimpairCleanup()
+  call s:VimpairStopSession()
 endfunction
 
 
-function! VimpairClientStart()
-  call g:VimpairRunPython("session = Session()")
-  call s:VimpairInitialize()
+function! VimpairClientStart(...)
+  if !s:VimpairStartSession(0, a:000)
+    return
+  endif
 
-  call g:VimpairRunPython("vimpair.connector = ServerConnector(client_socket_factory)")
+  call g:VimpairRunPython("vimpair.connector = ServerConnector(" .
+        \  "    socket_factory_for(settings, False), connections_for(settings, False))")
 
   call g:VimpairRunPython("vimpair.send_file_change.enabled = False")
-  call s:VimpairStartReceivingMessagesTimer()
 endfunction
 
 function! VimpairClientStop()
-  call s:VimpairCleanup()
-  call g:VimpairRunPython("session.end()")
-  call g:VimpairRunPython("session = None")
+  call s:VimpairStopSession()
 endfunction
 
 
 function! VimpairHandover()
+  call s:VimpairRunAsEditor("sessions.current().hand_over_control()")
+endfunction
+
+
+function! VimpairProfile(action, ...)
+  if a:action ==# "start"
+    call g:VimpairRunPython(
+          \  "profiler.start(with_cprofile=" .
+          \  (a:0 && a:1 ==# "cprofile" ? "True" : "False") . ")")
+  elseif a:action ==# "stop"
+    call g:VimpairRunPython("profiler.stop()")
+  elseif a:action ==# "dump"
+    let l:report_path = a:0 ? a:1 : g:VimpairProfileReport
+    call g:VimpairRunPython(
+          \  "vimpair.show_status_message('Profile written to \"%s\"'" .
+          \  "    % profiler.dump(vim.eval('l:report_path') or None))")
+  else
+    call g:VimpairRunPython(
+          \  "vimpair.show_status_message('Use :VimpairProfile start|stop|dump')")
+  endif
+endfunction
+
+function! VimpairStatus()
   call g:VimpairRunPython(
-        \  "if vimpair.hand_over_control(): vim_call('s:VimpairReleaseControl')"
-        \)
+        \  "sessions.with_current(vimpair.show_link_status) or " .
+        \  "    vimpair.show_status_message('No session in this window')")
 endfunction
 
 
-command! -nargs=0 VimpairServerStart :call VimpairServerStart()
+command! -nargs=? VimpairServerStart :call VimpairServerStart(<f-args>)
 command! -nargs=0 VimpairServerStop :call VimpairServerStop()
-command! -nargs=0 VimpairClientStart :call VimpairClientStart()
+command! -nargs=? VimpairClientStart :call VimpairClientStart(<f-args>)
 command! -nargs=0 VimpairClientStop :call VimpairClientStop()
 command! -nargs=0 VimpairHandover :call VimpairHandover()
+command! -nargs=+ VimpairProfile :call VimpairProfile(<f-args>)
+command! -nargs=0 VimpairStatus :call VimpairStatus()
@@ -0,0 +1,80 @@
+""" Measures how fast contents updates are encoded into messages and decoded
+    again, for ASCII and for non-ASCII heavy contents.
+
+    Run from the 'python' folder: python -m benchmarks.encoding_benchmark
+"""
+from argparse import ArgumentParser
+from timeit import default_timer
+
+from vimpair.protocol import MessageHandler, generate_contents_update_messages
+from vimpair.protocol.handle_messages import NullCallbacks
+
+
+READ_SIZE = 64 * 1024
+LINES = {
+    'ascii': u'    return self._callbacks.update_contents(contents)  # ok\n',
+    'latin': u'    Grüße aus Köln, schöne Übergänge für Äpfel und Öfen\n',
+    'cjk': u'    这是一个用于测试编码和解码速度的中文句子。\n',
+    'emoji': u'    🙂🚀✨ mixed with text 🧪📦🔧 and more 🎉\n',
+}
+
+
+class ReceivedContents(NullCallbacks):
+
+    def __init__(self):
+        super(ReceivedContents, self).__init__()
+        self.contents = None
+        self.update_contents = self._set_contents
+
+    def _set_contents(self, contents):
+        self.contents = contents
+
+
+def _best_time(function, repetitions):
+    best = None
+    for _ in range(repetitions):
+        start = default_timer()
+        function()
+        duration = default_timer() - start
+        best = duration if best is None else min(best, duration)
+    return best
+
+
+def measure(contents, repetitions):
+    ''' returns the throughput in MB/s of the encoded contents for
+        generating the messages and for decoding them from reads '''
+    messages = generate_contents_update_messages(contents)
+    stream = b''.join(messages)
+    reads = [stream[start:start + READ_SIZE] for start in range(0, len(stream), READ_SIZE)]
+    size = len(contents.encode('utf-8')) / (1024. * 1024.)
+
+    def decode():
+        callbacks = ReceivedContents()
+        handler = MessageHandler(callbacks=callbacks)
+        for data in reads:
+            handler.process([data])
+        assert callbacks.contents == contents
+
+    generate_time = _best_time(lambda: generate_contents_update_messages(contents), repetitions)
+    decode_time = _best_time(decode, repetitions)
+    return size / generate_time, size / decode_time
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 4, 16],
+                        help='sizes of the contents in MB (encoded)')
+    parser.add_argument('--repetitions', type=int, default=3)
+    arguments = parser.parse_args()
+
+    for size in arguments.sizes:
+        for name, line in sorted(LINES.items()):
+            line_size = len(line.encode('utf-8'))
+            contents = line * (size * 1024 * 1024 // line_size)
+            generate, decode = measure(contents, arguments.repetitions)
+            print('%4d MB %-5s: generate %8.1f MB/s, decode %8.1f MB/s' % (
+                size, name, generate, decode))
+
+
+if __name__ == '__main__':
+    main()
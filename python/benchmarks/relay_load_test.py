@@ -0,0 +1,132 @@
+""" Drives many simulated sessions through a local relay at once.
+
+    Run from the 'python' folder: python -m benchmarks.relay_load_test
+"""
+import asyncio
+from argparse import ArgumentParser
+from signal import SIGINT
+from socket import create_connection
+from subprocess import Popen
+import sys
+from time import sleep
+from timeit import default_timer
+
+from vimpair.protocol import (
+    PEER_JOINED_MESSAGE,
+    generate_cursor_position_message,
+    generate_join_session_message,
+    generate_lines_delta_message,
+)
+
+
+HOST = '127.0.0.1'
+START_TIMEOUT = 5.
+
+
+def _session_messages(number_of_messages):
+    messages = []
+    for index in range(number_of_messages):
+        messages.append(generate_lines_delta_message(
+            index + 1,
+            index,
+            1,
+            ['line %d of a simulated session' % index],
+        ))
+        messages.append(generate_cursor_position_message(index, 4))
+    return messages
+
+
+async def _join(port, session_id, is_host):
+    reader, writer = await asyncio.open_connection(HOST, port)
+    writer.write(generate_join_session_message(session_id, is_host))
+    return reader, writer
+
+
+async def _run_session(port, session_id, messages):
+    ''' returns the latencies of the messages the host sends to the observer '''
+    host_reader, host_writer = await _join(port, session_id, True)
+    observer_reader, observer_writer = await _join(port, session_id, False)
+    await host_reader.readexactly(len(PEER_JOINED_MESSAGE))
+    latencies = []
+    for message in messages:
+        start = default_timer()
+        host_writer.write(message)
+        await observer_reader.readexactly(len(message))
+        latencies.append(default_timer() - start)
+    host_writer.close()
+    observer_writer.close()
+    return latencies
+
+
+async def _run_sessions(port, number_of_sessions, messages):
+    results = await asyncio.gather(*(
+        _run_session(port, 'load-test-%d' % index, messages)
+        for index in range(number_of_sessions)
+    ))
+    return sorted(latency for latencies in results for latency in latencies)
+
+
+def _wait_for_relay(port):
+    deadline = default_timer() + START_TIMEOUT
+    while True:
+        try:
+            create_connection((HOST, port)).close()
+            return
+        except OSError:
+            if default_timer() > deadline:
+                raise
+            sleep(.05)
+
+
+def measure(port, workers, number_of_sessions, number_of_messages):
+    ''' returns a tuple (messages per second, median latency, 99th
+        percentile latency) with all sessions running concurrently '''
+    relay = Popen([
+        sys.executable, '-m', 'relay.broker',
+        '--host', HOST,
+        '--port', str(port),
+        '--workers', str(workers),
+    ])
+    try:
+        _wait_for_relay(port)
+        messages = _session_messages(number_of_messages)
+        start = default_timer()
+        latencies = asyncio.run(_run_sessions(port, number_of_sessions, messages))
+        duration = default_timer() - start
+    finally:
+        relay.send_signal(SIGINT)
+        relay.wait()
+    return (
+        len(latencies) / duration,
+        latencies[len(latencies) // 2],
+        latencies[int(len(latencies) * .99)],
+    )
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=50108)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--sessions', type=int, default=200)
+    parser.add_argument('--messages', type=int, default=100,
+                        help='line updates per session, each followed by a cursor position')
+    arguments = parser.parse_args()
+
+    for workers in arguments.workers:
+        throughput, median, percentile = measure(
+            arguments.port,
+            workers,
+            arguments.sessions,
+            arguments.messages,
+        )
+        print('%2d worker(s), %4d sessions: %9.0f messages/s, latency %6.2f ms (p99 %6.2f ms)' % (
+            workers,
+            arguments.sessions,
+            throughput,
+            median * 1000.,
+            percentile * 1000.,
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+""" Compares the throughput of Vimpair's transports for large updates.
+
+    Run from the 'python' folder: python -m benchmarks.transport_benchmark
+"""
+from argparse import ArgumentParser
+from os import path
+from shutil import rmtree
+from tempfile import mkdtemp
+from threading import Thread
+from timeit import default_timer
+
+from vimpair.connection import (
+    SHARED_MEMORY_TRANSPORT,
+    TCP_TRANSPORT,
+    UNIX_TRANSPORT,
+    create_client_socket,
+    create_server_socket,
+    create_shared_memory_client_connection,
+    create_shared_memory_server_connection,
+)
+from vimpair.protocol import generate_contents_update_messages
+
+
+READ_SIZE = 64 * 1024
+
+
+def _receive(sock, expected_size, result):
+    received_size = 0
+    sock.settimeout(None)
+    while received_size < expected_size:
+        part = sock.recv(READ_SIZE)
+        if not part:
+            break
+        received_size += len(part)
+    result.append(default_timer())
+
+
+def _receive_from_shared_memory(connection, expected_size, result):
+    received_size = 0
+    while received_size < expected_size:
+        received_size += len(connection.received_messages[0])
+    result.append(default_timer())
+
+
+def _send(sock, messages, repetitions):
+    for _ in range(repetitions):
+        for message in messages:
+            sock.sendall(message)
+
+
+def _send_to_shared_memory(connection, messages, repetitions):
+    for _ in range(repetitions):
+        for message in messages:
+            connection.send_message(message)
+    while connection.has_queued_messages:
+        connection.flush()
+
+
+def measure(transport, socket_path, contents, repetitions):
+    ''' returns the throughput in MB/s for sending contents repeatedly '''
+    messages = generate_contents_update_messages(contents)
+    expected_size = repetitions * sum(len(message) for message in messages)
+
+    server_socket = create_server_socket(transport=transport, socket_path=socket_path)
+    client_socket = create_client_socket(transport=transport, socket_path=socket_path)
+    connection_socket = server_socket.get_client_connection()
+    connections = []
+    try:
+        if transport == SHARED_MEMORY_TRANSPORT:
+            connections.append(create_shared_memory_server_connection(connection_socket))
+            connections.append(create_shared_memory_client_connection(client_socket))
+            sender, receiver = connections
+            send, receive = _send_to_shared_memory, _receive_from_shared_memory
+        else:
+            sender, receiver = connection_socket, client_socket
+            send, receive = _send, _receive
+
+        result = []
+        receiving_thread = Thread(
+            target=receive,
+            args=(receiver, expected_size, result),
+        )
+        receiving_thread.start()
+
+        start = default_timer()
+        send(sender, messages, repetitions)
+        receiving_thread.join()
+        return expected_size / (result[0] - start) / (1024. * 1024.)
+    finally:
+        for closeable in connections + [connection_socket, client_socket, server_socket]:
+            closeable.close()
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 4, 16],
+                        help='sizes of the updates in MB')
+    parser.add_argument('--repetitions', type=int, default=5)
+    arguments = parser.parse_args()
+
+    folder = mkdtemp('VimpairBenchmark')
+    try:
+        socket_path = path.join(folder, 'benchmark.socket')
+        for size in arguments.sizes:
+            contents = ('0123456789abcde\n' * (size * 1024 * 1024 // 16))
+            for transport in (TCP_TRANSPORT, UNIX_TRANSPORT, SHARED_MEMORY_TRANSPORT):
+                throughput = measure(
+                    transport,
+                    socket_path,
+                    contents,
+                    arguments.repetitions,
+                )
+                print('%4d MB update, %-4s: %8.1f MB/s' % (size, transport, throughput))
+    finally:
+        rmtree(folder, True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,292 @@
+""" Relays Vimpair sessions, so that Editors and Observers only have to
+    connect to the relay rather than to each other.
+
+    Run from the 'python' folder: python -m relay.broker --port 50008
+"""
+import asyncio
+from argparse import ArgumentParser
+from array import array
+from hmac import compare_digest
+from multiprocessing import Process
+import socket
+from zlib import crc32
+
+from vimpair.protocol import (
+    MAX_MESSAGE_SIZE,
+    MessageHandler,
+    generate_peer_joined_message,
+    parse_join_session_message,
+    split_complete_messages,
+)
+
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 50008
+READ_SIZE = 64 * 1024
+MAX_JOIN_SIZE = 1024
+JOIN_TIMEOUT = 5.
+# Observers not keeping up are dropped rather than buffering without end
+MAX_BUFFERED_SIZE = 16 * 1024 * 1024
+
+_PEER_JOINED = generate_peer_joined_message()
+
+
+class Session(object):
+
+    def __init__(self):
+        self.host = None
+        self.observers = set()
+        self.secret = None
+
+    @property
+    def is_empty(self):
+        return self.host is None and not self.observers
+
+    def admits_host(self, secret):
+        ''' the first host sets the session's secret, later hosts taking
+            over the session have to know it '''
+        secret = secret.encode('utf-8')
+        if self.secret is None:
+            self.secret = secret
+        return compare_digest(self.secret, secret)
+
+    def targets(self, writer):
+        ''' returns the writers of the peers receiving what writer sends '''
+        if writer is self.host:
+            return list(self.observers)
+        if writer in self.observers and self.host is not None:
+            return [self.host]
+        return []
+
+
+class ReceivedMessages(object):
+    """ Collects the data received from a peer until it forms complete
+        messages, so that messages from several observers are passed on to
+        the host whole rather than interleaved """
+
+    def __init__(self):
+        self._parts = []
+        self._missing_length = 0
+        self.size = 0
+
+    def add(self, data):
+        ''' returns the messages completed by data '''
+        self._parts.append(data)
+        self.size += len(data)
+        if len(data) < self._missing_length:
+            # Joining the parts with each read would take quadratic time
+            self._missing_length -= len(data)
+            return b''
+        complete, rest, self._missing_length = split_complete_messages(b''.join(self._parts))
+        self._parts = [rest]
+        self.size = len(rest) + self._missing_length
+        return complete
+
+
+class Relay(object):
+    """ Forwards what a session's host sends to all of its observers, and
+        what the observers send to the host; only complete messages are
+        passed on, without decoding their contents """
+
+    def __init__(self):
+        self.sessions = {}
+
+    async def serve(self, reader, writer, is_host, session_id, secret='', data=b''):
+        session = self.sessions.setdefault(session_id, Session())
+        if is_host and not session.admits_host(secret):
+            self._leave(session_id, session, writer)
+            return
+        if is_host:
+            if session.host is not None:
+                # The host has reconnected, its old connection is stale
+                session.host.close()
+            session.host = writer
+            if session.observers:
+                writer.write(_PEER_JOINED)
+        else:
+            session.observers.add(writer)
+            if session.host is not None:
+                session.host.write(_PEER_JOINED)
+        received = ReceivedMessages()
+        try:
+            while True:
+                if data:
+                    complete = received.add(data)
+                    if received.size > MAX_MESSAGE_SIZE:
+                        break
+                    if complete:
+                        self._forward(session, writer, complete)
+                data = await reader.read(READ_SIZE)
+                if not data:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            self._leave(session_id, session, writer)
+
+    @staticmethod
+    def _forward(session, writer, data):
+        for target in session.targets(writer):
+            if target.transport.get_write_buffer_size() > MAX_BUFFERED_SIZE:
+                target.close()
+            else:
+                target.write(data)
+
+    def _leave(self, session_id, session, writer):
+        if session.host is writer:
+            session.host = None
+        session.observers.discard(writer)
+        writer.close()
+        if session.is_empty and self.sessions.get(session_id) is session:
+            del self.sessions[session_id]
+
+
+async def _read_join_message(receive):
+    ''' returns a tuple (end, is_host, session_id, secret, data) with all
+        data received so far, or None if no valid join message was received '''
+    data = b''
+    while len(data) <= MAX_JOIN_SIZE:
+        part = await receive()
+        if not part:
+            return None
+        data += part
+        try:
+            joined = parse_join_session_message(data)
+        except MessageHandler.MessageMatchingError:
+            return None
+        if joined is not None:
+            return joined + (data,)
+    return None
+
+
+async def _join(relay, reader, writer):
+    receive = lambda: reader.read(MAX_JOIN_SIZE)
+    try:
+        joined = await asyncio.wait_for(_read_join_message(receive), JOIN_TIMEOUT)
+    except (asyncio.TimeoutError, ConnectionError):
+        joined = None
+    if joined is None:
+        writer.close()
+        return
+    end, is_host, session_id, secret, data = joined
+    await relay.serve(reader, writer, is_host, session_id, secret, data[end:])
+
+
+async def start_relay(host=DEFAULT_HOST, port=DEFAULT_PORT, relay=None):
+    ''' starts serving sessions in the running event loop, returns the server '''
+    relay = relay or Relay()
+    return await asyncio.start_server(
+        lambda reader, writer: _join(relay, reader, writer),
+        host,
+        port,
+    )
+
+
+def _send_socket(channel, sock, data):
+    fds = array('i', [sock.fileno()])
+    channel.sendmsg([data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds.tobytes())])
+
+
+def _receive_socket(channel):
+    fds = array('i')
+    data, ancillary_data, _, _ = channel.recvmsg(
+        2 * MAX_JOIN_SIZE + READ_SIZE,
+        socket.CMSG_LEN(fds.itemsize),
+    )
+    for level, kind, fd_data in ancillary_data:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(fd_data[:len(fd_data) - len(fd_data) % fds.itemsize])
+    return data, socket.socket(fileno=fds[0]) if fds else None
+
+
+async def _accept_for_workers(server_socket, channels):
+    ''' reads the join message of each new connection, then hands the
+        connection over to the worker responsible for its session '''
+    loop = asyncio.get_running_loop()
+
+    async def hand_over(sock):
+        receive = lambda: loop.sock_recv(sock, MAX_JOIN_SIZE)
+        try:
+            joined = await asyncio.wait_for(_read_join_message(receive), JOIN_TIMEOUT)
+        except (asyncio.TimeoutError, ConnectionError):
+            joined = None
+        if joined is not None:
+            _, _, session_id, _, data = joined
+            # All connections of a session have to end up in the same worker
+            worker = crc32(session_id.encode('utf-8')) % len(channels)
+            _send_socket(channels[worker], sock, data)
+        sock.close()
+
+    while True:
+        sock, _ = await loop.sock_accept(server_socket)
+        sock.setblocking(False)
+        loop.create_task(hand_over(sock))
+
+
+async def _serve_handed_over(channel):
+    loop = asyncio.get_running_loop()
+    relay = Relay()
+
+    async def serve(data, sock):
+        # The acceptor only hands over connections with a valid join message
+        end, is_host, session_id, secret = parse_join_session_message(data)
+        reader, writer = await asyncio.open_connection(sock=sock)
+        await relay.serve(reader, writer, is_host, session_id, secret, data[end:])
+
+    def receive():
+        data, sock = _receive_socket(channel)
+        if sock is not None:
+            loop.create_task(serve(data, sock))
+
+    channel.setblocking(False)
+    loop.add_reader(channel.fileno(), receive)
+    await loop.create_future()
+
+
+def _run_worker(channel):
+    try:
+        asyncio.run(_serve_handed_over(channel))
+    except KeyboardInterrupt:
+        pass
+
+
+async def _serve_forever(host, port):
+    server = await start_relay(host, port)
+    async with server:
+        await server.serve_forever()
+
+
+def run(host=DEFAULT_HOST, port=DEFAULT_PORT, workers=1):
+    ''' serves sessions until interrupted; with several workers, every
+        worker process relays its share of the sessions '''
+    if workers <= 1:
+        asyncio.run(_serve_forever(host, port))
+        return
+
+    channels = []
+    for _ in range(workers):
+        channel, worker_channel = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        Process(target=_run_worker, args=(worker_channel,), daemon=True).start()
+        worker_channel.close()
+        channels.append(channel)
+    server_socket = socket.create_server((host, port))
+    server_socket.setblocking(False)
+    asyncio.run(_accept_for_workers(server_socket, channels))
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default=DEFAULT_HOST,
+                        help='address to listen on, only local connections by default')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes relaying sessions')
+    arguments = parser.parse_args()
+    try:
+        run(arguments.host, arguments.port, arguments.workers)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
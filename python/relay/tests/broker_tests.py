@@ -0,0 +1,198 @@
+import asyncio
+import socket
+from unittest import TestCase
+
+from ..broker import Relay, _accept_for_workers, _serve_handed_over, start_relay
+from vimpair.protocol import (
+    PEER_JOINED_MESSAGE,
+    generate_join_session_message,
+)
+
+
+def run(coroutine):
+    return asyncio.run(asyncio.wait_for(coroutine, 5.))
+
+
+class RelayTests(TestCase):
+
+    async def _start(self):
+        self.relay = Relay()
+        self.server = await start_relay('127.0.0.1', 0, relay=self.relay)
+        self.port = self.server.sockets[0].getsockname()[1]
+        # Unreferenced writers would close their connections
+        self.connections = []
+
+    async def _join(self, session_id, is_host, secret='secret'):
+        reader, writer = await asyncio.open_connection('127.0.0.1', self.port)
+        writer.write(generate_join_session_message(session_id, is_host, secret))
+        await writer.drain()
+        self.connections.append((reader, writer))
+        return reader, writer
+
+    async def _pair(self, session_id):
+        host = await self._join(session_id, True)
+        observer = await self._join(session_id, False)
+        await host[0].readexactly(len(PEER_JOINED_MESSAGE))
+        return host, observer
+
+    def _run_with_relay(self, test):
+        async def run_test():
+            await self._start()
+            try:
+                return await test()
+            finally:
+                self.server.close()
+        return run(run_test())
+
+
+    def test_host_is_notified_when_observer_joins(self):
+        async def test():
+            host = await self._join('session', True)
+            await self._join('session', False)
+            return await host[0].readexactly(len(PEER_JOINED_MESSAGE))
+
+        self.assertEqual(self._run_with_relay(test), PEER_JOINED_MESSAGE.encode('utf-8'))
+
+    def test_host_joining_later_is_notified_of_observers(self):
+        async def test():
+            await self._join('session', False)
+            host = await self._join('session', True)
+            return await host[0].readexactly(len(PEER_JOINED_MESSAGE))
+
+        self.assertEqual(self._run_with_relay(test), PEER_JOINED_MESSAGE.encode('utf-8'))
+
+    def test_forwards_host_data_to_observers(self):
+        async def test():
+            (_, host), (observer, _) = await self._pair('session')
+            host.write(b'VIMPAIR_FULL_UPDATE|4|Text')
+            return await observer.readexactly(26)
+
+        self.assertEqual(self._run_with_relay(test), b'VIMPAIR_FULL_UPDATE|4|Text')
+
+    def test_forwards_observer_data_to_host(self):
+        async def test():
+            (host, _), (_, observer) = await self._pair('session')
+            observer.write(b'VIMPAIR_RESYNC_REQUEST')
+            return await host.readexactly(22)
+
+        self.assertEqual(self._run_with_relay(test), b'VIMPAIR_RESYNC_REQUEST')
+
+    def test_forwards_data_sent_along_with_join_message(self):
+        async def test():
+            observer, _ = await self._join('session', False)
+            while not self.relay.sessions:
+                await asyncio.sleep(.01)
+            reader, writer = await asyncio.open_connection('127.0.0.1', self.port)
+            self.connections.append((reader, writer))
+            writer.write(
+                generate_join_session_message('session', True) +
+                b'VIMPAIR_TAKE_CONTROL'
+            )
+            return await observer.readexactly(20)
+
+        self.assertEqual(self._run_with_relay(test), b'VIMPAIR_TAKE_CONTROL')
+
+    def test_sessions_are_kept_apart(self):
+        async def test():
+            (_, first_host), (first_observer, _) = await self._pair('first')
+            (_, second_host), (second_observer, _) = await self._pair('second')
+            second_host.write(b'VIMPAIR_PING|1|2')
+            first_host.write(b'VIMPAIR_PING|1|1')
+            return (
+                await first_observer.readexactly(16),
+                await second_observer.readexactly(16),
+            )
+
+        self.assertEqual(
+            self._run_with_relay(test),
+            (b'VIMPAIR_PING|1|1', b'VIMPAIR_PING|1|2'),
+        )
+
+    def test_messages_of_observers_are_not_interleaved(self):
+        async def test():
+            (host, _), (_, first_observer) = await self._pair('session')
+            _, second_observer = await self._join('session', False)
+            await host.readexactly(len(PEER_JOINED_MESSAGE))
+            first_observer.write(b'VIMPAIR_PING|1|')
+            await first_observer.drain()
+            second_observer.write(b'VIMPAIR_RESYNC_')
+            await second_observer.drain()
+            await asyncio.sleep(.05)
+            first_observer.write(b'1')
+            second_observer.write(b'REQUEST')
+            return {await host.readexactly(16), await host.readexactly(22)}
+
+        self.assertEqual(
+            self._run_with_relay(test),
+            {b'VIMPAIR_PING|1|1', b'VIMPAIR_RESYNC_REQUEST'},
+        )
+
+    def test_host_with_secret_takes_over_session(self):
+        async def test():
+            (_, old_host), (observer, _) = await self._pair('session')
+            _, new_host = await self._join('session', True)
+            while self.relay.sessions['session'].host is old_host:
+                await asyncio.sleep(.01)
+            new_host.write(b'VIMPAIR_TAKE_CONTROL')
+            return await observer.readexactly(20)
+
+        self.assertEqual(self._run_with_relay(test), b'VIMPAIR_TAKE_CONTROL')
+
+    def test_host_without_secret_cant_take_over_session(self):
+        async def test():
+            (_, host), (observer, _) = await self._pair('session')
+            intruder, _ = await self._join('session', True, secret='guessed')
+            closed = await intruder.read()
+            host.write(b'VIMPAIR_TAKE_CONTROL')
+            return closed, await observer.readexactly(20)
+
+        self.assertEqual(self._run_with_relay(test), (b'', b'VIMPAIR_TAKE_CONTROL'))
+
+    def test_closes_connection_without_join_message(self):
+        async def test():
+            reader, writer = await asyncio.open_connection('127.0.0.1', self.port)
+            writer.write(b'VIMPAIR_FULL_UPDATE|4|Text')
+            return await reader.read()
+
+        self.assertEqual(self._run_with_relay(test), b'')
+
+    def test_session_ends_when_all_peers_have_left(self):
+        async def test():
+            (_, host), (_, observer) = await self._pair('session')
+            host.close()
+            observer.close()
+            while self.relay.sessions:
+                await asyncio.sleep(.01)
+            return self.relay.sessions
+
+        self.assertEqual(self._run_with_relay(test), {})
+
+
+class WorkerTests(TestCase):
+
+    def test_sessions_with_non_ascii_ids_are_handed_over(self):
+        async def test():
+            server_socket = socket.create_server(('127.0.0.1', 0))
+            server_socket.setblocking(False)
+            channel, worker_channel = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+            tasks = [
+                asyncio.create_task(_accept_for_workers(server_socket, [channel])),
+                asyncio.create_task(_serve_handed_over(worker_channel)),
+            ]
+            port = server_socket.getsockname()[1]
+            connections = []
+            try:
+                for is_host in (True, False):
+                    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+                    writer.write(generate_join_session_message('caf\xe9-\u4e16', is_host))
+                    connections.append((reader, writer))
+                return await connections[0][0].readexactly(len(PEER_JOINED_MESSAGE))
+            finally:
+                for task in tasks:
+                    task.cancel()
+                for _, writer in connections:
+                    writer.close()
+                for sock in (server_socket, channel, worker_channel):
+                    sock.close()
+
+        self.assertEqual(run(test()), PEER_JOINED_MESSAGE.encode('utf-8'))
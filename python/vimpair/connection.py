@@ -1,18 +1,64 @@
+from array import array
+from collections import deque
+from functools import partial
+from mmap import mmap
+from os import chmod, environ, fdopen, lstat, mkdir, path, remove, stat
+from select import select
+from shutil import rmtree
+from stat import S_IMODE, S_ISDIR, S_ISSOCK
+from struct import Struct
+from tempfile import gettempdir, mkdtemp
+from timeit import default_timer
 from socket import (
     AF_INET,
+    IPPROTO_TCP,
+    MSG_PEEK,
     SOCK_STREAM,
     SOL_SOCKET,
+    SO_RCVBUF,
     SO_REUSEADDR,
+    SO_SNDBUF,
+    TCP_NODELAY,
     error,
     gethostbyname,
     socket,
     timeout,
 )
+try:
+    from socket import AF_UNIX
+except ImportError:
+    AF_UNIX = None
+try:
+    from os import getuid
+except ImportError:
+    # Only needed for Unix domain sockets, which aren't available either
+    getuid = None
+try:
+    # Lets the files of the ring buffers be passed to the other side
+    from socket import CMSG_LEN, SCM_RIGHTS
+except ImportError:
+    SCM_RIGHTS = None
 
 
 SERVER_ADDRESS = gethostbyname('localhost')
 SERVER_PORT = 50007
+TCP_TRANSPORT = 'tcp'
+UNIX_TRANSPORT = 'unix'
+SHARED_MEMORY_TRANSPORT = 'shm'
+SOCKET_NAME = 'vimpair.socket'
 MAX_READ_SIZE = 1024
+# Reading stops at this size, the rest stays in the socket until the next
+# poll, which keeps a fast sender from filling Vim's memory
+MAX_RECEIVE_SIZE = 4 * 1024 * 1024
+CONNECT_TIMEOUT = 1.
+RECEIVE_TIMEOUT = .1
+
+CONTROL_PRIORITY = 0
+CURSOR_PRIORITY = 1
+CONTENTS_PRIORITY = 2
+# Limits how much contents are sent per flush, so that control and cursor
+# messages queued in the meantime don't have to wait for large transfers
+MAX_CONTENTS_PER_FLUSH = 256 * 1024
 
 _noop = lambda *a, **k: None
 
@@ -23,71 +69,698 @@ class ServerSocket(socket):
     def get_client_connection(self):
         try:
             connection_socket, _ = self.accept()
+            # Otherwise, it would inherit blocking mode (or this timeout)
+            connection_socket.settimeout(RECEIVE_TIMEOUT)
             return connection_socket
         except timeout:
             pass
 
 
-def create_server_socket():
+def default_socket_path():
+    ''' returns the path of the socket in a folder only the current user
+        can access, so that other users can neither connect to it nor
+        put something else in its place '''
+    folder = environ.get('XDG_RUNTIME_DIR')
+    if not folder:
+        folder = path.join(gettempdir(), 'vimpair-%d' % getuid())
+        try:
+            mkdir(folder, 0o700)
+        except OSError:
+            pass
+        # The folder might have been created by someone else before
+        info = lstat(folder)
+        if not S_ISDIR(info.st_mode) or info.st_uid != getuid():
+            raise OSError('%s is not a folder of the current user' % folder)
+        if S_IMODE(info.st_mode) != 0o700:
+            chmod(folder, 0o700)
+    return path.join(folder, SOCKET_NAME)
+
+
+def _remove_stale_socket(address):
+    ''' removes a socket file left behind by a previous session, but
+        neither other files nor sockets still in use '''
+    try:
+        if not S_ISSOCK(stat(address).st_mode):
+            return
+    except OSError:
+        return
+    probe = socket(AF_UNIX, SOCK_STREAM)
+    probe.settimeout(CONNECT_TIMEOUT)
+    try:
+        probe.connect(address)
+    except timeout:
+        # Still in use, just busy
+        pass
+    except error:
+        remove(address)
+    finally:
+        probe.close()
+
+
+def _family_and_address(transport, socket_path, port):
+    if transport in (UNIX_TRANSPORT, SHARED_MEMORY_TRANSPORT):
+        return AF_UNIX, socket_path or default_socket_path()
+    return AF_INET, (SERVER_ADDRESS, port or SERVER_PORT)
+
+
+def create_server_socket(transport=TCP_TRANSPORT, socket_path=None, port=None):
+    sock = None
     try:
-        sock = ServerSocket(AF_INET, SOCK_STREAM)
+        family, address = _family_and_address(transport, socket_path, port)
+        sock = ServerSocket(family, SOCK_STREAM)
         sock.settimeout(1.)
-        sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
-        sock.bind((SERVER_ADDRESS, SERVER_PORT))
+        if family == AF_UNIX:
+            # A previous session might have left its socket file behind
+            _remove_stale_socket(address)
+        else:
+            sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+        sock.bind(address)
         sock.listen(1)
     except:
-        sock.close()
+        if sock is not None:
+            sock.close()
         sock = None
     finally:
         return sock
 
 
-def create_client_socket():
+def create_client_socket(transport=TCP_TRANSPORT, socket_path=None, port=None):
+    sock = None
     try:
-        sock = socket(AF_INET, SOCK_STREAM)
-        sock.settimeout(.1)
-        sock.connect((SERVER_ADDRESS, SERVER_PORT))
-    except Exception as e:
-        print(str(e))
-        sock.close()
+        family, address = _family_and_address(transport, socket_path, port)
+        sock = socket(family, SOCK_STREAM)
+        sock.settimeout(CONNECT_TIMEOUT)
+        sock.connect(address)
+        sock.settimeout(RECEIVE_TIMEOUT)
+    except Exception:
+        # Connecting is retried, see ServerConnector
+        if sock is not None:
+            sock.close()
         sock = None
     finally:
         return sock
 
 
+def create_relay_socket(address, join_message):
+    ''' connects to a relay at 'host:port' and joins a session with the
+        given message; the relay forwards everything else to the peers '''
+    host, _, port = address.rpartition(':')
+    sock = socket(AF_INET, SOCK_STREAM)
+    try:
+        sock.settimeout(CONNECT_TIMEOUT)
+        sock.connect((host or SERVER_ADDRESS, int(port)))
+        sock.sendall(_encode(join_message))
+        sock.settimeout(RECEIVE_TIMEOUT)
+    except Exception:
+        # Connecting is retried, see ServerConnector
+        sock.close()
+        sock = None
+    return sock
+
+
 class NullSocket(object):
 
     close = _noop
     sendall = _noop
     recv = _noop
+    gettimeout = _noop
+    settimeout = _noop
+
+
+class QueuedMessages(deque):
+
+    def __init__(self, messages, replaceable, on_sent=None):
+        super(QueuedMessages, self).__init__(messages)
+        self.replaceable = replaceable
+        self.on_sent = on_sent
+
+
+class MessageScheduler(object):
+    """ Queues outgoing messages by priority; flushing sends all control and
+        cursor messages, but only a limited amount of contents. Contents are
+        sent with send_bulk_message, if given. """
+
+    def __init__(self, send_message, send_bulk_message=None, timer=default_timer):
+        self._send_message = send_message
+        self._send_bulk_message = send_bulk_message or send_message
+        self._timer = timer
+        self._queues = (deque(), deque(), deque())
+        # When the queued contents started waiting, see flush
+        self._contents_queued_at = None
+
+    @property
+    def has_queued_messages(self):
+        return any(self._queues)
+
+    @property
+    def has_queued_contents(self):
+        return bool(self._queues[CONTENTS_PRIORITY])
+
+    def queue(self, messages, priority=CONTENTS_PRIORITY, replaceable=False,
+              on_sent=None):
+        ''' queues messages to be sent in order; replaceable messages are
+            dropped if they haven't been sent before the next replaceable
+            messages of the same priority are queued. on_sent is called
+            once the last of the messages has been sent. '''
+        queue = self._queues[priority]
+        if priority == CONTENTS_PRIORITY and not queue:
+            # Replaced contents keep waiting since the first ones were queued
+            self._contents_queued_at = self._timer()
+        if replaceable:
+            while queue and queue[-1].replaceable:
+                queue.pop()
+        if messages:
+            queue.append(QueuedMessages(messages, replaceable, on_sent))
+
+    def flush(self, max_contents_size=MAX_CONTENTS_PER_FLUSH, coalescing_window=0.):
+        ''' sends queued messages, highest priority first; pass None as
+            max_contents_size to send all queued contents. Contents are held
+            back until they have been queued for coalescing_window seconds,
+            so that replaceable ones can still be replaced. '''
+        for queue in self._queues[:CONTENTS_PRIORITY]:
+            while queue:
+                self._send_next(queue, self._send_message)
+        contents_queue = self._queues[CONTENTS_PRIORITY]
+        if contents_queue and max_contents_size is not None and \
+                self._timer() - self._contents_queued_at < coalescing_window:
+            return
+        contents_size = 0
+        while contents_queue and (
+            max_contents_size is None or contents_size < max_contents_size
+        ):
+            contents_size += len(self._send_next(contents_queue, self._send_bulk_message))
+
+    def clear(self):
+        for queue in self._queues:
+            queue.clear()
+
+    def _send_next(self, queue, send_message):
+        messages = queue[0]
+        message = messages.popleft()
+        if not messages:
+            queue.popleft()
+        send_message(message)
+        if not messages and messages.on_sent is not None:
+            messages.on_sent()
+        return message
+
+
+def _readable(sockets):
+    ''' returns without blocking those sockets with anything to receive '''
+    try:
+        readable, _, _ = select(sockets, [], [], 0)
+        return readable
+    except (TypeError, ValueError, error):
+        # A socket has been closed or isn't a real one
+        return []
+
+
+def _is_readable(sockets):
+    return bool(_readable(sockets))
+
+
+def _receive(sock):
+    ''' returns the bytes that have arrived, without waiting for more '''
+    parts = []
+    size = 0
+    receive_timeout = sock.gettimeout()
+    sock.settimeout(0.)
+    try:
+        while size < MAX_RECEIVE_SIZE:
+            new_part = sock.recv(MAX_READ_SIZE)
+            if new_part:
+                size += len(new_part)
+                parts.append(new_part)
+            else:
+                # Broken connection?
+                break
+    finally:
+        # Handshakes still wait as long as before
+        sock.settimeout(receive_timeout)
+        return b''.join(parts)
+
+
+def _send_all(sock, data):
+    ''' sends all data, however long it takes; a timeout would leave the
+        other side with part of a message and lose the rest '''
+    send_timeout = sock.gettimeout()
+    sock.settimeout(None)
+    try:
+        sock.sendall(data)
+    finally:
+        sock.settimeout(send_timeout)
 
 
 class Connection(object):
 
-    def __init__(self, socket):
+    def __init__(self, socket, metrics=None):
         self._socket = socket or NullSocket()
+        self._metrics = metrics
+        self._scheduler = MessageScheduler(self._measured(self.send_message))
+        # Tells the other side how much has arrived, see vimpair's link module
+        self.bytes_received = 0
 
     def close(self):
         self._socket.close()
         self._socket = NullSocket()
+        self._scheduler.clear()
+
+    def queue_messages(self, messages, priority=CONTENTS_PRIORITY, replaceable=False,
+                       on_sent=None):
+        self._scheduler.queue(
+            messages,
+            priority=priority,
+            replaceable=replaceable,
+            on_sent=on_sent,
+        )
+
+    def flush(self, max_contents_size=MAX_CONTENTS_PER_FLUSH, coalescing_window=0.):
+        self._scheduler.flush(
+            max_contents_size=max_contents_size,
+            coalescing_window=coalescing_window,
+        )
+
+    @property
+    def has_queued_messages(self):
+        return self._scheduler.has_queued_messages
+
+    @property
+    def has_queued_contents(self):
+        return self._scheduler.has_queued_contents
+
+    @property
+    def has_received_data(self):
+        ''' checks without blocking whether there is anything to receive '''
+        return _is_readable([self._socket])
+
+    def _measured(self, send_message):
+        if self._metrics is None:
+            return send_message
+
+        def send_measured_message(message):
+            start = default_timer()
+            send_message(message)
+            self._metrics.message_sent(message, default_timer() - start)
+
+        return send_measured_message
 
     def send_message(self, message):
+        self._send_through(self._socket, message)
+
+    def _send_through(self, sock, message):
         try:
-            self._socket.sendall(message)
+            _send_all(sock, message)
         except error as e:
             if e.errno == 32: # Broken pipe
                 self.close()
 
     @property
     def received_messages(self):
-        message = ''
+        ''' returns the received bytes, they are decoded by the MessageHandler '''
+        return [self._counted(_receive(self._socket))]
+
+    @property
+    def received_bulk_messages(self):
+        ''' returns the bytes received on the bulk connection, or None
+            without one, see SplitConnection '''
+        return None
+
+    def receive(self):
+        ''' returns the received messages and bulk messages, as taken by
+            MessageHandler.process, without waiting for any '''
+        if not self.has_received_data:
+            return [], None
+        return self.received_messages, self.received_bulk_messages
+
+    def _counted(self, data):
+        self.bytes_received += len(data)
+        return data
+
+
+RING_BUFFER_CAPACITY = 8 * 1024 * 1024
+SHARED_MEMORY_HANDSHAKE_TIMEOUT = 1.
+_NOTIFICATION = b'.'
+_RING_BUFFER_HEADER = Struct('=QQ') # write position, read position
+_POSITION = Struct('=Q')
+
+
+def _encode(message):
+    return message if isinstance(message, bytes) else message.encode('utf-8')
+
+
+class RingBuffer(object):
+    """ Ring buffer in a memory-mapped file, for one writing and one reading
+        process; positions count all bytes ever written/read. With fd, the
+        file is opened from that descriptor rather than from file_path. """
+
+    def __init__(self, file_path, capacity=RING_BUFFER_CAPACITY, create=False,
+                 fd=None):
+        if create:
+            with open(file_path, 'wb') as ring_file:
+                ring_file.truncate(_RING_BUFFER_HEADER.size + capacity)
+        self._file = open(file_path, 'r+b') if fd is None else fdopen(fd, 'r+b')
+        self._map = mmap(self._file.fileno(), 0)
+        self._capacity = len(self._map) - _RING_BUFFER_HEADER.size
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def fileno(self):
+        return self._file.fileno()
+
+    @property
+    def is_empty(self):
+        write_position, read_position = _RING_BUFFER_HEADER.unpack_from(self._map)
+        return write_position == read_position
+
+    def write(self, data):
+        ''' writes as much of data as fits, returns the number of bytes written '''
+        write_position, read_position = _RING_BUFFER_HEADER.unpack_from(self._map)
+        size = min(len(data), self._capacity - (write_position - read_position))
+        self._copy_in(write_position % self._capacity, data[:size])
+        _POSITION.pack_into(self._map, 0, write_position + size)
+        return size
+
+    def read(self):
+        ''' returns all bytes written since the last read '''
+        write_position, read_position = _RING_BUFFER_HEADER.unpack_from(self._map)
+        data = self._copy_out(
+            read_position % self._capacity,
+            write_position - read_position,
+        )
+        _POSITION.pack_into(self._map, _POSITION.size, write_position)
+        return data
+
+    def _copy_in(self, offset, data):
+        start = _RING_BUFFER_HEADER.size + offset
+        first_size = min(len(data), self._capacity - offset)
+        # Python 2 only assigns strings to slices of a map
+        self._map[start:start + first_size] = bytes(data[:first_size])
+        rest_size = len(data) - first_size
+        start = _RING_BUFFER_HEADER.size
+        self._map[start:start + rest_size] = bytes(data[first_size:])
+
+    def _copy_out(self, offset, size):
+        start = _RING_BUFFER_HEADER.size + offset
+        first_size = min(size, self._capacity - offset)
+        data = self._map[start:start + first_size]
+        if first_size < size:
+            start = _RING_BUFFER_HEADER.size
+            data += self._map[start:start + size - first_size]
+        return data
+
+
+class SharedMemoryConnection(Connection):
+    """ Transfers messages through memory-mapped ring buffers; the socket is
+        only used to notify the other side of new data """
+
+    def __init__(self, socket, outgoing, incoming, folder=None, metrics=None):
+        super(SharedMemoryConnection, self).__init__(socket, metrics=metrics)
+        self._socket.setblocking(False)
+        self._outgoing = outgoing
+        self._incoming = incoming
+        self._folder = folder
+        self._unwritten = bytearray()
+
+    def close(self):
+        super(SharedMemoryConnection, self).close()
+        if self._outgoing:
+            self._outgoing.close()
+            self._incoming.close()
+            self._outgoing = self._incoming = None
+        if self._folder:
+            rmtree(self._folder, True)
+            self._folder = None
+
+    def flush(self, max_contents_size=MAX_CONTENTS_PER_FLUSH, coalescing_window=0.):
+        self._write_unwritten()
+        super(SharedMemoryConnection, self).flush(
+            max_contents_size=max_contents_size,
+            coalescing_window=coalescing_window,
+        )
+
+    @property
+    def has_queued_messages(self):
+        return bool(self._unwritten) or \
+            super(SharedMemoryConnection, self).has_queued_messages
+
+    def send_message(self, message):
+        if self._outgoing:
+            self._unwritten += _encode(message)
+            self._write_unwritten()
+
+    def _write_unwritten(self):
+        # Data that doesn't fit into the ring buffer waits for the next flush
+        if self._unwritten:
+            was_empty = self._outgoing.is_empty
+            written = self._outgoing.write(self._unwritten)
+            del self._unwritten[:written]
+            if written and was_empty:
+                # Otherwise, the other side hasn't read the previous data yet
+                super(SharedMemoryConnection, self).send_message(_NOTIFICATION)
+
+    @property
+    def has_received_data(self):
+        return self._incoming is not None and not self._incoming.is_empty
+
+    @property
+    def received_messages(self):
+        try:
+            while self._socket.recv(MAX_READ_SIZE):
+                pass
+        except error:
+            pass
+        return [self._counted(self._incoming.read() if self._incoming else b'')]
+
+
+def _receive_line(sock, max_duration):
+    line = b''
+    deadline = default_timer() + max_duration
+    while not line.endswith(b'\n'):
+        if default_timer() > deadline:
+            raise error('No shared memory handshake received')
         try:
-            while True:
-                new_part = self._socket.recv(MAX_READ_SIZE)
-                if new_part:
-                    message += new_part
-                else:
-                    # Broken connection?
-                    break
-        finally:
-            return [message]
+            line += sock.recv(1)
+        except (error, timeout):
+            pass
+    return line[:-1].decode('utf-8')
+
+
+def _receive_line_and_fds(sock, max_duration):
+    ''' returns a line as _receive_line does, and the file descriptors
+        passed along with it '''
+    if SCM_RIGHTS is None:
+        return _receive_line(sock, max_duration), []
+    line = b''
+    fds = array('i')
+    deadline = default_timer() + max_duration
+    while not line.endswith(b'\n'):
+        if default_timer() > deadline:
+            raise error('No shared memory handshake received')
+        try:
+            data, ancillary_data, _, _ = sock.recvmsg(1, CMSG_LEN(2 * fds.itemsize))
+        except (error, timeout):
+            continue
+        line += data
+        for level, kind, fd_data in ancillary_data:
+            if level == SOL_SOCKET and kind == SCM_RIGHTS:
+                fds.frombytes(fd_data[:len(fd_data) - len(fd_data) % fds.itemsize])
+    return line[:-1].decode('utf-8'), list(fds)
+
+
+def create_shared_memory_server_connection(sock, capacity=RING_BUFFER_CAPACITY,
+                                           metrics=None):
+    ''' tells the client where the ring buffers are; where possible, their
+        files are passed along, as the client might run as another user and
+        can't access the folder then '''
+    folder = mkdtemp('VimpairSharedMemory')
+    outgoing = RingBuffer(path.join(folder, 'to_client'), capacity, create=True)
+    incoming = RingBuffer(path.join(folder, 'to_server'), capacity, create=True)
+    line = _encode(folder) + b'\n'
+    if SCM_RIGHTS is None:
+        sock.sendall(line)
+    else:
+        sock.sendmsg([line], [(SOL_SOCKET, SCM_RIGHTS, array(
+            'i', [outgoing.fileno(), incoming.fileno()]).tobytes())])
+    return SharedMemoryConnection(
+        sock, outgoing, incoming, folder=folder, metrics=metrics)
+
+
+def create_shared_memory_client_connection(sock, metrics=None):
+    folder, fds = _receive_line_and_fds(sock, SHARED_MEMORY_HANDSHAKE_TIMEOUT)
+    incoming_fd, outgoing_fd = fds if len(fds) == 2 else (None, None)
+    outgoing = RingBuffer(path.join(folder, 'to_server'), fd=outgoing_fd)
+    incoming = RingBuffer(path.join(folder, 'to_client'), fd=incoming_fd)
+    return SharedMemoryConnection(sock, outgoing, incoming, metrics=metrics)
+
+
+# Large buffers let contents be sent without waiting for the receiver
+BULK_BUFFER_SIZE = 4 * 1024 * 1024
+BULK_HANDSHAKE_TIMEOUT = 1.
+# The server offers its bulk socket as '<BULK_OFFER><port>\n'; clients
+# without a bulk connection skip it like any other unknown data
+BULK_OFFER = b'VIMPAIR_BULK_PORT|'
+_MAX_BULK_OFFER_LENGTH = len(BULK_OFFER) + len('65535\n')
+
+
+class SplitConnection(Connection):
+    """ Sends control and cursor messages through the socket without delay,
+        and contents through a second socket with large buffers, so that
+        large transfers don't hold up the former. The receiver can't tell
+        the order of messages on different sockets, so control messages are
+        preceded by the number of contents messages sent before them, as
+        generated by sequence_message; see the MessageHandler. """
+
+    def __init__(self, socket, bulk_socket, sequence_message, metrics=None):
+        super(SplitConnection, self).__init__(socket, metrics=metrics)
+        self._socket.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+        self._bulk_socket = bulk_socket
+        self._sequence_message = sequence_message
+        self._bulk_messages_sent = 0
+        self._sequence_sent = 0
+        self._scheduler = MessageScheduler(
+            self._measured(self.send_message),
+            send_bulk_message=self._measured(self._send_bulk_message),
+        )
+
+    def close(self):
+        super(SplitConnection, self).close()
+        self._bulk_socket.close()
+        self._bulk_socket = NullSocket()
+
+    @property
+    def has_received_data(self):
+        return _is_readable([self._socket, self._bulk_socket])
+
+    def send_message(self, message):
+        if self._sequence_sent != self._bulk_messages_sent:
+            self._sequence_sent = self._bulk_messages_sent
+            self._send_through(self._socket, self._sequence_message(self._sequence_sent))
+        self._send_through(self._socket, message)
+
+    def _send_bulk_message(self, message):
+        self._bulk_messages_sent += 1
+        self._send_through(self._bulk_socket, message)
+
+    @property
+    def received_bulk_messages(self):
+        return self._counted(_receive(self._bulk_socket))
+
+    def receive(self):
+        # Only the sockets with data are read
+        readable = _readable([self._socket, self._bulk_socket])
+        return (
+            self.received_messages if self._socket in readable else [],
+            self.received_bulk_messages if self._bulk_socket in readable else b'',
+        )
+
+
+def _set_bulk_buffers(sock):
+    # Set before connecting, as the buffers determine the window size
+    sock.setsockopt(SOL_SOCKET, SO_SNDBUF, BULK_BUFFER_SIZE)
+    sock.setsockopt(SOL_SOCKET, SO_RCVBUF, BULK_BUFFER_SIZE)
+
+
+def create_split_server_connection(sock, sequence_message, metrics=None):
+    ''' offers the client a port to connect its bulk socket to; if it
+        doesn't, e.g. without a bulk connection, the connection is plain '''
+    listener = socket(AF_INET, SOCK_STREAM)
+    try:
+        _set_bulk_buffers(listener)
+        listener.settimeout(BULK_HANDSHAKE_TIMEOUT)
+        listener.bind((sock.getsockname()[0], 0))
+        listener.listen(1)
+        sock.sendall(BULK_OFFER + _encode('%d\n' % listener.getsockname()[1]))
+        try:
+            bulk_socket, _ = listener.accept()
+        except timeout:
+            return Connection(sock, metrics=metrics)
+    finally:
+        listener.close()
+    bulk_socket.settimeout(RECEIVE_TIMEOUT)
+    return SplitConnection(sock, bulk_socket, sequence_message, metrics=metrics)
+
+
+def _receive_bulk_offer(sock, max_duration):
+    ''' returns the port the server offers, or None if it sends anything
+        else; only an offer is taken from the socket, other data is left
+        for the connection '''
+    deadline = default_timer() + max_duration
+    while default_timer() <= deadline:
+        try:
+            data = sock.recv(_MAX_BULK_OFFER_LENGTH, MSG_PEEK)
+        except (error, timeout):
+            continue
+        if not data:
+            raise error('Connection closed during handshake')
+        if not data.startswith(BULK_OFFER[:len(data)]):
+            return None
+        line_end = data.find(b'\n', len(BULK_OFFER))
+        if line_end >= 0:
+            port = data[len(BULK_OFFER):line_end]
+            if not port.isdigit():
+                return None
+            # The offer has arrived completely, so it's received at once
+            sock.recv(line_end + 1)
+            return int(port)
+        if len(data) == _MAX_BULK_OFFER_LENGTH:
+            return None
+    return None
+
+
+def create_split_client_connection(sock, sequence_message, metrics=None):
+    ''' connects a bulk socket to the port the server offers; without an
+        offer, e.g. from a server without a bulk connection, or if
+        connecting fails, the connection is plain '''
+    port = _receive_bulk_offer(sock, BULK_HANDSHAKE_TIMEOUT)
+    if port is None:
+        return Connection(sock, metrics=metrics)
+    bulk_socket = socket(AF_INET, SOCK_STREAM)
+    try:
+        _set_bulk_buffers(bulk_socket)
+        bulk_socket.settimeout(CONNECT_TIMEOUT)
+        bulk_socket.connect((sock.getpeername()[0], port))
+        bulk_socket.settimeout(RECEIVE_TIMEOUT)
+    except error:
+        bulk_socket.close()
+        # The server stops waiting for it as well
+        return Connection(sock, metrics=metrics)
+    return SplitConnection(sock, bulk_socket, sequence_message, metrics=metrics)
+
+
+class HandshakeError(Exception):
+    """ Raised when no connection could be set up on a connected socket """
+
+
+def connection_factory(transport, is_server, metrics=None, sequence_message=None):
+    ''' returns a callable creating a Connection for a given socket; the
+        connections report what they send to metrics, if given. With a
+        sequence_message, TCP connections get a second socket for contents
+        if the other side has one as well, see SplitConnection. If the
+        handshake of a connection fails, the socket is closed and a
+        HandshakeError raised. '''
+    if transport == SHARED_MEMORY_TRANSPORT:
+        create = create_shared_memory_server_connection \
+            if is_server \
+            else create_shared_memory_client_connection
+    elif transport == TCP_TRANSPORT and sequence_message is not None:
+        create = partial(
+            create_split_server_connection
+                if is_server
+                else create_split_client_connection,
+            sequence_message=sequence_message,
+        )
+    else:
+        return Connection if metrics is None else partial(Connection, metrics=metrics)
+
+    def create_connection(sock):
+        if sock is None:
+            return Connection(None, metrics=metrics)
+        try:
+            return create(sock, metrics=metrics)
+        except (error, EnvironmentError, ValueError) as e:
+            sock.close()
+            raise HandshakeError(str(e))
+
+    return create_connection
@@ -1,30 +1,82 @@
-from connection import Connection
-from threading import Thread, Lock
+from collections import deque
+from connection import Connection, HandshakeError
+from os import close, pipe, read, write
+from select import select
+from threading import Event, Thread, Lock
+
+
+FIRST_RETRY_DELAY = .25
+MAX_RETRY_DELAY = 4.
 
 
 class ConnectionHolder(object):
 
-    def __init__(self):
+    def __init__(self, connection_factory=Connection):
+        self._lock = Lock()
+        self._connection_factory = connection_factory
+        # Status messages can't be shown from the connecting thread
+        self._status_messages = deque()
         self._setup_connection(None)
 
+    def pop_status_messages(self):
+        messages = []
+        while self._status_messages:
+            messages.append(self._status_messages.popleft())
+        return messages
+
+    def _try_to_set_up_connection(self, socket):
+        ''' returns whether a connection could be set up on the socket '''
+        try:
+            self._setup_connection(socket)
+            return True
+        except HandshakeError as e:
+            self._status_messages.append('Connecting failed: %s' % e)
+            return False
+
     def _setup_connection(self, socket):
-        self._connection = Connection(socket)
+        connection = self._connection_factory(socket)
+        with self._lock:
+            self._connection = connection
 
     @property
     def connection(self):
-        return self._connection
+        with self._lock:
+            return self._connection
 
     def disconnect(self):
         self._connection.close()
         self._setup_connection(None)
 
 
+class SelfPipe(object):
+    """ Pipe that lets another thread wake up a thread waiting in select """
+
+    def __init__(self):
+        self._read_fd, self._write_fd = pipe()
+
+    def fileno(self):
+        return self._read_fd
+
+    def notify(self):
+        if self._write_fd is not None:
+            write(self._write_fd, b'.')
+
+    def clear(self):
+        read(self._read_fd, 1024)
+
+    def close(self):
+        if self._write_fd is not None:
+            close(self._read_fd)
+            close(self._write_fd)
+            self._read_fd = self._write_fd = None
+
+
 class ClientConnector(ConnectionHolder):
 
-    def __init__(self, socket_factory):
-        self._lock = Lock()
+    def __init__(self, socket_factory, connection_factory=Connection):
+        self._wakeup = SelfPipe()
 
-        super(ClientConnector, self).__init__()
+        super(ClientConnector, self).__init__(connection_factory)
         self._server_socket = socket_factory()
 
         self._start_waiting_for_client()
@@ -40,25 +92,26 @@ class ClientConnector(ConnectionHolder):
 
     def _stop_waiting_for_client(self):
         self._wait_for_client = False
+        self._wakeup.notify()
         self._thread.join()
 
+    def _wait_for_incoming_connection(self):
+        ''' blocks until a client connects or waiting is stopped '''
+        readable, _, _ = select([self._server_socket, self._wakeup], [], [])
+        if self._wakeup in readable:
+            self._wakeup.clear()
+        return self._server_socket in readable
+
     def _check_for_new_connection_to_client(self):
         if self._server_socket:
             while self._wait_for_client:
+                if not self._wait_for_incoming_connection():
+                    continue
                 connection_socket = self._server_socket.get_client_connection()
-                if connection_socket:
-                    self._setup_connection(connection_socket)
+                if connection_socket and \
+                        self._try_to_set_up_connection(connection_socket):
                     self._wait_for_client = False
 
-    def _setup_connection(self, socket):
-        with self._lock:
-            super(ClientConnector, self)._setup_connection(socket)
-
-    @property
-    def connection(self):
-        with self._lock:
-            return self._connection
-
     def disconnect(self):
         self._stop_waiting_for_client()
 
@@ -67,6 +120,7 @@ class ClientConnector(ConnectionHolder):
         if self._server_socket:
             self._server_socket.close()
             self._server_socket = None
+        self._wakeup.close()
 
 
 class SingleThreadedClientConnector(ClientConnector):
@@ -78,16 +132,76 @@ class SingleThreadedClientConnector(ClientConnector):
     def _stop_waiting_for_client(self):
         self._wait_for_client = False
 
+    def _wait_for_incoming_connection(self):
+        return True
+
     def set_waiting_for_connection(self, waiting):
         self._wait_for_client = waiting
 
 
 class ServerConnector(ConnectionHolder):
+    """ Connects to the server in the background, retrying with exponential
+        backoff until a connection is established or disconnect is called """
+
+    def __init__(
+        self,
+        socket_factory,
+        connection_factory=Connection,
+        first_retry_delay=FIRST_RETRY_DELAY,
+        max_retry_delay=MAX_RETRY_DELAY,
+    ):
+        super(ServerConnector, self).__init__(connection_factory)
+        self._socket_factory = socket_factory
+        self._first_retry_delay = first_retry_delay
+        self._max_retry_delay = max_retry_delay
+        self._stop_connecting = Event()
+
+        self._start_connecting()
+
+    @property
+    def is_waiting_for_connection(self):
+        return self._wait_for_server
+
+    def _start_connecting(self):
+        self._wait_for_server = True
+        self._thread = Thread(target=self._connect_to_server)
+        self._thread.start()
+
+    def _stop_waiting_for_server(self):
+        self._stop_connecting.set()
+        self._thread.join()
+        self._wait_for_server = False
+
+    def _connect_to_server(self):
+        delay = self._first_retry_delay
+        while not self._try_to_connect():
+            self._status_messages.append(
+                'Server not reachable, retrying in %.2gs' % delay
+            )
+            if self._stop_connecting.wait(delay):
+                break
+            delay = min(2 * delay, self._max_retry_delay)
+
+    def _try_to_connect(self):
+        connection_socket = self._socket_factory()
+        if connection_socket is None or \
+                not self._try_to_set_up_connection(connection_socket):
+            return False
+        self._status_messages.append('Connected to server')
+        self._wait_for_server = False
+        return True
+
+    def disconnect(self):
+        self._stop_waiting_for_server()
+
+        super(ServerConnector, self).disconnect()
+
+
+class SingleThreadedServerConnector(ServerConnector):
 
-    def __init__(self, socket_factory):
-        super(ServerConnector, self).__init__()
-        self._check_for_connection_to_server(socket_factory)
+    def _start_connecting(self):
+        self._wait_for_server = True
+        self._try_to_connect()
 
-    def _check_for_connection_to_server(self, socket_factory):
-        connection_socket = socket_factory()
-        self._setup_connection(connection_socket)
+    def _stop_waiting_for_server(self):
+        self._wait_for_server = False
@@ -0,0 +1,200 @@
+from collections import OrderedDict, deque, namedtuple
+from timeit import default_timer
+
+from connection import MAX_CONTENTS_PER_FLUSH
+from protocol import MESSAGE_LENGTH
+
+
+# Seconds between the Editor's pings
+PING_INTERVAL = 1.
+# Pings still waiting for their pong; older ones are given up
+MAX_PENDING_PINGS = 8
+# Weight of a new round trip time in the moving average, as for TCP
+ROUND_TRIP_TIME_WEIGHT = .125
+# Less data received by the peer between two pongs tells how little was
+# sent rather than how much the link carries
+MIN_THROUGHPUT_SAMPLE_SIZE = 64 * 1024
+# The throughput is the highest of this many latest samples
+THROUGHPUT_SAMPLES = 8
+# Sending more contents per flush has to raise the throughput by this
+# factor, otherwise the link is taken as the limit
+PROBE_GAIN = 1.25
+
+# Each flush sends about what the link carries in a default timer interval,
+# so control and cursor messages don't wait much longer behind contents
+FLUSH_DURATION = .2
+MIN_CONTENTS_PER_FLUSH = 64 * 1024
+MAX_TUNED_CONTENTS_PER_FLUSH = 4 * 1024 * 1024
+# Larger parts take less time per byte to send and decode
+PARTS_PER_FLUSH = 64
+MAX_PART_SIZE = 64 * 1024
+# Compression levels for links slower than the given bytes per second
+COMPRESSION_LEVELS = (
+    (256 * 1024, 9),
+    (4 * 1024 * 1024, 6),
+    (32 * 1024 * 1024, 1),
+)
+# On slower links, contents are held back for about a round trip time, so
+# that updates in quick succession are sent together
+COALESCING_THROUGHPUT = 1024 * 1024
+MIN_COALESCING_WINDOW = .02
+MAX_COALESCING_WINDOW = .1
+
+
+LinkSettings = namedtuple('LinkSettings', (
+    'part_size',
+    'contents_per_flush',
+    'compression_level',
+    'coalescing_window',
+))
+DEFAULT_SETTINGS = LinkSettings(MESSAGE_LENGTH, MAX_CONTENTS_PER_FLUSH, 0, 0.)
+
+
+def _clamp(value, lowest, highest):
+    return min(max(value, lowest), highest)
+
+
+def tune(round_trip_time, throughput):
+    ''' returns the LinkSettings for a link's round trip time (in seconds)
+        and throughput (in bytes per second); as long as the throughput
+        hasn't been measured, the defaults '''
+    if throughput is None:
+        return DEFAULT_SETTINGS
+    contents_per_flush = int(_clamp(
+        throughput * FLUSH_DURATION,
+        MIN_CONTENTS_PER_FLUSH,
+        MAX_TUNED_CONTENTS_PER_FLUSH,
+    ))
+    compression_level = next(
+        (level for limit, level in COMPRESSION_LEVELS if throughput < limit), 0)
+    coalescing_window = 0. if throughput >= COALESCING_THROUGHPUT else _clamp(
+        round_trip_time or 0., MIN_COALESCING_WINDOW, MAX_COALESCING_WINDOW)
+    return LinkSettings(
+        part_size=_part_size(contents_per_flush),
+        contents_per_flush=contents_per_flush,
+        compression_level=compression_level,
+        coalescing_window=coalescing_window,
+    )
+
+
+def _part_size(contents_per_flush):
+    return _clamp(contents_per_flush // PARTS_PER_FLUSH, MESSAGE_LENGTH, MAX_PART_SIZE)
+
+
+def probe(contents_per_flush):
+    ''' returns the LinkSettings for trying whether the link carries
+        contents_per_flush per flush; as the throughput is only known not
+        to be any lower, nothing is compressed or coalesced '''
+    return LinkSettings(
+        part_size=_part_size(contents_per_flush),
+        contents_per_flush=contents_per_flush,
+        compression_level=0,
+        coalescing_window=0.,
+    )
+
+
+class LinkMonitor(object):
+    """ Estimates the link to the other participant from the pongs answering
+        our pings: the round trip time as a moving average, and the
+        throughput from the data the other side has received in between.
+
+        The data received only tells the throughput while contents have been
+        waiting to be sent all the time, see contents_flushed. Even then, the
+        limit may have been the contents sent per flush, so these are
+        doubled as long as that raises the throughput, and again whenever
+        the contents sent have been received without a backlog. Once the
+        link is the limit, the settings are tuned to its throughput. """
+
+    def __init__(self, timer=default_timer):
+        self._timer = timer
+        self.reset()
+
+    def reset(self):
+        self._next_ping_id = 0
+        self._pending_pings = OrderedDict()
+        self._last_ping = None
+        # Time and bytes received by the other side as of the last pong
+        self._last_pong = None
+        self._throughput_samples = deque(maxlen=THROUGHPUT_SAMPLES)
+        # Whether contents were left queued by every flush since the last
+        # pong, None without any flush
+        self._backlogged = None
+        self.is_probing = False
+        self._probed_contents_per_flush = None
+        self.round_trip_time = None
+        self.settings = DEFAULT_SETTINGS
+
+    @property
+    def throughput(self):
+        return max(self._throughput_samples) if self._throughput_samples else None
+
+    @property
+    def ping_due(self):
+        return self._last_ping is None or self._timer() - self._last_ping >= PING_INTERVAL
+
+    def next_ping(self):
+        ''' returns the id of a new ping '''
+        ping_id = self._next_ping_id
+        self._next_ping_id += 1
+        self._last_ping = self._timer()
+        self._pending_pings[ping_id] = self._last_ping
+        while len(self._pending_pings) > MAX_PENDING_PINGS:
+            self._pending_pings.popitem(last=False)
+        return ping_id
+
+    def contents_flushed(self, backlogged):
+        ''' to be called after each flush, telling whether contents are
+            still waiting to be sent '''
+        self._backlogged = backlogged and self._backlogged is not False
+
+    def pong_received(self, ping_id, bytes_received):
+        sent = self._pending_pings.pop(ping_id, None)
+        if sent is None:
+            # Given up, or answered by another Observer of a relay already
+            return
+        now = self._timer()
+        round_trip_time = now - sent
+        self.round_trip_time = round_trip_time if self.round_trip_time is None \
+            else self.round_trip_time + ROUND_TRIP_TIME_WEIGHT * (
+                round_trip_time - self.round_trip_time)
+        if self._last_pong is not None:
+            last_time, last_bytes_received = self._last_pong
+            size = bytes_received - last_bytes_received
+            if size >= MIN_THROUGHPUT_SAMPLE_SIZE and now > last_time:
+                self._estimate(size / (now - last_time))
+        self._last_pong = (now, bytes_received)
+        self._backlogged = None
+        self.settings = probe(self._probed_contents_per_flush) if self.is_probing \
+            else tune(self.round_trip_time, self.throughput)
+
+    def _estimate(self, rate):
+        if self._backlogged:
+            best = self.throughput
+            self._throughput_samples.append(rate)
+            if best is not None and rate < PROBE_GAIN * best:
+                # Sending more didn't get more across
+                self.is_probing = False
+                return
+        # Either more was sent than before, or the link carried everything
+        # there was to send, so it may carry more
+        self._probed_contents_per_flush = min(
+            2 * self.settings.contents_per_flush, MAX_TUNED_CONTENTS_PER_FLUSH)
+        self.is_probing = True
+
+    def describe(self):
+        ''' returns the estimates and settings as a status message '''
+        settings = self.settings
+        return '%s, %s; %d bytes per part, %d bytes per flush, %s, %s' % (
+            'round trip time not measured yet' if self.round_trip_time is None
+                else 'round trip time %.1f ms' % (1000 * self.round_trip_time),
+            'throughput not measured yet' if self.throughput is None
+                else 'throughput %s%.1f MB/s' % (
+                    'at least ' if self.is_probing else '',
+                    self.throughput / (1024. * 1024.)),
+            settings.part_size,
+            settings.contents_per_flush,
+            'compression level %d' % settings.compression_level
+                if settings.compression_level else 'no compression',
+            'coalescing for %d ms' % (1000 * settings.coalescing_window)
+                if settings.coalescing_window else 'no coalescing',
+        )
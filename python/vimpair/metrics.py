@@ -0,0 +1,179 @@
+from json import dumps
+from os import path
+from time import time
+from timeit import default_timer
+
+from protocol import (
+    COMPRESSED_START_PREFIX,
+    DELTA_PREFIX,
+    FULL_UPDATE_PREFIX,
+    INSERT_TEXT_PREFIX,
+    LINES_DELTA_PREFIX,
+    UPDATE_END_PREFIX,
+    UPDATE_PART_PREFIX,
+    UPDATE_START_PREFIX,
+    VISIBLE_LINES_PREFIX,
+)
+from vim_interface import show_status_message
+
+
+# Seconds between the lines appended to the metrics file
+DEFAULT_METRICS_INTERVAL = 60.
+# Upper bounds (in Milliseconds) of the buckets of the time histograms
+HISTOGRAM_BOUNDS = (.1, .3, 1., 3., 10., 30., 100., 300.)
+
+FULL_UPDATE_TYPES = (FULL_UPDATE_PREFIX, UPDATE_START_PREFIX, COMPRESSED_START_PREFIX)
+# Full updates of several parts start with one of these
+UPDATE_START_TYPES = (UPDATE_START_PREFIX, COMPRESSED_START_PREFIX)
+PARTIAL_UPDATE_TYPES = (
+    LINES_DELTA_PREFIX,
+    INSERT_TEXT_PREFIX,
+    DELTA_PREFIX,
+    VISIBLE_LINES_PREFIX,
+)
+
+
+def _message_type(message):
+    end = message.find(b'|')
+    return (message if end < 0 else message[:end]).decode('ascii', 'replace')
+
+
+class Histogram(object):
+
+    def __init__(self):
+        self.buckets = [0] * (len(HISTOGRAM_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+    def record(self, duration):
+        milliseconds = duration * 1000.
+        self.count += 1
+        self.total += milliseconds
+        self.max = max(self.max, milliseconds)
+        for index, bound in enumerate(HISTOGRAM_BOUNDS):
+            if milliseconds <= bound:
+                self.buckets[index] += 1
+                return
+        self.buckets[-1] += 1
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'total_ms': round(self.total, 3),
+            'max_ms': round(self.max, 3),
+            'buckets_ms': dict(zip(
+                ['%g' % bound for bound in HISTOGRAM_BOUNDS] + ['inf'],
+                self.buckets,
+            )),
+        }
+
+
+class Metrics(object):
+    """ Counts what a Connection sends and a MessageHandler receives and
+        periodically appends the numbers as a JSON line to a file; the
+        counters start over with each line """
+
+    def __init__(self, file_path, interval=DEFAULT_METRICS_INTERVAL,
+                 timer=default_timer, clock=time):
+        self.file_path = path.expanduser(file_path)
+        self.interval = interval
+        self._timer = timer
+        self._clock = clock
+        # Size of the parts sent so far of an update sent in several parts
+        self._full_update_size = None
+        self.reset()
+
+    def reset(self):
+        self.sent = {}
+        self.received = {}
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.messages_discarded = 0
+        self.bytes_discarded = 0
+        self.full_updates_sent = 0
+        self.partial_updates_sent = 0
+        self.largest_message_sent = 0
+        self.largest_full_update_sent = 0
+        self.send_time = Histogram()
+        self.process_time = Histogram()
+        self._interval_start = self._timer()
+
+    def message_sent(self, message, duration):
+        message_type = _message_type(message)
+        self.sent[message_type] = self.sent.get(message_type, 0) + 1
+        size = len(message)
+        self.bytes_sent += size
+        self.largest_message_sent = max(self.largest_message_sent, size)
+        if message_type in FULL_UPDATE_TYPES:
+            self.full_updates_sent += 1
+        elif message_type in PARTIAL_UPDATE_TYPES:
+            self.partial_updates_sent += 1
+        self._full_update_part_sent(message_type, size)
+        self.send_time.record(duration)
+
+    def _full_update_part_sent(self, message_type, size):
+        if message_type in UPDATE_START_TYPES:
+            self._full_update_size = size
+            return
+        if message_type in (UPDATE_PART_PREFIX, UPDATE_END_PREFIX):
+            if self._full_update_size is None:
+                return
+            self._full_update_size += size
+            if message_type == UPDATE_PART_PREFIX:
+                return
+            size = self._full_update_size
+        elif message_type != FULL_UPDATE_PREFIX:
+            return
+        self.largest_full_update_sent = max(self.largest_full_update_sent, size)
+        self._full_update_size = None
+
+    def message_received(self, message_type):
+        self.received[message_type] = self.received.get(message_type, 0) + 1
+
+    def data_processed(self, size, duration):
+        self.bytes_received += size
+        self.process_time.record(duration)
+
+    def message_discarded(self):
+        self.messages_discarded += 1
+
+    def data_discarded(self, size):
+        self.bytes_discarded += size
+
+    def as_dict(self):
+        duration = max(self._timer() - self._interval_start, 1e-9)
+        per_second = lambda counts: dict(
+            (message_type, round(count / duration, 3))
+            for message_type, count in counts.items()
+        )
+        return {
+            'time': round(self._clock(), 3),
+            'interval_s': round(duration, 3),
+            'sent': self.sent,
+            'sent_per_second': per_second(self.sent),
+            'received': self.received,
+            'received_per_second': per_second(self.received),
+            'bytes_sent': self.bytes_sent,
+            'bytes_received': self.bytes_received,
+            'messages_discarded': self.messages_discarded,
+            'bytes_discarded': self.bytes_discarded,
+            'full_updates_sent': self.full_updates_sent,
+            'partial_updates_sent': self.partial_updates_sent,
+            'largest_message_sent': self.largest_message_sent,
+            'largest_full_update_sent': self.largest_full_update_sent,
+            'send_time': self.send_time.as_dict(),
+            'process_time': self.process_time.as_dict(),
+        }
+
+    def write(self):
+        try:
+            with open(self.file_path, 'a') as metrics_file:
+                metrics_file.write(dumps(self.as_dict(), sort_keys=True) + '\n')
+        except EnvironmentError as e:
+            show_status_message('Could not write metrics: %s' % e)
+        self.reset()
+
+    def write_if_due(self):
+        if self._timer() - self._interval_start >= self.interval:
+            self.write()
@@ -0,0 +1,152 @@
+from cProfile import Profile
+from functools import wraps
+from os import path
+from pstats import Stats
+from tempfile import gettempdir
+from timeit import default_timer
+
+
+DEFAULT_REPORT_PATH = path.join(gettempdir(), 'vimpair-profile.txt')
+# Functions listed from the cProfile statistics, by cumulative time
+PROFILE_STATS_LIMIT = 40
+
+
+class EntryPointStats(object):
+
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.
+        self.max = 0.
+
+    def record(self, duration):
+        self.calls += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+
+
+class Profiler(object):
+    """ Collects the wall-clock time spent in Vimpair's entry points, i.e.
+        the time Vim's UI waits for Vimpair; a cProfile run of everything
+        called meanwhile can be added for the details """
+
+    def __init__(self, timer=default_timer):
+        self.timer = timer
+        self._profile = None
+        self.is_running = False
+        self.clear()
+
+    def clear(self):
+        self.entry_points = {}
+        self._start = None
+        self._duration = 0.
+        self._profile_stats = None
+
+    def start(self, with_cprofile=False):
+        if self.is_running:
+            return
+        self.clear()
+        self.is_running = True
+        if with_cprofile:
+            self._profile = Profile()
+            self._profile.enable()
+        self._start = self.timer()
+
+    def stop(self):
+        if not self.is_running:
+            return
+        self._duration = self.timer() - self._start
+        self.is_running = False
+        if self._profile is not None:
+            self._profile.disable()
+            self._profile_stats = self._profile
+            self._profile = None
+
+    @property
+    def duration(self):
+        return self.timer() - self._start if self.is_running else self._duration
+
+    def record(self, name, duration):
+        stats = self.entry_points.get(name)
+        if stats is None:
+            stats = self.entry_points[name] = EntryPointStats()
+        stats.record(duration)
+
+    def report(self):
+        ''' returns the collected times as a text table, followed by the
+            cProfile statistics if there are any '''
+        duration = self.duration
+        lines = [
+            'Vimpair profile of %.1f s%s' % (
+                duration,
+                ' (still running)' if self.is_running else ''),
+            '',
+            '%-24s %8s %10s %9s %9s %7s' % (
+                'entry point', 'calls', 'total ms', 'mean ms', 'max ms', 'share'),
+        ]
+        by_total = sorted(
+            self.entry_points.items(),
+            key=lambda item: item[1].total,
+            reverse=True,
+        )
+        for name, stats in by_total:
+            lines.append('%-24s %8d %10.2f %9.3f %9.3f %6.1f%%' % (
+                name,
+                stats.calls,
+                stats.total * 1000.,
+                stats.total * 1000. / stats.calls,
+                stats.max * 1000.,
+                100. * stats.total / duration if duration else 0.,
+            ))
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, file_path=None):
+        ''' writes the report to the file, returns the file's path '''
+        file_path = file_path or DEFAULT_REPORT_PATH
+        with open(file_path, 'w') as report_file:
+            report_file.write(self.report())
+            if self._profile_stats is not None:
+                report_file.write('\n')
+                stats = Stats(self._profile_stats, stream=report_file)
+                stats.sort_stats('cumulative').print_stats(PROFILE_STATS_LIMIT)
+        return file_path
+
+
+profiler = Profiler()
+
+
+def profiled(name):
+    ''' records the time spent in the decorated function while the
+        profiler is running; otherwise, just a flag is checked per call '''
+    def decorate(function):
+        @wraps(function)
+        def profiled_function(*args, **kwargs):
+            if not profiler.is_running:
+                return function(*args, **kwargs)
+            start = profiler.timer()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                profiler.record(name, profiler.timer() - start)
+        return profiled_function
+    return decorate
+
+
+def profiled_steps(name):
+    ''' like profiled, for functions returning a generator: records the
+        time spent in each of its steps, as Vim waits for one at a time '''
+    def decorate(function):
+        @wraps(function)
+        def profiled_function(*args, **kwargs):
+            steps = function(*args, **kwargs)
+            while True:
+                start = profiler.timer() if profiler.is_running else None
+                try:
+                    next(steps)
+                except StopIteration:
+                    return
+                finally:
+                    if start is not None:
+                        profiler.record(name, profiler.timer() - start)
+                yield
+        return profiled_function
+    return decorate
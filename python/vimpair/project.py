@@ -0,0 +1,101 @@
+from base64 import b64encode
+from fnmatch import fnmatch
+from io import BytesIO
+from os import path, walk
+import tarfile
+
+
+DEFAULT_IGNORE_PATTERNS = (
+    '.git',
+    '.hg',
+    '.svn',
+    '__pycache__',
+    'node_modules',
+    '*.pyc',
+    '*.swp',
+    '*.o',
+)
+MAX_FILE_SIZE = 1024 * 1024
+# The archive is kept in memory until it has been sent, so only files up to
+# this size in total are added
+MAX_PROJECT_SIZE = 32 * 1024 * 1024
+
+
+def read_ignore_patterns(root):
+    ''' returns the simple patterns of the project's .gitignore '''
+    try:
+        with open(path.join(root, '.gitignore')) as ignore_file:
+            lines = ignore_file.read().splitlines()
+    except EnvironmentError:
+        return []
+    return [
+        line.strip().strip('/')
+        for line in lines
+        if line.strip() and not line.startswith(('#', '!'))
+    ]
+
+
+def _is_ignored(relative_path, name, ignore_patterns):
+    return any(
+        fnmatch(name, pattern) or fnmatch(relative_path, pattern)
+        for pattern in ignore_patterns
+    )
+
+
+def project_files(root, ignore_patterns=DEFAULT_IGNORE_PATTERNS):
+    ''' yields tuples (folderpath, filename) of the project's files '''
+    for folder, folders, filenames in walk(root):
+        relative_folder = path.relpath(folder, root)
+        folders[:] = [
+            name for name in sorted(folders)
+            if not _is_ignored(
+                path.normpath(path.join(relative_folder, name)),
+                name,
+                ignore_patterns,
+            )
+        ]
+        for name in sorted(filenames):
+            file_path = path.join(folder, name)
+            if not _is_ignored(
+                path.normpath(path.join(relative_folder, name)),
+                name,
+                ignore_patterns,
+            ) and path.isfile(file_path) and path.getsize(file_path) <= MAX_FILE_SIZE:
+                yield folder, name
+
+
+def create_project_archive(root, archive_name, ignore_patterns=DEFAULT_IGNORE_PATTERNS,
+                           max_size=MAX_PROJECT_SIZE):
+    ''' returns the project's files as gzip-compressed tar archive, encoded
+        as base64; archive_name(filename, folderpath) gives the name of a
+        file in the archive. Files that would exceed max_size bytes in total
+        are left out. '''
+    archive_data = BytesIO()
+    archive = tarfile.open(fileobj=archive_data, mode='w:gz')
+    size = 0
+    try:
+        for folder, name in project_files(root, ignore_patterns):
+            file_path = path.join(folder, name)
+            file_size = path.getsize(file_path)
+            if size + file_size > max_size:
+                continue
+            size += file_size
+            archive.add(file_path, arcname=archive_name(name, folder))
+    finally:
+        archive.close()
+    return b64encode(archive_data.getvalue()).decode('ascii')
+
+
+def extract_project_archive(archive_path, destination):
+    ''' extracts the archive's regular files into destination; files that
+        would end up outside of it are skipped '''
+    archive = tarfile.open(archive_path, mode='r:gz')
+    try:
+        for member in archive.getmembers():
+            name = path.normpath(member.name.lstrip('/'))
+            if not member.isfile() or name.startswith('..'):
+                continue
+            member.name = name
+            archive.extract(member, destination)
+    finally:
+        archive.close()
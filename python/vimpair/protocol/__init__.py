@@ -3,19 +3,82 @@ from .constants import (
     UPDATE_START_PREFIX,
     UPDATE_PART_PREFIX,
     UPDATE_END_PREFIX,
+    COMPRESSED_START_PREFIX,
     CURSOR_POSITION_PREFIX,
+    VISIBLE_LINES_PREFIX,
     TAKE_CONTROL_MESSAGE,
     FILE_CHANGE_PREFIX,
+    FILE_REGISTER_PREFIX,
+    FILE_SWITCH_PREFIX,
     SAVE_FILE_MESSAGE,
+    HASH_TREE_PREFIX,
+    HASH_REQUEST_PREFIX,
+    HASH_NODES_PREFIX,
+    BLOCK_REQUEST_PREFIX,
+    SIGNATURES_PREFIX,
+    DELTA_PREFIX,
+    PROJECT_PART_PREFIX,
+    PROJECT_END_MESSAGE,
+    PROJECT_EXTRACTED_MESSAGE,
+    CONTENTS_VERSION_PREFIX,
+    LINES_DELTA_PREFIX,
+    SYNC_STATE_PREFIX,
+    RESYNC_REQUEST_MESSAGE,
+    INSERT_TEXT_PREFIX,
+    JOIN_SESSION_PREFIX,
+    PEER_JOINED_MESSAGE,
+    LIMITS_PREFIX,
+    SEQUENCE_PREFIX,
+    PING_PREFIX,
+    PONG_PREFIX,
     MESSAGE_LENGTH,
 )
 
 from .generate_messages import (
+    MIN_MESSAGE_LENGTH,
     generate_contents_update_messages,
+    generate_contents_version_message,
     generate_cursor_position_message,
+    generate_delta_message,
     generate_file_change_message,
+    generate_file_register_message,
+    generate_file_switch_message,
+    generate_block_request_message,
+    generate_hash_nodes_message,
+    generate_hash_request_message,
+    generate_hash_tree_message,
+    generate_inserted_text_message,
+    generate_join_session_message,
+    generate_lines_delta_message,
+    generate_limits_message,
+    generate_peer_joined_message,
+    generate_ping_message,
+    generate_pong_message,
+    generate_project_extracted_message,
+    generate_project_messages,
+    generate_resync_request_message,
     generate_save_file_message,
+    generate_sequence_message,
+    generate_signatures_message,
+    generate_sync_state_message,
     generate_take_control_message,
+    generate_visible_lines_message,
 )
 
-from .handle_messages import MessageHandler
+from .delta import (
+    apply_delta,
+    block_signatures,
+    compute_delta,
+    compute_line_delta,
+    contents_hash,
+    signature_block_size,
+    signatures_checksum,
+)
+from .file_table import FileTable
+from .hash_tree import HashTree
+from .handle_messages import (
+    MAX_MESSAGE_SIZE,
+    MessageHandler,
+    parse_join_session_message,
+    split_complete_messages,
+)
@@ -2,9 +2,33 @@ FULL_UPDATE_PREFIX = 'VIMPAIR_FULL_UPDATE'
 UPDATE_START_PREFIX = 'VIMPAIR_CONTENTS_START'
 UPDATE_PART_PREFIX = 'VIMPAIR_CONTENTS_PART'
 UPDATE_END_PREFIX = 'VIMPAIR_CONTENTS_END'
+COMPRESSED_START_PREFIX = 'VIMPAIR_COMPRESSED_START'
 CURSOR_POSITION_PREFIX = 'VIMPAIR_CURSOR_POSITION'
+VISIBLE_LINES_PREFIX = 'VIMPAIR_VISIBLE_LINES'
 TAKE_CONTROL_MESSAGE = 'VIMPAIR_TAKE_CONTROL'
 FILE_CHANGE_PREFIX = 'VIMPAIR_FILE_CHANGE'
+FILE_REGISTER_PREFIX = 'VIMPAIR_FILE_REGISTER'
+FILE_SWITCH_PREFIX = 'VIMPAIR_FILE_SWITCH'
 SAVE_FILE_MESSAGE = 'VIMPAIR_SAVE_FILE'
+HASH_TREE_PREFIX = 'VIMPAIR_HASH_TREE'
+HASH_REQUEST_PREFIX = 'VIMPAIR_HASH_REQUEST'
+HASH_NODES_PREFIX = 'VIMPAIR_HASH_NODES'
+BLOCK_REQUEST_PREFIX = 'VIMPAIR_BLOCK_REQUEST'
+SIGNATURES_PREFIX = 'VIMPAIR_SIGNATURES'
+DELTA_PREFIX = 'VIMPAIR_DELTA'
+PROJECT_PART_PREFIX = 'VIMPAIR_PROJECT_PART'
+PROJECT_END_MESSAGE = 'VIMPAIR_PROJECT_END'
+PROJECT_EXTRACTED_MESSAGE = 'VIMPAIR_PROJECT_EXTRACTED'
+CONTENTS_VERSION_PREFIX = 'VIMPAIR_CONTENTS_VERSION'
+LINES_DELTA_PREFIX = 'VIMPAIR_LINES_DELTA'
+SYNC_STATE_PREFIX = 'VIMPAIR_SYNC_STATE'
+RESYNC_REQUEST_MESSAGE = 'VIMPAIR_RESYNC_REQUEST'
+INSERT_TEXT_PREFIX = 'VIMPAIR_INSERT_TEXT'
+JOIN_SESSION_PREFIX = 'VIMPAIR_JOIN_SESSION'
+PEER_JOINED_MESSAGE = 'VIMPAIR_PEER_JOINED'
+LIMITS_PREFIX = 'VIMPAIR_LIMITS'
+SEQUENCE_PREFIX = 'VIMPAIR_SEQUENCE'
+PING_PREFIX = 'VIMPAIR_PING'
+PONG_PREFIX = 'VIMPAIR_PONG'
 
 MESSAGE_LENGTH = 1024
@@ -0,0 +1,181 @@
+from hashlib import sha1
+from operator import mul
+from zlib import crc32
+import re
+
+
+MIN_BLOCK_SIZE = 256 # characters
+SIGNATURE_LENGTH = 16 # hex digits, weak checksum followed by strong hash
+# Contents none of whose first blocks match are probably unrelated to the
+# signed ones, looking further would mostly take time
+MAX_LEADING_UNMATCHED_BLOCKS = 16
+_MODULUS = 1 << 16
+
+_INSTRUCTION = re.compile(r'([BL])(\d+)(?:,(\d+))?\|')
+
+
+def signature_block_size(contents_length):
+    ''' returns the block size for contents of the given length; like rsync,
+        blocks grow with the square root of the length '''
+    return max(MIN_BLOCK_SIZE, int(contents_length ** .5))
+
+
+def _weak_checksum_parts(block):
+    ords = [ord(character) for character in block]
+    a = sum(ords) % _MODULUS
+    b = sum(map(mul, ords, range(len(ords), 0, -1))) % _MODULUS
+    return a, b
+
+
+def _strong_hash(block):
+    return sha1(block.encode('utf-8')).hexdigest()[:8]
+
+
+def _signature(a, b, block):
+    return '%08x%s' % ((b << 16) | a, _strong_hash(block))
+
+
+def block_signatures(contents, block_size):
+    ''' returns the signatures of all complete blocks of contents '''
+    return [
+        _signature(*(_weak_checksum_parts(block) + (block,)))
+        for block in (
+            contents[start:start + block_size]
+            for start in range(0, len(contents) - block_size + 1, block_size)
+        )
+    ]
+
+
+def signatures_checksum(signatures):
+    ''' identifies the signatures a delta was computed against '''
+    return crc32(''.join(signatures).encode('ascii')) & 0xffffffff
+
+
+def contents_hash(lines):
+    return sha1('\n'.join(lines).encode('utf-8')).hexdigest()
+
+
+def compute_line_delta(old_lines, new_lines):
+    ''' returns a tuple (first_line, number_of_removed_lines, added_lines)
+        turning old_lines into new_lines '''
+    first_line = 0
+    common_length = min(len(old_lines), len(new_lines))
+    while first_line < common_length and \
+            old_lines[first_line] == new_lines[first_line]:
+        first_line += 1
+    old_end, new_end = len(old_lines), len(new_lines)
+    while old_end > first_line and new_end > first_line and \
+            old_lines[old_end - 1] == new_lines[new_end - 1]:
+        old_end -= 1
+        new_end -= 1
+    return first_line, old_end - first_line, new_lines[first_line:new_end]
+
+
+def split_signatures(contents):
+    return [
+        contents[start:start + SIGNATURE_LENGTH]
+        for start in range(0, len(contents), SIGNATURE_LENGTH)
+    ]
+
+
+class _DeltaBuilder(object):
+
+    def __init__(self):
+        self.parts = []
+        self.size = 0
+        self._blocks = None # first and count of the pending block reference
+
+    def add_literal(self, literal):
+        if literal:
+            self._add_blocks()
+            self._add('L%d|%s' % (len(literal), literal))
+
+    def add_block(self, index):
+        if self._blocks and sum(self._blocks) == index:
+            self._blocks[1] += 1
+        else:
+            self._add_blocks()
+            self._blocks = [index, 1]
+
+    def finish(self):
+        self._add_blocks()
+        return ''.join(self.parts)
+
+    def _add_blocks(self):
+        if self._blocks:
+            self._add('B%d,%d|' % tuple(self._blocks))
+            self._blocks = None
+
+    def _add(self, part):
+        self.parts.append(part)
+        self.size += len(part)
+
+
+def compute_delta(contents, block_size, signatures, max_size=None):
+    ''' returns instructions to rebuild contents from the blocks with the
+        given signatures plus literal text, or None if they'd get larger
+        than max_size; also None without signatures, or if none of the
+        first blocks of contents match '''
+    if not signatures:
+        return None
+    weak_to_blocks = {}
+    for index, signature in enumerate(signatures):
+        weak_to_blocks.setdefault(int(signature[:8], 16), []).append(
+            (signature[8:], index)
+        )
+
+    delta = _DeltaBuilder()
+    literal_start = position = 0
+    a = b = None
+    while position + block_size <= len(contents):
+        if a is None:
+            a, b = _weak_checksum_parts(contents[position:position + block_size])
+        index = None
+        candidates = weak_to_blocks.get((b << 16) | a)
+        if candidates:
+            strong_hash = _strong_hash(contents[position:position + block_size])
+            index = next((i for h, i in candidates if h == strong_hash), None)
+        if index is not None:
+            delta.add_literal(contents[literal_start:position])
+            delta.add_block(index)
+            position += block_size
+            literal_start = position
+            a = b = None
+        else:
+            if position + block_size < len(contents):
+                # Rolling the checksum forward by one character
+                removed = ord(contents[position])
+                added = ord(contents[position + block_size])
+                a = (a - removed + added) % _MODULUS
+                b = (b - block_size * removed + a) % _MODULUS
+            position += 1
+            if max_size is not None and \
+                    delta.size + position - literal_start > max_size:
+                return None
+            if literal_start == 0 and \
+                    position > MAX_LEADING_UNMATCHED_BLOCKS * block_size:
+                return None
+    delta.add_literal(contents[literal_start:])
+    if max_size is not None and delta.size > max_size:
+        return None
+    return delta.finish()
+
+
+def apply_delta(contents, block_size, delta):
+    ''' rebuilds the contents a delta was computed for, using the blocks
+        of the contents the signatures were computed from '''
+    parts = []
+    position = 0
+    while position < len(delta):
+        match = _INSTRUCTION.match(delta, position)
+        if match is None:
+            raise ValueError('Malformed delta at %d' % position)
+        kind, first, count = match.groups()
+        position = match.end()
+        if kind == 'B':
+            start = int(first) * block_size
+            parts.append(contents[start:start + int(count) * block_size])
+        else:
+            parts.append(delta[position:position + int(first)])
+            position += int(first)
+    return ''.join(parts)
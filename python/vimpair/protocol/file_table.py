@@ -0,0 +1,37 @@
+from hashlib import sha224
+from os import path
+
+
+class FileTable(object):
+    """ Assigns small numeric IDs to the files referenced during a session """
+
+    def __init__(self):
+        self._ids = {}
+        self._concealed_folders = {}
+
+    def _conceal(self, folderpath):
+        if folderpath not in self._concealed_folders:
+            self._concealed_folders[folderpath] = \
+                sha224(folderpath.encode('utf-8')).hexdigest()
+        return self._concealed_folders[folderpath]
+
+    def file_path(self, filename, folderpath=None, conceal_path=False):
+        ''' returns the path the Observer uses for the given file '''
+        file_path = (filename or '').strip()
+        if file_path and folderpath:
+            file_path = path.join(
+                self._conceal(folderpath) if conceal_path else folderpath,
+                file_path
+            )
+        return file_path
+
+    def lookup(self, filename, folderpath=None, conceal_path=False):
+        ''' returns a tuple (file_id, file_path) for the given file;
+            file_path is None if the file has been looked up before '''
+        key = (filename, folderpath, conceal_path)
+        if key in self._ids:
+            return self._ids[key], None
+
+        file_id = len(self._ids)
+        self._ids[key] = file_id
+        return file_id, self.file_path(filename, folderpath, conceal_path)
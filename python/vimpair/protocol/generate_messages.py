@@ -1,69 +1,148 @@
 from hashlib import sha224
 from os import path
+from zlib import compress
 
 from .constants import (
     FULL_UPDATE_PREFIX,
     UPDATE_START_PREFIX,
     UPDATE_PART_PREFIX,
     UPDATE_END_PREFIX,
+    COMPRESSED_START_PREFIX,
     CURSOR_POSITION_PREFIX,
+    VISIBLE_LINES_PREFIX,
     TAKE_CONTROL_MESSAGE,
     FILE_CHANGE_PREFIX,
+    FILE_REGISTER_PREFIX,
+    FILE_SWITCH_PREFIX,
     SAVE_FILE_MESSAGE,
+    HASH_TREE_PREFIX,
+    HASH_REQUEST_PREFIX,
+    HASH_NODES_PREFIX,
+    BLOCK_REQUEST_PREFIX,
+    SIGNATURES_PREFIX,
+    DELTA_PREFIX,
+    PROJECT_PART_PREFIX,
+    PROJECT_END_MESSAGE,
+    PROJECT_EXTRACTED_MESSAGE,
+    CONTENTS_VERSION_PREFIX,
+    LINES_DELTA_PREFIX,
+    SYNC_STATE_PREFIX,
+    RESYNC_REQUEST_MESSAGE,
+    INSERT_TEXT_PREFIX,
+    JOIN_SESSION_PREFIX,
+    PEER_JOINED_MESSAGE,
+    LIMITS_PREFIX,
+    SEQUENCE_PREFIX,
+    PING_PREFIX,
+    PONG_PREFIX,
     MESSAGE_LENGTH,
 )
 
 
-_LENGTH_DIGITS_AND_MARKERS = 3 + 2
 _NUM_MARKERS = 2
-_UPDATE_START_CONTENTS_LENGTH = \
-    MESSAGE_LENGTH - len(UPDATE_START_PREFIX) - _LENGTH_DIGITS_AND_MARKERS
-_UPDATE_PART_CONTENTS_LENGTH = \
-    MESSAGE_LENGTH - len(UPDATE_PART_PREFIX) - _LENGTH_DIGITS_AND_MARKERS
+# Shorter contents fit into a single message, compressed or not
+MIN_COMPRESSED_SIZE = MESSAGE_LENGTH
+# Contents updates are split into messages of at least this many bytes, so
+# that each part holds at least one byte of contents besides its header
+MIN_MESSAGE_LENGTH = max(
+    len(prefix) for prefix in (UPDATE_START_PREFIX, COMPRESSED_START_PREFIX, UPDATE_PART_PREFIX)
+) + _NUM_MARKERS + len('1') + 1
 
-def generate_contents_update_messages(contents):
 
-    contents_length = len(contents or '')
+def _encode(text):
+    return text if isinstance(text, bytes) else text.encode('utf-8')
+
+def _message(prefix, *numbers):
+    return '|'.join((prefix,) + tuple('%d' % number for number in numbers)).encode('ascii')
+
+def _message_with_contents(prefix, contents, *numbers):
+    ''' returns a message whose last field is the length of contents in bytes '''
+    contents = _encode(contents)
+    return b''.join((_message(prefix, *(numbers + (len(contents),))), b'|', contents))
+
+def _contents_length(message_length, prefix):
+    ''' returns how many bytes of contents a message of message_length
+        bytes with the given prefix holds '''
+    length = message_length - len(prefix) - _NUM_MARKERS
+    digits = len('%d' % length)
+    while len('%d' % (length - digits)) < digits:
+        digits -= 1
+    return length - digits
+
+def generate_contents_update_messages(contents, message_length=MESSAGE_LENGTH,
+                                      compression_level=0):
+    ''' splits the contents into parts of about message_length bytes; they
+        are encoded only once, so a part may end within a character, which
+        the receiver joins again. With a compression_level, larger contents
+        are compressed with zlib first. '''
+
+    message_length = max(MIN_MESSAGE_LENGTH, message_length)
+    data = _encode(contents or '')
+    compressed = compression_level > 0 and len(data) >= MIN_COMPRESSED_SIZE
+    if compressed:
+        data = compress(data, compression_level)
+    contents_length = len(data)
+    first_prefix = COMPRESSED_START_PREFIX if compressed else UPDATE_START_PREFIX
+    start_contents_length = _contents_length(message_length, first_prefix)
+    part_contents_length = _contents_length(message_length, UPDATE_PART_PREFIX)
 
     def get_number_of_parts(contents):
-        length_without_start = contents_length - _UPDATE_START_CONTENTS_LENGTH
-        return 1 \
-            + length_without_start // _UPDATE_PART_CONTENTS_LENGTH \
-            + int(0 < length_without_start % _UPDATE_PART_CONTENTS_LENGTH)
+        length_without_start = contents_length - start_contents_length
+        number_of_parts = 1 \
+            + length_without_start // part_contents_length \
+            + int(0 < length_without_start % part_contents_length)
+        # Compressed contents always end with an end part, even if empty
+        return max(2, number_of_parts) if compressed else number_of_parts
 
     def get_part_prefix(index, num_parts):
         if num_parts > 1:
-            prefixes = num_parts * [UPDATE_PART_PREFIX]
-            prefixes[0] = UPDATE_START_PREFIX
-            prefixes[-1] = UPDATE_END_PREFIX
-            return prefixes[index]
+            if index == 0:
+                return first_prefix
+            if index == num_parts - 1:
+                return UPDATE_END_PREFIX
+            return UPDATE_PART_PREFIX
         return FULL_UPDATE_PREFIX
 
     def get_part_size(contents_size, index, num_parts):
-        first_part_size = min(_UPDATE_START_CONTENTS_LENGTH, contents_size)
-        if num_parts > 1:
-            sizes = num_parts * [_UPDATE_PART_CONTENTS_LENGTH]
-            sizes[0] = first_part_size
-            sizes[-1] = (contents_size - _UPDATE_START_CONTENTS_LENGTH) \
-                    % _UPDATE_PART_CONTENTS_LENGTH
-            return sizes[index]
-        return first_part_size
+        # Computed directly, as a list of all sizes per part is quadratic
+        if index == 0:
+            return min(start_contents_length, contents_size)
+        if index == num_parts - 1:
+            return contents_size - min(start_contents_length, contents_size) \
+                    - (num_parts - 2) * part_contents_length
+        return part_contents_length
 
     messages = []
     if contents is not None:
-        num_parts = get_number_of_parts(contents)
+        num_parts = get_number_of_parts(data)
+        # Slicing off the remaining contents would be quadratic as well
+        offset = 0
         for index in range(0, num_parts):
             prefix = get_part_prefix(index, num_parts)
             part_size = get_part_size(contents_length, index, num_parts)
-            part_contents = contents[:part_size]
-            messages.append('%s|%d|%s' % (prefix, part_size, part_contents))
-            contents = contents[part_size:]
+            messages.append(b''.join((
+                _message(prefix, part_size),
+                b'|',
+                data[offset:offset + part_size],
+            )))
+            offset += part_size
     return messages
 
 def generate_cursor_position_message(line, column):
     line = max(0, line or 0)
-    column = max(0, column or 0)
-    return '%s|%d|%d' % (CURSOR_POSITION_PREFIX, line, column)
+    # The column is sent like contents, so its end can't be mistaken
+    column = '%d' % max(0, column or 0)
+    # Formatted directly, as it's the most frequent message
+    return ('%s|%d|%d|%s' % (
+        CURSOR_POSITION_PREFIX, line, len(column), column)).encode('ascii')
+
+def generate_visible_lines_message(first_line, number_of_lines, lines):
+    return _message_with_contents(
+        VISIBLE_LINES_PREFIX,
+        '\n'.join(lines or []),
+        max(0, first_line or 0),
+        max(0, number_of_lines or 0),
+    )
 
 def generate_file_change_message(filename, folderpath=None, conceal_path=False):
     contents = (filename or '').strip()
@@ -74,10 +153,105 @@ def generate_file_change_message(filename, folderpath=None, conceal_path=False):
                 else folderpath,
             contents
         )
-    return '%s|%d|%s' % (FILE_CHANGE_PREFIX, len(contents), contents)
+    return _message_with_contents(FILE_CHANGE_PREFIX, contents)
+
+def generate_file_register_message(file_id, file_path):
+    return _message_with_contents(FILE_REGISTER_PREFIX, file_path or '', file_id)
+
+def generate_file_switch_message(file_id):
+    # The ID is sent like contents, so its end can't be mistaken
+    return _message_with_contents(FILE_SWITCH_PREFIX, '%d' % file_id)
+
+def generate_hash_tree_message(number_of_lines, levels, root_hash):
+    return _message_with_contents(HASH_TREE_PREFIX, root_hash, number_of_lines, levels)
+
+def generate_hash_request_message(level, index):
+    # As the index comes last, it's sent like contents
+    return _message_with_contents(HASH_REQUEST_PREFIX, '%d' % index, level)
+
+def generate_hash_nodes_message(level, index, hashes):
+    return _message_with_contents(HASH_NODES_PREFIX, ''.join(hashes), level, index)
+
+def generate_block_request_message(index):
+    return _message_with_contents(BLOCK_REQUEST_PREFIX, '%d' % index)
+
+def generate_signatures_message(file_id, block_size, signatures):
+    return _message_with_contents(
+        SIGNATURES_PREFIX,
+        ''.join(signatures),
+        file_id,
+        block_size,
+    )
+
+def generate_delta_message(file_id, block_size, checksum, delta):
+    ''' the checksum is the one of the signatures the delta is based on '''
+    return _message_with_contents(DELTA_PREFIX, delta, file_id, block_size, checksum)
+
+def generate_project_messages(archive_data, part_size):
+    ''' splits the (base64 encoded) project archive into parts '''
+    data = _encode(archive_data)
+    messages = [
+        _message_with_contents(PROJECT_PART_PREFIX, data[start:start + part_size])
+        for start in range(0, len(data), part_size)
+    ]
+    return messages + [_message(PROJECT_END_MESSAGE)]
+
+def generate_project_extracted_message():
+    return _message(PROJECT_EXTRACTED_MESSAGE)
+
+def generate_contents_version_message(version):
+    # The version is sent like contents, so its end can't be mistaken
+    return _message_with_contents(CONTENTS_VERSION_PREFIX, '%d' % version)
+
+def generate_lines_delta_message(version, first_line, number_of_removed_lines, lines):
+    return _message_with_contents(
+        LINES_DELTA_PREFIX,
+        '\n'.join(lines),
+        version,
+        first_line,
+        number_of_removed_lines,
+        len(lines),
+    )
+
+def generate_sync_state_message(version, contents_hash):
+    return _message_with_contents(SYNC_STATE_PREFIX, contents_hash, version)
+
+def generate_inserted_text_message(version, line, column, text):
+    return _message_with_contents(INSERT_TEXT_PREFIX, text, version, line, column)
+
+def generate_join_session_message(session_id, is_host, secret=''):
+    ''' the relay lets a host take over a session only with its secret '''
+    session_id = _encode(session_id)
+    return _message_with_contents(
+        JOIN_SESSION_PREFIX,
+        session_id + _encode(secret),
+        int(is_host),
+        len(session_id),
+    )
+
+def generate_peer_joined_message():
+    return _message(PEER_JOINED_MESSAGE)
+
+def generate_limits_message(max_message_size):
+    # The size is sent like contents, so its end can't be mistaken
+    return _message_with_contents(LIMITS_PREFIX, '%d' % max_message_size)
+
+def generate_sequence_message(bulk_messages):
+    # The number is sent like contents, so its end can't be mistaken
+    return _message_with_contents(SEQUENCE_PREFIX, '%d' % bulk_messages)
+
+def generate_ping_message(ping_id):
+    # The id is sent like contents, so its end can't be mistaken
+    return _message_with_contents(PING_PREFIX, '%d' % ping_id)
+
+def generate_pong_message(ping_id, bytes_received):
+    return _message_with_contents(PONG_PREFIX, '%d' % ping_id, bytes_received)
+
+def generate_resync_request_message():
+    return _message(RESYNC_REQUEST_MESSAGE)
 
 def generate_save_file_message():
-    return SAVE_FILE_MESSAGE
+    return _message(SAVE_FILE_MESSAGE)
 
 def generate_take_control_message():
-    return TAKE_CONTROL_MESSAGE
+    return _message(TAKE_CONTROL_MESSAGE)
@@ -1,5 +1,6 @@
-from contextlib import contextmanager
-from functools import reduce
+from collections import deque
+from timeit import default_timer
+from zlib import decompressobj, error as CompressionError
 import re
 
 from .constants import (
@@ -7,177 +8,734 @@ from .constants import (
     UPDATE_START_PREFIX,
     UPDATE_PART_PREFIX,
     UPDATE_END_PREFIX,
+    COMPRESSED_START_PREFIX,
     CURSOR_POSITION_PREFIX,
+    VISIBLE_LINES_PREFIX,
     TAKE_CONTROL_MESSAGE,
     FILE_CHANGE_PREFIX,
+    FILE_REGISTER_PREFIX,
+    FILE_SWITCH_PREFIX,
     SAVE_FILE_MESSAGE,
+    HASH_TREE_PREFIX,
+    HASH_REQUEST_PREFIX,
+    HASH_NODES_PREFIX,
+    BLOCK_REQUEST_PREFIX,
+    SIGNATURES_PREFIX,
+    DELTA_PREFIX,
+    PROJECT_PART_PREFIX,
+    PROJECT_END_MESSAGE,
+    PROJECT_EXTRACTED_MESSAGE,
+    CONTENTS_VERSION_PREFIX,
+    LINES_DELTA_PREFIX,
+    SYNC_STATE_PREFIX,
+    RESYNC_REQUEST_MESSAGE,
+    INSERT_TEXT_PREFIX,
+    JOIN_SESSION_PREFIX,
+    PEER_JOINED_MESSAGE,
+    LIMITS_PREFIX,
+    SEQUENCE_PREFIX,
+    PING_PREFIX,
+    PONG_PREFIX,
 )
+from .delta import split_signatures
+from .hash_tree import split_hashes
 
 
-_ANY_PREFIX = re.compile('%s|%s|%s|%s|%s|%s|%s' % (
+_PREFIXES = (
     FULL_UPDATE_PREFIX,
     CURSOR_POSITION_PREFIX,
+    VISIBLE_LINES_PREFIX,
     UPDATE_START_PREFIX,
     UPDATE_PART_PREFIX,
     UPDATE_END_PREFIX,
+    COMPRESSED_START_PREFIX,
     FILE_CHANGE_PREFIX,
+    FILE_REGISTER_PREFIX,
+    FILE_SWITCH_PREFIX,
     SAVE_FILE_MESSAGE,
-))
+    TAKE_CONTROL_MESSAGE,
+    HASH_TREE_PREFIX,
+    HASH_REQUEST_PREFIX,
+    HASH_NODES_PREFIX,
+    BLOCK_REQUEST_PREFIX,
+    SIGNATURES_PREFIX,
+    DELTA_PREFIX,
+    PROJECT_PART_PREFIX,
+    PROJECT_END_MESSAGE,
+    PROJECT_EXTRACTED_MESSAGE,
+    CONTENTS_VERSION_PREFIX,
+    LINES_DELTA_PREFIX,
+    SYNC_STATE_PREFIX,
+    RESYNC_REQUEST_MESSAGE,
+    INSERT_TEXT_PREFIX,
+    PEER_JOINED_MESSAGE,
+    LIMITS_PREFIX,
+    SEQUENCE_PREFIX,
+    PING_PREFIX,
+    PONG_PREFIX,
+)
+# Messages are decoded as received, as UTF-8 encoded bytes
+_ENCODED_PREFIXES = dict((prefix.encode('ascii'), prefix) for prefix in _PREFIXES)
+_ANY_PREFIX = re.compile(b'|'.join(_ENCODED_PREFIXES))
+_PARTIAL_PREFIXES = set(
+    prefix[:length] for prefix in _ENCODED_PREFIXES for length in range(1, len(prefix))
+)
+_ENCODED_CURSOR_POSITION_PREFIX = CURSOR_POSITION_PREFIX.encode('ascii')
+_ENCODED_JOIN_SESSION_PREFIX = JOIN_SESSION_PREFIX.encode('ascii')
+_MAX_PREFIX_LENGTH = max(len(prefix) for prefix in _PREFIXES)
+# Longer numeric fields can't belong to a valid message
+_MAX_FIELDS_LENGTH = 256
+# Messages claiming to be longer are skipped as they arrive, not buffered
+MAX_MESSAGE_SIZE = 64 * 1024 * 1024
 
 _noop = lambda *a, **k: None
+_no_steps = lambda *a, **k: iter(())
+
+
+def _encode(text):
+    return text if isinstance(text, bytes) else text.encode('utf-8')
+
+def _decode(contents):
+    # Broken characters are replaced rather than failing the whole message
+    return contents.decode('utf-8', 'replace')
+
+def _received_data(messages):
+    ''' returns the received messages as bytes, text is encoded first '''
+    if isinstance(messages, (bytes, type(u''))):
+        return _encode(messages)
+    return b''.join(_encode(message) for message in messages)
 
 
 class NullCallbacks(object):
 
     def __init__(self):
         self.update_contents = _noop
+        self.update_contents_in_steps = _no_steps
+        self.update_visible_lines = _noop
         self.apply_cursor_position = _noop
         self.take_control = _noop
         self.file_changed = _noop
         self.save_file = _noop
+        self.check_hash_tree = _noop
+        self.compare_hash_nodes = _noop
+        self.send_hash_nodes = _noop
+        self.send_block = _noop
+        self.send_signatures = _noop
+        self.send_delta = _noop
+        self.update_contents_from_delta = _noop
+        self.receive_project_part = _noop
+        self.extract_project = _noop
+        self.project_extracted = _noop
+        self.contents_version = _noop
+        self.update_lines = _noop
+        self.check_sync_state = _noop
+        self.resync = _noop
+        self.insert_text = _noop
+        self.peer_joined = _noop
+        self.peer_limits = _noop
+        self.ping = _noop
+        self.pong = _noop
+        self.message_discarded = _noop
 
 
 class PendingUpdate(object):
 
     def __init__(self, update_callback=None):
-        self._contents = None
+        self._parts = None
+        self._compressed = False
         self._update_callback = update_callback or _noop
 
-    def start(self, contents):
-        self._contents = contents
+    def start(self, contents, compressed=False):
+        self._parts = [contents]
+        self._compressed = compressed
+
+    def start_compressed(self, contents):
+        self.start(contents, compressed=True)
 
     def add(self, contents):
-        if self._contents is not None:
-            self._contents += contents
+        if self._parts is not None:
+            self._parts.append(contents)
 
     def end(self, contents):
-        if self._contents is not None:
-            self._contents += contents
-            self._update_callback(self._contents)
+        if self._parts is not None:
+            self._parts.append(contents)
+            self._update_callback(b''.join(self._parts), self._compressed)
         self.reset()
 
     def reset(self):
-        self._contents = None
+        self._parts = None
+
+
+class ReceivedStream(object):
+    """ The data of a stream that hasn't been decoded yet """
+
+    def __init__(self):
+        self.leftover = b''
+        # Parts of an incomplete message, collected until it's complete
+        self.pending_parts = []
+        self.missing_length = 0
+        # Remaining length of an oversized message, dropped as it arrives
+        self.skip_length = 0
+
+
+class MessageFormat(object):
+    """ Numeric fields following a message's prefix; if the message has
+        contents, the last field gives their length in bytes """
+
+    def __init__(self, number_of_fields, with_contents=False):
+        fields = br'\|(\d+)' * number_of_fields
+        self._complete = re.compile(fields + (br'\|' if with_contents else b''))
+        self._incomplete = re.compile(
+            br'(?:\|\d+){0,%d}(?:\|\d*)?\Z' % max(0, number_of_fields - 1)
+        )
+        self._with_contents = with_contents
+
+    def decode(self, message, position):
+        ''' returns a tuple (end, values) for the message's fields starting
+            at position, or None if the fields haven't been received fully;
+            if only the contents are missing, values is None and end is
+            where the message will end '''
+        match = self._complete.match(message, position)
+        if match is None:
+            if self._incomplete.match(message, position):
+                return None
+            raise MessageHandler.MessageMatchingError
+        values = [int(value) for value in match.groups()]
+        end = match.end()
+        if self._with_contents:
+            length = values.pop()
+            if len(message) < end + length:
+                return end + length, None
+            values.append(message[end:end + length])
+            end += length
+        return end, values
+
+
+_MESSAGE_FORMATS = {
+    FULL_UPDATE_PREFIX: MessageFormat(1, with_contents=True),
+    CURSOR_POSITION_PREFIX: MessageFormat(2, with_contents=True),
+    VISIBLE_LINES_PREFIX: MessageFormat(3, with_contents=True),
+    UPDATE_START_PREFIX: MessageFormat(1, with_contents=True),
+    UPDATE_PART_PREFIX: MessageFormat(1, with_contents=True),
+    UPDATE_END_PREFIX: MessageFormat(1, with_contents=True),
+    COMPRESSED_START_PREFIX: MessageFormat(1, with_contents=True),
+    FILE_CHANGE_PREFIX: MessageFormat(1, with_contents=True),
+    FILE_REGISTER_PREFIX: MessageFormat(2, with_contents=True),
+    FILE_SWITCH_PREFIX: MessageFormat(1, with_contents=True),
+    SAVE_FILE_MESSAGE: MessageFormat(0),
+    TAKE_CONTROL_MESSAGE: MessageFormat(0),
+    HASH_TREE_PREFIX: MessageFormat(3, with_contents=True),
+    HASH_REQUEST_PREFIX: MessageFormat(2, with_contents=True),
+    HASH_NODES_PREFIX: MessageFormat(3, with_contents=True),
+    BLOCK_REQUEST_PREFIX: MessageFormat(1, with_contents=True),
+    SIGNATURES_PREFIX: MessageFormat(3, with_contents=True),
+    DELTA_PREFIX: MessageFormat(4, with_contents=True),
+    PROJECT_PART_PREFIX: MessageFormat(1, with_contents=True),
+    PROJECT_END_MESSAGE: MessageFormat(0),
+    PROJECT_EXTRACTED_MESSAGE: MessageFormat(0),
+    CONTENTS_VERSION_PREFIX: MessageFormat(1, with_contents=True),
+    LINES_DELTA_PREFIX: MessageFormat(5, with_contents=True),
+    SYNC_STATE_PREFIX: MessageFormat(2, with_contents=True),
+    RESYNC_REQUEST_MESSAGE: MessageFormat(0),
+    INSERT_TEXT_PREFIX: MessageFormat(4, with_contents=True),
+    PEER_JOINED_MESSAGE: MessageFormat(0),
+    LIMITS_PREFIX: MessageFormat(1, with_contents=True),
+    SEQUENCE_PREFIX: MessageFormat(1, with_contents=True),
+    PING_PREFIX: MessageFormat(1, with_contents=True),
+    PONG_PREFIX: MessageFormat(2, with_contents=True),
+}
+_JOIN_SESSION_FORMAT = MessageFormat(3, with_contents=True)
+# Applied as soon as they're received on the control stream, see process
+_UNSEQUENCED_PREFIXES = (CURSOR_POSITION_PREFIX, SEQUENCE_PREFIX, PING_PREFIX, PONG_PREFIX)
+
+
+def _partial_prefix_start(message, start):
+    ''' returns the position of an incomplete prefix at the end of message '''
+    for position in range(max(start, len(message) - _MAX_PREFIX_LENGTH), len(message)):
+        if message[position:] in _PARTIAL_PREFIXES:
+            return position
+    return len(message)
+
+
+def split_complete_messages(message):
+    ''' returns a tuple (complete, rest, missing_length) for the UTF-8
+        encoded message: the complete messages it starts with, the rest
+        that doesn't form a complete message yet and how many bytes that
+        message is still missing, if known; data in between that doesn't
+        belong to any message is dropped '''
+    complete = []
+    position = 0
+    while True:
+        match = _ANY_PREFIX.search(message, position)
+        if match is None:
+            rest = message[_partial_prefix_start(message, position):]
+            return b''.join(complete), rest, 0
+        start, end = match.start(), match.end()
+        try:
+            decoded = _MESSAGE_FORMATS[_ENCODED_PREFIXES[match.group()]].decode(message, end)
+        except MessageHandler.MessageMatchingError:
+            position = end
+            continue
+        if decoded is None:
+            if len(message) - end > _MAX_FIELDS_LENGTH:
+                position = end
+                continue
+            return b''.join(complete), message[start:], 0
+        message_end, values = decoded
+        if values is None:
+            return b''.join(complete), message[start:], message_end - len(message)
+        complete.append(message[start:message_end])
+        position = message_end
+
+
+def parse_join_session_message(message):
+    ''' returns a tuple (end, is_host, session_id, secret) for the join
+        message at the start of message, or None if it hasn't been received
+        fully; end is a position in the UTF-8 encoded message '''
+    message = _encode(message)
+    if not message.startswith(_ENCODED_JOIN_SESSION_PREFIX):
+        if _ENCODED_JOIN_SESSION_PREFIX.startswith(message):
+            return None
+        raise MessageHandler.MessageMatchingError
+    decoded = _JOIN_SESSION_FORMAT.decode(message, len(_ENCODED_JOIN_SESSION_PREFIX))
+    if decoded is None or decoded[1] is None:
+        return None
+    end, (is_host, id_length, contents) = decoded
+    return end, is_host != 0, _decode(contents[:id_length]), _decode(contents[id_length:])
 
 
 class MessageHandler(object):
+    """ Decodes received messages and applies them through the callbacks.
+
+        Decoding happens as soon as messages are received, while applying
+        the results can be spread over several calls to process if a
+        time_budget (in milliseconds) is given. If metrics are given, they
+        are told the type of each decoded message and the time spent in
+        process, see vimpair's metrics module.
+
+        Messages are received as UTF-8 encoded bytes (text is encoded
+        first) and contents are only decoded when passed to the callbacks.
+        Incomplete messages are kept until they have been received fully,
+        unless they would exceed max_message_size (in bytes), which applies
+        to compressed contents once decompressed as well.
+
+        With a separate connection for contents (see vimpair's connection
+        module), its bulk stream is passed to process as well. Messages on
+        the control stream are then applied after the contents messages sent
+        before them, as told by sequence messages; cursor positions are
+        applied right away and once more when those contents have been
+        applied. """
 
     class MessageMatchingError(RuntimeError):
         pass
 
-    @staticmethod
-    def _find_match(message, expression):
-        match = re.search(expression, message, re.DOTALL)
-        if not match:
-            raise MessageHandler.MessageMatchingError
-        return match.groups()
-
-    def __init__(self, callbacks=None):
-        self._leftover = ''
-        self._current_message = ''
+    def __init__(self, callbacks=None, time_budget=None, metrics=None,
+                 max_message_size=MAX_MESSAGE_SIZE):
+        self._stream = ReceivedStream()
+        self._bulk_stream = ReceivedStream()
+        # Contents messages received on the bulk stream so far, and those
+        # sent before the control stream's current messages
+        self._bulk_received = 0
+        self._control_sequence = 0
+        self._cursor_sequence = 0
+        # Control messages waiting for contents, with their sequence
+        self._held_messages = deque()
+        self._max_message_size = max_message_size
+        self.discarded_messages = 0
+        self.discarded_size = 0
         self._callbacks = callbacks or NullCallbacks()
+        self._time_budget = time_budget
+        self._metrics = metrics
+        self._file_paths = {}
+        self._has_project = False
+        self._actions = deque()
+        self._contents_steps = None
+        self._latest_cursor_position = None
+        self._cursor_position_received = False
         self._pending_update = PendingUpdate(
-            update_callback=self._callbacks.update_contents
+            update_callback=self._queue_contents_update
         )
         self._prefix_to_process_call = {
             FULL_UPDATE_PREFIX: self._contents_update,
             CURSOR_POSITION_PREFIX: self._cursor_position,
-            UPDATE_START_PREFIX: self._contents_start,
-            UPDATE_PART_PREFIX: self._contents_part,
-            UPDATE_END_PREFIX: self._contents_end,
+            VISIBLE_LINES_PREFIX: self._visible_lines,
+            UPDATE_START_PREFIX: self._pending_update.start,
+            UPDATE_PART_PREFIX: self._pending_update.add,
+            UPDATE_END_PREFIX: self._pending_update.end,
+            COMPRESSED_START_PREFIX: self._pending_update.start_compressed,
             FILE_CHANGE_PREFIX: self._file_change,
+            FILE_REGISTER_PREFIX: self._file_register,
+            FILE_SWITCH_PREFIX: self._file_switch,
             SAVE_FILE_MESSAGE: self._save_file,
+            TAKE_CONTROL_MESSAGE: self._take_control,
+            HASH_TREE_PREFIX: self._hash_tree,
+            HASH_REQUEST_PREFIX: self._hash_request,
+            HASH_NODES_PREFIX: self._hash_nodes,
+            BLOCK_REQUEST_PREFIX: self._block_request,
+            SIGNATURES_PREFIX: self._signatures,
+            DELTA_PREFIX: self._delta,
+            PROJECT_PART_PREFIX: self._project_part,
+            PROJECT_END_MESSAGE: self._project_end,
+            PROJECT_EXTRACTED_MESSAGE: self._project_extracted,
+            CONTENTS_VERSION_PREFIX: self._contents_version,
+            LINES_DELTA_PREFIX: self._lines_delta,
+            SYNC_STATE_PREFIX: self._sync_state,
+            RESYNC_REQUEST_MESSAGE: self._resync_request,
+            INSERT_TEXT_PREFIX: self._insert_text,
+            PEER_JOINED_MESSAGE: self._peer_joined,
+            LIMITS_PREFIX: self._limits,
+            SEQUENCE_PREFIX: self._sequence,
+            PING_PREFIX: self._ping,
+            PONG_PREFIX: self._pong,
         }
 
-    def _remove_from_message(self, string):
-        self._current_message = self._current_message.replace(string, '')
-
-    def _extract_length_and_contents(self, prefix):
-        groups = self._find_match(self._current_message, '%s\|(\d+)\|(.*)' % prefix)
-        length = int(groups[0])
-        contents = groups[1][:length]
-        self._remove_from_message('%s|%d|%s' % (prefix, length, contents))
-        return length, contents
+    @property
+    def is_applying(self):
+        ''' tells whether received messages are still waiting to be
+            applied, e.g. the rest of an update beyond the time budget '''
+        return self._contents_steps is not None or bool(self._actions)
+
+    def _queue(self, callback, *args):
+        self._actions.append((callback, args))
+
+    def _queue_contents_update(self, contents, compressed=False):
+        if compressed:
+            contents = self._decompress(contents)
+            if contents is None:
+                return
+        # The parts are joined first, as they may split characters
+        self._queue(self._update_contents, _decode(contents))
+
+    def _decompress(self, contents):
+        ''' returns the decompressed contents, or None if they're broken or
+            would exceed the largest message accepted '''
+        decompressor = decompressobj()
+        try:
+            decompressed = decompressor.decompress(contents, self._max_message_size)
+        except CompressionError:
+            return None
+        if decompressor.unconsumed_tail:
+            self._message_discarded(len(decompressed) + len(decompressor.unconsumed_tail))
+            return None
+        return decompressed
+
+    def _contents_update(self, contents):
+        self._pending_update.start(contents)
+        self._pending_update.end(b'')
+
+    def _cursor_position(self, line, column):
+        if not column.isdigit():
+            return
+        # Only the latest cursor position is applied, after all other actions.
+        # Cursor positions may be sent between the parts of an update.
+        self._latest_cursor_position = (line, int(column))
+        self._cursor_position_received = True
+        self._cursor_sequence = self._control_sequence
+
+    def _visible_lines(self, first_line, number_of_lines, contents):
+        self._queue(
+            self._callbacks.update_visible_lines,
+            first_line,
+            number_of_lines,
+            _decode(contents),
+        )
+        self._pending_update.reset()
 
-    def _handle_message_with_length(self, prefix, handler):
-        length, contents =  self._extract_length_and_contents(prefix)
-        handler(length, contents)
+    def _file_change(self, filename):
+        self._queue_file_change(_decode(filename))
+        self._pending_update.reset()
 
-    def _contents_update(self):
+    def _file_register(self, file_id, file_path):
+        file_path = _decode(file_path)
+        self._file_paths[file_id] = file_path
+        self._queue_file_change(file_path)
+        if self._has_project:
+            # The file is probably part of the project received before
+            self._queue(self._callbacks.send_signatures, file_id)
+        self._pending_update.reset()
 
-        def handle(length, contents):
-            if length <= len(contents):
-                self._pending_update.start(contents)
-                self._pending_update.end('')
+    def _file_switch(self, file_id):
+        file_id = int(file_id) if file_id.isdigit() else None
+        if file_id in self._file_paths:
+            self._queue_file_change(self._file_paths[file_id])
+            # The Editor sends the contents once it knows what we've got
+            self._queue(self._callbacks.send_signatures, file_id)
+        self._pending_update.reset()
 
-        self._handle_message_with_length(FULL_UPDATE_PREFIX, handle)
+    def _save_file(self):
+        self._queue(self._callbacks.save_file)
+
+    def _take_control(self):
+        if self._latest_cursor_position is not None:
+            self._queue(
+                self._callbacks.apply_cursor_position,
+                *self._latest_cursor_position
+            )
+            self._latest_cursor_position = None
+        self._queue(self._callbacks.take_control)
+        self._pending_update.reset()
 
-    def _contents_start(self):
-        self._handle_message_with_length(
-            UPDATE_START_PREFIX,
-            lambda _, contents: self._pending_update.start(contents)
+    def _hash_tree(self, number_of_lines, levels, root_hash):
+        self._queue(
+            self._callbacks.check_hash_tree,
+            number_of_lines,
+            levels,
+            _decode(root_hash),
         )
 
-    def _contents_part(self):
-        self._handle_message_with_length(
-            UPDATE_PART_PREFIX,
-            lambda length, contents: self._pending_update.add(contents[:length])
-        )
+    def _hash_request(self, level, index):
+        if index.isdigit():
+            self._queue(self._callbacks.send_hash_nodes, level, int(index))
 
-    def _contents_end(self):
-        self._handle_message_with_length(
-            UPDATE_END_PREFIX,
-            lambda _, contents: self._pending_update.end(contents)
+    def _hash_nodes(self, level, index, hashes):
+        self._queue(
+            self._callbacks.compare_hash_nodes,
+            level,
+            index,
+            split_hashes(_decode(hashes)),
         )
 
-    def _file_change(self):
-
-        def handle_file_change(_, contents):
-            self._callbacks.file_changed(filename=contents)
-            self._pending_update.reset()
+    def _block_request(self, index):
+        if index.isdigit():
+            self._queue(self._callbacks.send_block, int(index))
 
-        self._handle_message_with_length(FILE_CHANGE_PREFIX, handle_file_change)
+    def _signatures(self, file_id, block_size, signatures):
+        self._queue(
+            self._callbacks.send_delta,
+            file_id,
+            block_size,
+            split_signatures(_decode(signatures)),
+        )
 
-    def _cursor_position(self):
-        pattern = '%s\|(\d+)\|(\d+)' % CURSOR_POSITION_PREFIX
-        groups = self._find_match(self._current_message, pattern)
-        line, column = map(int, groups[:2])
-        self._remove_from_message('%s|%d|%d' % (CURSOR_POSITION_PREFIX, line, column))
-        self._callbacks.apply_cursor_position(line, column)
+    def _delta(self, file_id, block_size, checksum, delta):
+        self._queue(
+            self._callbacks.update_contents_from_delta,
+            file_id,
+            block_size,
+            checksum,
+            _decode(delta),
+        )
         self._pending_update.reset()
 
-    def _save_file(self):
-        groups = self._find_match(self._current_message, SAVE_FILE_MESSAGE)
-        self._remove_from_message(SAVE_FILE_MESSAGE)
-        self._callbacks.save_file()
-
-    @contextmanager
-    def _taking_control_when_told(self):
-        do_take_control = TAKE_CONTROL_MESSAGE in self._current_message
-        self._current_message = self._current_message.split(TAKE_CONTROL_MESSAGE)[0]
-        yield
-        if do_take_control:
-            self._callbacks.take_control()
-            self._pending_update.reset()
-            self._leftover = ''
-
-    def process(self, messages):
-        all_messages = reduce(lambda s1, s2: s1 + s2, messages or [''])
-        self._current_message = self._leftover + all_messages
-        with self._taking_control_when_told():
-            self._process_current_message()
-            self._leftover = self._current_message.replace(self._leftover, '')
-
-    def _process_current_message(self):
-        match = _ANY_PREFIX.search(self._current_message)
-        while match is not None:
+    def _project_part(self, data):
+        # Base64 encoded, which can be decoded from bytes right away
+        self._queue(self._callbacks.receive_project_part, data)
+
+    def _project_end(self):
+        self._has_project = True
+        self._queue(self._callbacks.extract_project)
+
+    def _project_extracted(self):
+        self._queue(self._callbacks.project_extracted)
+
+    def _contents_version(self, version):
+        if version.isdigit():
+            self._queue(self._callbacks.contents_version, int(version))
+
+    def _lines_delta(self, version, first_line, number_of_removed_lines,
+                     number_of_added_lines, contents):
+        lines = _decode(contents).split('\n') if number_of_added_lines else []
+        self._queue(
+            self._callbacks.update_lines,
+            version,
+            first_line,
+            number_of_removed_lines,
+            lines,
+        )
+
+    def _sync_state(self, version, contents_hash):
+        self._queue(self._callbacks.check_sync_state, version, _decode(contents_hash))
+
+    def _resync_request(self):
+        self._queue(self._callbacks.resync)
+
+    def _insert_text(self, version, line, column, text):
+        self._queue(self._callbacks.insert_text, version, line, column, _decode(text))
+
+    def _peer_joined(self):
+        self._queue(self._callbacks.peer_joined)
+
+    def _limits(self, max_message_size):
+        if max_message_size.isdigit():
+            self._queue(self._callbacks.peer_limits, int(max_message_size))
+
+    def _sequence(self, bulk_messages):
+        if bulk_messages.isdigit():
+            self._control_sequence = int(bulk_messages)
+
+    def _ping(self, ping_id):
+        # Answered and measured right away rather than queued, so the time
+        # spent applying other messages doesn't count as round trip time
+        if ping_id.isdigit():
+            self._callbacks.ping(int(ping_id))
+
+    def _pong(self, bytes_received, ping_id):
+        if ping_id.isdigit():
+            self._callbacks.pong(int(ping_id), bytes_received)
+
+    def _file_changed(self, filename):
+        self._callbacks.file_changed(filename=filename)
+
+    def _queue_file_change(self, filename):
+        # Cursor positions received so far belong to the previous file,
+        # unless they were sent after this message
+        if self._cursor_sequence <= self._bulk_received:
+            self._latest_cursor_position = None
+        self._queue(self._file_changed, filename)
+
+    def _update_contents(self, contents):
+        if self._time_budget is None:
+            self._callbacks.update_contents(contents)
+        else:
+            self._contents_steps = self._callbacks.update_contents_in_steps(contents)
+
+    def process(self, messages, bulk_messages=None):
+        start = default_timer()
+        deadline = None if self._time_budget is None \
+            else start + self._time_budget / 1000.
+        # The control stream comes first, so its messages can be released
+        # right after the contents sent before them
+        received_size = self._receive(self._stream, messages or [])
+        if bulk_messages is not None:
+            received_size += self._receive(self._bulk_stream, bulk_messages)
+        self._apply_actions(deadline)
+        if self._metrics is not None:
+            self._metrics.data_processed(received_size, default_timer() - start)
+
+    def _receive(self, stream, messages):
+        ''' decodes the stream's messages, returns the size received '''
+        data = _received_data(messages)
+        received_size = len(data)
+        if stream.skip_length:
+            data = self._skip(stream, data)
+        stream.pending_parts.append(data)
+        if len(data) < stream.missing_length:
+            # Joining the parts with each call would take quadratic time
+            stream.missing_length -= len(data)
+        else:
+            message = stream.leftover + b''.join(stream.pending_parts)
+            stream.pending_parts = []
+            stream.missing_length = 0
+            self._decode(stream, message)
+        return received_size
+
+    def _skip(self, stream, data):
+        length = min(len(data), stream.skip_length)
+        stream.skip_length -= length
+        self._data_discarded(length)
+        return data[length:]
+
+    def _data_discarded(self, size):
+        self.discarded_size += size
+        if self._metrics is not None:
+            self._metrics.data_discarded(size)
+
+    def _message_discarded(self, size):
+        self.discarded_messages += 1
+        if self._metrics is not None:
+            self._metrics.message_discarded()
+        self._queue(self._callbacks.message_discarded, size)
+
+    def _handle(self, stream, prefix, values):
+        if stream is self._bulk_stream:
+            self._prefix_to_process_call[prefix](*values)
+            self._bulk_message_received()
+        elif prefix in _UNSEQUENCED_PREFIXES or (
+            not self._held_messages and self._control_sequence <= self._bulk_received
+        ):
+            self._prefix_to_process_call[prefix](*values)
+        else:
+            self._held_messages.append((self._control_sequence, prefix, values))
+
+    def _bulk_message_received(self):
+        self._bulk_received += 1
+        while self._held_messages and self._held_messages[0][0] <= self._bulk_received:
+            _, prefix, values = self._held_messages.popleft()
+            self._prefix_to_process_call[prefix](*values)
+
+    def _decode(self, stream, message):
+        position = 0
+        while True:
+            # Cursor positions are the most frequent messages and usually
+            # follow each other directly, so they're checked for first
+            if message.startswith(_ENCODED_CURSOR_POSITION_PREFIX, position):
+                prefix = CURSOR_POSITION_PREFIX
+                start, end = position, position + len(_ENCODED_CURSOR_POSITION_PREFIX)
+            else:
+                match = _ANY_PREFIX.search(message, position)
+                if match is None:
+                    break
+                prefix = _ENCODED_PREFIXES[match.group()]
+                start, end = match.start(), match.end()
             try:
-                process_call = self._prefix_to_process_call[match.group()]
-                process_call()
+                decoded = _MESSAGE_FORMATS[prefix].decode(message, end)
             except MessageHandler.MessageMatchingError:
                 # This can happen if the contained message doesn't have
                 # the correct form (i.e., negative cursor position).
                 # So we discard the message here.
-                self._current_message = \
-                    self._current_message[match.start() + len(match.group()):]
-            match = _ANY_PREFIX.search(self._current_message)
+                position = end
+                continue
+            if decoded is None:
+                if len(message) - end > _MAX_FIELDS_LENGTH:
+                    position = end
+                    continue
+                stream.leftover = message[start:]
+                return
+            message_end, values = decoded
+            if message_end - start > self._max_message_size:
+                # The message is dropped as it arrives instead of buffering
+                # it, and the messages after it are handled as usual
+                self._message_discarded(message_end - start)
+                self._data_discarded(min(message_end, len(message)) - start)
+                if stream is self._bulk_stream:
+                    self._bulk_message_received()
+                if values is None:
+                    stream.skip_length = message_end - len(message)
+                    stream.leftover = b''
+                    return
+                position = message_end
+                continue
+            if values is None:
+                stream.leftover = message[start:]
+                stream.missing_length = message_end - len(message)
+                return
+            position = message_end
+            if self._metrics is not None:
+                self._metrics.message_received(prefix)
+            self._handle(stream, prefix, values)
+            if prefix == TAKE_CONTROL_MESSAGE:
+                # Everything after this message is meant for the Editor
+                stream.leftover = b''
+                return
+        stream.leftover = message[_partial_prefix_start(message, position):]
+
+    def _apply_actions(self, deadline):
+        applied = False
+        while self._contents_steps is not None or self._actions:
+            applied = True
+            if self._contents_steps is not None:
+                self._continue_contents_update(deadline)
+                if self._contents_steps is not None:
+                    break
+            else:
+                callback, args = self._actions.popleft()
+                callback(*args)
+            if deadline is not None and default_timer() > deadline:
+                break
+        self._apply_latest_cursor_position(actions_applied=applied)
+
+    def _continue_contents_update(self, deadline):
+        for _ in self._contents_steps:
+            if default_timer() > deadline:
+                return
+        self._contents_steps = None
+
+    def _apply_latest_cursor_position(self, actions_applied):
+        # The cursor position is applied right away, even if other actions
+        # have to wait for the next call. It's kept and applied again after
+        # later actions, as its line may only be added by them, e.g. by
+        # contents the Editor held back while sending the position.
+        if self._latest_cursor_position is not None and (
+                self._cursor_position_received or actions_applied):
+            self._callbacks.apply_cursor_position(*self._latest_cursor_position)
+            self._cursor_position_received = False
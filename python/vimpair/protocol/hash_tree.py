@@ -0,0 +1,86 @@
+from hashlib import sha1
+
+
+BLOCK_SIZE = 64 # lines per leaf
+FANOUT = 16 # children per node
+HASH_LENGTH = 16 # hex digits
+
+
+def _hash(text):
+    return sha1(text.encode('utf-8')).hexdigest()[:HASH_LENGTH]
+
+
+class HashTree(object):
+    """ Merkle tree over blocks of lines: level 0 holds the blocks' hashes,
+        every level above hashes up to FANOUT nodes of the level below,
+        the last level holds the single root hash """
+
+    def __init__(self, lines, number_of_lines=None, block_size=BLOCK_SIZE, fanout=FANOUT):
+        ''' number_of_lines gives the length of the buffer to compare with;
+            blocks are cut (or left short) accordingly '''
+        lines = list(lines)
+        if number_of_lines is None:
+            number_of_lines = len(lines)
+        self.number_of_lines = number_of_lines
+        self._block_size = block_size
+        self._fanout = fanout
+
+        number_of_blocks = max(1, -(-number_of_lines // block_size))
+        level = [
+            self._block_hash(lines[start:min(start + block_size, number_of_lines)])
+            for start in range(0, number_of_blocks * block_size, block_size)
+        ]
+        self._levels = [level]
+        while len(level) > 1:
+            level = [
+                _hash(''.join(level[start:start + fanout]))
+                for start in range(0, len(level), fanout)
+            ]
+            self._levels.append(level)
+
+    @staticmethod
+    def _block_hash(lines):
+        # The line count tells blocks apart that only differ in missing lines
+        return _hash('%d\n%s' % (len(lines), '\n'.join(lines)))
+
+    @property
+    def levels(self):
+        return len(self._levels)
+
+    @property
+    def root(self):
+        return self._levels[-1][0]
+
+    @property
+    def number_of_blocks(self):
+        return len(self._levels[0])
+
+    def children(self, level, index):
+        ''' returns the hashes of the node's children on the level below '''
+        if not 0 < level < self.levels:
+            return []
+        start = index * self._fanout
+        return self._levels[level - 1][start:start + self._fanout]
+
+    def mismatching_children(self, level, index, hashes):
+        ''' returns the indices (on the level below) of the node's children
+            whose hashes differ from the given ones '''
+        start = index * self._fanout
+        children = self.children(level, index)
+        return [
+            start + offset
+            for offset, child in enumerate(children)
+            if offset >= len(hashes) or hashes[offset] != child
+        ]
+
+    def block_lines(self, index):
+        ''' returns a tuple (first_line, last_line) of the block's lines '''
+        first_line = index * self._block_size
+        return first_line, min(first_line + self._block_size, self.number_of_lines)
+
+
+def split_hashes(contents):
+    return [
+        contents[start:start + HASH_LENGTH]
+        for start in range(0, len(contents), HASH_LENGTH)
+    ]
@@ -0,0 +1,137 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import vimpair
+from profiling import profiled
+from vim_interface import get_current_window_id, go_to_window
+
+
+class PairingSession(object):
+    """ One of the sessions of this Vim instance; it keeps its own copies of
+        vimpair's module-level objects and is shown in the window it was
+        started in """
+
+    def __init__(self, window_id, is_server, folder=None):
+        self.window_id = window_id
+        self.is_server = is_server
+        self.is_editor = is_server
+        self.is_connected = False
+        # The Observer's session folder, see session.Session
+        self.folder = folder
+        self.message_handler = None
+        self.state = vimpair.create_session_state()
+
+    def take_control(self):
+        self.is_editor = True
+
+    def hand_over_control(self):
+        if vimpair.hand_over_control():
+            self.is_editor = False
+
+    def poll(self):
+        ''' services the session's connection, the session has to be active '''
+        if not self.is_connected:
+            self.is_connected = vimpair.check_for_new_client() \
+                if self.is_server \
+                else vimpair.check_for_server()
+        elif self.is_editor:
+            self._process(*vimpair.receive_requests())
+            vimpair.flush_messages()
+        else:
+            self._process(*vimpair.connector.connection.receive())
+            vimpair.project_extraction()
+
+    @profiled('MessageHandler.process')
+    def _process(self, messages, bulk_messages=None):
+        self.message_handler.process(messages, bulk_messages)
+
+    def end(self):
+        vimpair.connector.disconnect()
+        self.message_handler = None
+        if self.folder:
+            self.folder.end()
+            self.folder = None
+
+
+class SessionRegistry(object):
+    """ Keeps the sessions of this Vim instance by window; a single poller
+        services all of them, so they share one timer """
+
+    def __init__(self, metrics=None):
+        self._sessions = OrderedDict()
+        # Shared by the sessions' connections and message handlers
+        self.metrics = metrics
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def current(self):
+        ''' returns the session of the current window, or the only session '''
+        session = self._sessions.get(get_current_window_id())
+        if session is None and len(self._sessions) == 1:
+            session = next(iter(self._sessions.values()))
+        return session
+
+    def start(self, is_server, folder=None):
+        ''' adds and activates a session for the current window, returns
+            None if the window has a session already '''
+        window_id = get_current_window_id()
+        if window_id in self._sessions:
+            return None
+        session = PairingSession(window_id, is_server, folder=folder)
+        self._sessions[window_id] = session
+        vimpair.activate_session_state(session.state)
+        return session
+
+    def stop(self, session):
+        with self.activated(session):
+            session.end()
+        del self._sessions[session.window_id]
+
+    def stop_all(self):
+        for session in list(self._sessions.values()):
+            self.stop(session)
+        if self.metrics is not None:
+            self.metrics.write()
+
+    @contextmanager
+    def activated(self, session, switch_window=True):
+        ''' lets vimpair's functions work with the session's objects; with
+            several sessions, its window is made current meanwhile '''
+        vimpair.activate_session_state(session.state)
+        previous_window_id = get_current_window_id()
+        switched = (
+            switch_window
+            and len(self._sessions) > 1
+            and session.window_id != previous_window_id
+            and go_to_window(session.window_id)
+        )
+        try:
+            yield session
+        finally:
+            if switched:
+                go_to_window(previous_window_id)
+
+    def as_editor(self, action):
+        ''' calls action for the current window's session, if it's the Editor '''
+        session = self.current()
+        if session is not None and session.is_editor:
+            with self.activated(session, switch_window=False):
+                action()
+
+    def with_current(self, action):
+        ''' calls action for the current window's session, returns whether
+            there is one '''
+        session = self.current()
+        if session is None:
+            return False
+        with self.activated(session, switch_window=False):
+            action()
+        return True
+
+    def poll(self):
+        for session in list(self._sessions.values()):
+            with self.activated(session):
+                session.poll()
+        if self.metrics is not None:
+            self.metrics.write_if_due()
@@ -1,7 +1,9 @@
-from os import path
+from os import path, remove
 from shutil import rmtree
 from tempfile import mkdtemp
 
+from project import extract_project_archive
+
 
 class Session(object):
 
@@ -15,4 +17,9 @@ class Session(object):
         self._session_folder = None
 
     def prepend_folder(self, filename):
-        return path.join(self._session_folder, filename)
+        # Unconcealed paths are absolute, but have to stay in the session
+        return path.join(self._session_folder, filename.lstrip('/'))
+
+    def extract_project(self, archive_path):
+        extract_project_archive(archive_path, self._session_folder)
+        remove(archive_path)
@@ -1,9 +1,50 @@
 from functools import partial
-from mock import Mock
-from socket import error, timeout
-from unittest import TestCase
+from mock import Mock, patch
+from os import path, stat
+from shutil import rmtree
+from socket import (
+    AF_INET,
+    IPPROTO_TCP,
+    SOCK_STREAM,
+    TCP_NODELAY,
+    error,
+    socket,
+    socketpair,
+    timeout,
+)
+from select import select
+from tempfile import mkdtemp
+from threading import Thread
+from time import sleep
+from timeit import default_timer
+from unittest import TestCase, skipIf
 
-from ..connection import Connection
+from ..connection import (
+    AF_UNIX,
+    CONTENTS_PRIORITY,
+    CONTROL_PRIORITY,
+    CURSOR_PRIORITY,
+    Connection,
+    HandshakeError,
+    MessageScheduler,
+    RECEIVE_TIMEOUT,
+    RingBuffer,
+    SCM_RIGHTS,
+    SHARED_MEMORY_TRANSPORT,
+    SharedMemoryConnection,
+    SplitConnection,
+    TCP_TRANSPORT,
+    UNIX_TRANSPORT,
+    connection_factory,
+    create_client_socket,
+    create_relay_socket,
+    create_server_socket,
+    create_shared_memory_client_connection,
+    create_shared_memory_server_connection,
+    create_split_client_connection,
+    create_split_server_connection,
+    default_socket_path,
+)
 
 def fake_recv(_number_of_bytes, values=[]):
     if len(values) == 0:
@@ -34,21 +75,42 @@ class ConnectionTests(TestCase):
         self.socket.sendall.assert_called_with('Some message')
 
     def test_received_messages_contain_single_message_from_recv(self):
-        self.socket.recv = partial(fake_recv, values=['Some message'])
+        self.socket.recv = partial(fake_recv, values=[b'Some message'])
 
-        self.assertEqual(['Some message'], self.connection.received_messages)
+        self.assertEqual([b'Some message'], self.connection.received_messages)
 
     def test_received_messages_concatenate_all_messages_until_timeout(self):
         self.socket.recv = partial(
             fake_recv,
-            values=['Another message', 'Some message']
+            values=[b'Another message', b'Some message']
         )
 
         self.assertEqual(
-            ['Some messageAnother message'],
+            [b'Some messageAnother message'],
             self.connection.received_messages,
         )
 
+    def test_received_messages_stop_at_max_receive_size(self):
+        self.socket.recv = partial(
+            fake_recv,
+            values=[b'Third part', b'Second part', b'First part']
+        )
+
+        with patch('vimpair.connection.MAX_RECEIVE_SIZE', 20):
+            self.assertEqual(
+                [b'First partSecond part'],
+                self.connection.received_messages,
+            )
+            self.assertEqual([b'Third part'], self.connection.received_messages)
+
+    def test_received_bytes_are_counted(self):
+        self.socket.recv = partial(fake_recv, values=[b'Another message', b'Some message'])
+        self.connection.received_messages
+        self.socket.recv = partial(fake_recv, values=[b'Third message'])
+        self.connection.received_messages
+
+        self.assertEqual(self.connection.bytes_received, 40)
+
     def test_closing_socket_on_broken_pipe(self):
         self.socket.sendall.side_effect = raise_broken_pipe
 
@@ -64,3 +126,773 @@ class ConnectionTests(TestCase):
         self.connection.send_message('Another message')
 
         self.socket.sendall.assert_not_called()
+
+
+class MessageSchedulerTests(TestCase):
+
+    def setUp(self):
+        self.sent_messages = []
+        self.scheduler = MessageScheduler(self.sent_messages.append)
+
+
+    def test_flush_sends_queued_messages_in_order(self):
+        self.scheduler.queue(['1', '2'])
+        self.scheduler.queue(['3'])
+
+        self.scheduler.flush()
+
+        self.assertEqual(self.sent_messages, ['1', '2', '3'])
+
+    def test_queue_does_not_send_messages(self):
+        self.scheduler.queue(['1', '2'])
+
+        self.assertEqual(self.sent_messages, [])
+
+    def test_flush_sends_messages_by_priority(self):
+        self.scheduler.queue(['contents'], priority=CONTENTS_PRIORITY)
+        self.scheduler.queue(['cursor'], priority=CURSOR_PRIORITY)
+        self.scheduler.queue(['control'], priority=CONTROL_PRIORITY)
+
+        self.scheduler.flush()
+
+        self.assertEqual(self.sent_messages, ['control', 'cursor', 'contents'])
+
+    def test_flush_limits_size_of_sent_contents(self):
+        self.scheduler.queue(['12345', '67890', 'abcde'])
+
+        self.scheduler.flush(max_contents_size=6)
+
+        self.assertEqual(self.sent_messages, ['12345', '67890'])
+
+    def test_flush_sends_all_contents_without_limit(self):
+        self.scheduler.queue(['12345', '67890', 'abcde'])
+
+        self.scheduler.flush(max_contents_size=None)
+
+        self.assertEqual(self.sent_messages, ['12345', '67890', 'abcde'])
+
+    def test_on_sent_is_called_once_last_message_has_been_sent(self):
+        on_sent = Mock()
+        self.scheduler.queue(['12345', '67890'], on_sent=on_sent)
+
+        self.scheduler.flush(max_contents_size=1)
+        on_sent.assert_not_called()
+        self.scheduler.flush(max_contents_size=1)
+
+        on_sent.assert_called_once_with()
+
+    def test_on_sent_is_called_after_sending(self):
+        self.scheduler.queue(['message'], on_sent=lambda: self.sent_messages.append('sent'))
+
+        self.scheduler.flush()
+
+        self.assertEqual(self.sent_messages, ['message', 'sent'])
+
+    def test_cursor_messages_are_sent_between_contents(self):
+        self.scheduler.queue(['12345', '67890'])
+        self.scheduler.flush(max_contents_size=1)
+        self.scheduler.queue(['cursor'], priority=CURSOR_PRIORITY)
+
+        self.scheduler.flush(max_contents_size=1)
+
+        self.assertEqual(self.sent_messages, ['12345', 'cursor', '67890'])
+
+    def test_replaceable_messages_replace_unsent_replaceable_messages(self):
+        self.scheduler.queue(['1', '2'], replaceable=True)
+
+        self.scheduler.queue(['3', '4'], replaceable=True)
+        self.scheduler.flush()
+
+        self.assertEqual(self.sent_messages, ['3', '4'])
+
+    def test_replaceable_messages_replace_remainder_of_partially_sent_messages(self):
+        self.scheduler.queue(['1', '2'], replaceable=True)
+        self.scheduler.flush(max_contents_size=1)
+
+        self.scheduler.queue(['3', '4'], replaceable=True)
+        self.scheduler.flush()
+
+        self.assertEqual(self.sent_messages, ['1', '3', '4'])
+
+    def test_replaceable_messages_dont_replace_other_messages(self):
+        self.scheduler.queue(['1'], replaceable=True)
+        self.scheduler.queue(['2'])
+
+        self.scheduler.queue(['3'], replaceable=True)
+        self.scheduler.flush()
+
+        self.assertEqual(self.sent_messages, ['1', '2', '3'])
+
+    def test_replaceable_messages_dont_replace_messages_of_other_priority(self):
+        self.scheduler.queue(['cursor'], priority=CURSOR_PRIORITY, replaceable=True)
+
+        self.scheduler.queue(['contents'], replaceable=True)
+        self.scheduler.flush()
+
+        self.assertEqual(self.sent_messages, ['cursor', 'contents'])
+
+    def test_has_queued_messages_until_all_are_sent(self):
+        self.scheduler.queue(['12345', '67890'])
+        self.scheduler.flush(max_contents_size=1)
+        has_queued_messages = self.scheduler.has_queued_messages
+
+        self.scheduler.flush(max_contents_size=1)
+
+        self.assertEqual(
+            (has_queued_messages, self.scheduler.has_queued_messages),
+            (True, False),
+        )
+
+    def test_has_queued_contents_only_for_contents_priority(self):
+        self.scheduler.queue(['cursor'], priority=CURSOR_PRIORITY)
+        has_queued_contents = self.scheduler.has_queued_contents
+
+        self.scheduler.queue(['contents'])
+
+        self.assertEqual(
+            (has_queued_contents, self.scheduler.has_queued_contents),
+            (False, True),
+        )
+
+    def test_queueing_no_messages_is_ignored(self):
+        self.scheduler.queue([])
+
+        self.assertFalse(self.scheduler.has_queued_messages)
+
+    def test_contents_are_sent_with_send_bulk_message(self):
+        bulk_messages = []
+        scheduler = MessageScheduler(
+            self.sent_messages.append,
+            send_bulk_message=bulk_messages.append,
+        )
+        scheduler.queue(['contents'])
+        scheduler.queue(['cursor'], priority=CURSOR_PRIORITY)
+        scheduler.queue(['control'], priority=CONTROL_PRIORITY)
+
+        scheduler.flush()
+
+        self.assertEqual(self.sent_messages, ['control', 'cursor'])
+        self.assertEqual(bulk_messages, ['contents'])
+
+    def _scheduler_with_timer(self):
+        self.now = 0.
+        return MessageScheduler(self.sent_messages.append, timer=lambda: self.now)
+
+    def test_contents_are_held_back_during_coalescing_window(self):
+        scheduler = self._scheduler_with_timer()
+        scheduler.queue(['contents'])
+        scheduler.queue(['cursor'], priority=CURSOR_PRIORITY)
+
+        self.now = .05
+        scheduler.flush(coalescing_window=.1)
+
+        self.assertEqual(self.sent_messages, ['cursor'])
+
+    def test_contents_are_sent_after_coalescing_window(self):
+        scheduler = self._scheduler_with_timer()
+        scheduler.queue(['contents'])
+
+        self.now = .1
+        scheduler.flush(coalescing_window=.1)
+
+        self.assertEqual(self.sent_messages, ['contents'])
+
+    def test_replaced_contents_keep_coalescing_window_of_first_contents(self):
+        scheduler = self._scheduler_with_timer()
+        scheduler.queue(['first'], replaceable=True)
+        self.now = .08
+        scheduler.queue(['second'], replaceable=True)
+
+        self.now = .1
+        scheduler.flush(coalescing_window=.1)
+
+        self.assertEqual(self.sent_messages, ['second'])
+
+    def test_coalescing_window_is_ignored_when_sending_all_contents(self):
+        scheduler = self._scheduler_with_timer()
+        scheduler.queue(['contents'])
+
+        scheduler.flush(max_contents_size=None, coalescing_window=.1)
+
+        self.assertEqual(self.sent_messages, ['contents'])
+
+
+class ConnectionQueueTests(TestCase):
+
+    def setUp(self):
+        self.socket = Mock()
+        self.connection = Connection(self.socket)
+
+
+    def test_flush_sends_queued_messages_with_sendall(self):
+        self.connection.queue_messages(['Some message'])
+
+        self.connection.flush()
+
+        self.socket.sendall.assert_called_with('Some message')
+
+    def test_closing_connection_drops_queued_messages(self):
+        self.connection.queue_messages(['Some message'])
+
+        self.connection.close()
+
+        self.assertFalse(self.connection.has_queued_messages)
+
+    def test_broken_pipe_drops_remaining_queued_messages(self):
+        self.socket.sendall.side_effect = raise_broken_pipe
+        self.connection.queue_messages(['Some message', 'Another message'])
+
+        self.connection.flush()
+
+        self.assertFalse(self.connection.has_queued_messages)
+
+
+class ConnectionMetricsTests(TestCase):
+
+    def setUp(self):
+        self.socket = Mock()
+        self.metrics = Mock()
+
+
+    def test_sent_messages_are_reported_to_metrics(self):
+        connection = Connection(self.socket, metrics=self.metrics)
+        connection.queue_messages(['Some message'])
+
+        connection.flush()
+
+        self.socket.sendall.assert_called_with('Some message')
+        self.assertEqual(self.metrics.message_sent.call_args[0][0], 'Some message')
+
+    def test_factory_creates_connections_reporting_to_metrics(self):
+        create_connection = connection_factory(UNIX_TRANSPORT, True, metrics=self.metrics)
+        connection = create_connection(self.socket)
+        connection.queue_messages(['Some message'])
+
+        connection.flush()
+
+        self.metrics.message_sent.assert_called_once()
+
+
+@skipIf(AF_UNIX is None, 'Unix domain sockets are not available')
+class UnixTransportTests(TestCase):
+
+    def setUp(self):
+        self.folder = mkdtemp('VimpairTests')
+        self.socket_path = path.join(self.folder, 'test.socket')
+        self.sockets = []
+
+    def tearDown(self):
+        for sock in self.sockets:
+            sock.close()
+        rmtree(self.folder, True)
+
+    def create_server_socket(self):
+        sock = create_server_socket(
+            transport=UNIX_TRANSPORT,
+            socket_path=self.socket_path,
+        )
+        if sock is not None:
+            self.sockets.append(sock)
+        return sock
+
+
+    def test_server_socket_is_bound_to_given_path(self):
+        self.create_server_socket()
+
+        self.assertTrue(path.exists(self.socket_path))
+
+    def test_server_socket_replaces_stale_socket_file(self):
+        self.create_server_socket().close()
+
+        self.assertIsNotNone(self.create_server_socket())
+
+    def test_server_socket_does_not_replace_socket_in_use(self):
+        self.create_server_socket()
+
+        self.assertIsNone(self.create_server_socket())
+
+    def test_server_socket_does_not_replace_other_files(self):
+        with open(self.socket_path, 'w') as other_file:
+            other_file.write('Some contents')
+
+        server_socket = self.create_server_socket()
+
+        self.assertIsNone(server_socket)
+        with open(self.socket_path) as other_file:
+            self.assertEqual(other_file.read(), 'Some contents')
+
+    def test_default_socket_path_is_in_runtime_folder(self):
+        with patch.dict('os.environ', {'XDG_RUNTIME_DIR': self.folder}):
+            socket_path = default_socket_path()
+
+        self.assertEqual(path.dirname(socket_path), self.folder)
+
+    def test_default_socket_path_is_in_private_folder(self):
+        with patch.dict('os.environ', {'XDG_RUNTIME_DIR': ''}), \
+                patch('vimpair.connection.gettempdir', return_value=self.folder):
+            socket_path = default_socket_path()
+
+        self.assertEqual(stat(path.dirname(socket_path)).st_mode & 0o777, 0o700)
+
+    def test_client_socket_connects_to_server_socket(self):
+        server_socket = self.create_server_socket()
+        client_socket = create_client_socket(
+            transport=UNIX_TRANSPORT,
+            socket_path=self.socket_path,
+        )
+        self.sockets.append(client_socket)
+
+        connection_socket = server_socket.get_client_connection()
+        self.sockets.append(connection_socket)
+
+        self.assertIsNotNone(connection_socket)
+
+    def test_messages_are_transferred_through_socket(self):
+        server_socket = self.create_server_socket()
+        client_socket = create_client_socket(
+            transport=UNIX_TRANSPORT,
+            socket_path=self.socket_path,
+        )
+        connection_socket = server_socket.get_client_connection()
+        self.sockets.extend([client_socket, connection_socket])
+
+        client_socket.sendall(b'Some message')
+
+        self.assertEqual(connection_socket.recv(1024), b'Some message')
+
+    def test_connection_has_received_data_once_message_arrives(self):
+        server_socket = self.create_server_socket()
+        client_socket = create_client_socket(
+            transport=UNIX_TRANSPORT,
+            socket_path=self.socket_path,
+        )
+        connection_socket = server_socket.get_client_connection()
+        self.sockets.extend([client_socket, connection_socket])
+        connection = Connection(connection_socket)
+        self.assertFalse(connection.has_received_data)
+
+        client_socket.sendall(b'Some message')
+
+        self.assertTrue(connection.has_received_data)
+
+    def test_connection_without_socket_has_no_received_data(self):
+        self.assertFalse(Connection(None).has_received_data)
+
+    def test_connection_without_received_data_receives_nothing(self):
+        self.assertEqual(Connection(None).receive(), ([], None))
+
+    def test_receiving_does_not_wait_for_more_data(self):
+        server_socket, client_socket = socketpair()
+        self.sockets.extend([server_socket, client_socket])
+        client_socket.settimeout(1.)
+        server_socket.sendall(b'Some message')
+        start = default_timer()
+
+        received = Connection(client_socket).received_messages
+
+        self.assertLess(default_timer() - start, .05)
+        self.assertEqual(received, [b'Some message'])
+        self.assertEqual(client_socket.gettimeout(), 1.)
+
+    def test_sending_more_than_fits_into_buffers_waits_for_slow_reader(self):
+        server_socket, client_socket = socketpair()
+        self.sockets.extend([server_socket, client_socket])
+        server_socket.settimeout(.1)
+        message = b'x' * (16 * 1024 * 1024)
+        received = []
+
+        def read_slowly():
+            sleep(.3)
+            client_socket.settimeout(1.)
+            size = 0
+            try:
+                while size < len(message):
+                    size += len(client_socket.recv(1024 * 1024))
+            except timeout:
+                pass
+            received.append(size)
+        reader = Thread(target=read_slowly)
+        reader.start()
+
+        Connection(server_socket).send_message(message)
+        reader.join()
+
+        self.assertEqual(received, [len(message)])
+        self.assertEqual(server_socket.gettimeout(), .1)
+
+
+class TcpPortTests(TestCase):
+
+    def setUp(self):
+        probe = socket(AF_INET, SOCK_STREAM)
+        probe.bind(('127.0.0.1', 0))
+        self.port = probe.getsockname()[1]
+        probe.close()
+        self.sockets = []
+
+    def tearDown(self):
+        for sock in self.sockets:
+            sock.close()
+
+
+    def test_client_socket_connects_to_server_socket_on_given_port(self):
+        server_socket = create_server_socket(port=self.port)
+        self.sockets.append(server_socket)
+        client_socket = create_client_socket(port=self.port)
+        self.sockets.append(client_socket)
+
+        connection_socket = server_socket.get_client_connection()
+        self.sockets.append(connection_socket)
+
+        self.assertIsNotNone(connection_socket)
+
+
+class RelaySocketTests(TestCase):
+
+    def setUp(self):
+        self.relay_socket = socket(AF_INET, SOCK_STREAM)
+        self.relay_socket.bind(('127.0.0.1', 0))
+        self.relay_socket.listen(1)
+        self.address = '127.0.0.1:%d' % self.relay_socket.getsockname()[1]
+
+    def tearDown(self):
+        self.relay_socket.close()
+
+
+    def test_sends_join_message_after_connecting(self):
+        sock = create_relay_socket(self.address, 'VIMPAIR_JOIN_SESSION|1|2|id')
+        connection_socket, _ = self.relay_socket.accept()
+
+        self.assertEqual(connection_socket.recv(1024), b'VIMPAIR_JOIN_SESSION|1|2|id')
+        sock.close()
+        connection_socket.close()
+
+    def test_returns_none_if_relay_is_not_reachable(self):
+        self.relay_socket.close()
+
+        self.assertIsNone(create_relay_socket(self.address, 'Join'))
+
+
+class RingBufferTests(TestCase):
+
+    def setUp(self):
+        self.folder = mkdtemp('VimpairTests')
+        file_path = path.join(self.folder, 'ring')
+        self.writer = RingBuffer(file_path, capacity=8, create=True)
+        self.reader = RingBuffer(file_path)
+
+    def tearDown(self):
+        self.writer.close()
+        self.reader.close()
+        rmtree(self.folder, True)
+
+
+    def test_written_data_can_be_read(self):
+        self.writer.write(b'abc')
+
+        self.assertEqual(self.reader.read(), b'abc')
+
+    def test_data_is_read_only_once(self):
+        self.writer.write(b'abc')
+        self.reader.read()
+
+        self.assertEqual(self.reader.read(), b'')
+
+    def test_write_returns_number_of_bytes_fitting_into_buffer(self):
+        self.assertEqual(self.writer.write(b'0123456789'), 8)
+        self.assertEqual(self.reader.read(), b'01234567')
+
+    def test_data_wraps_around_end_of_buffer(self):
+        self.writer.write(b'012345')
+        self.reader.read()
+
+        self.writer.write(b'abcdef')
+
+        self.assertEqual(self.reader.read(), b'abcdef')
+
+    def test_buffer_is_empty_after_everything_was_read(self):
+        self.writer.write(b'abc')
+        self.assertFalse(self.writer.is_empty)
+
+        self.reader.read()
+
+        self.assertTrue(self.writer.is_empty)
+
+
+class SharedMemoryConnectionTests(TestCase):
+
+    def setUp(self):
+        server_socket, client_socket = socketpair()
+        self.server = create_shared_memory_server_connection(server_socket, 64)
+        self.client = create_shared_memory_client_connection(client_socket)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.close()
+
+
+    def test_handshake_creates_shared_memory_connections(self):
+        self.assertIsInstance(self.server, SharedMemoryConnection)
+        self.assertIsInstance(self.client, SharedMemoryConnection)
+
+    def test_messages_are_transferred_to_client(self):
+        self.server.send_message('Some message')
+
+        self.assertEqual(self.client.received_messages, [b'Some message'])
+
+    def test_messages_are_transferred_to_server(self):
+        self.client.send_message('Some message')
+
+        self.assertEqual(self.server.received_messages, [b'Some message'])
+
+    def test_has_received_data_once_message_was_written(self):
+        self.assertFalse(self.client.has_received_data)
+
+        self.server.send_message('Some message')
+
+        self.assertTrue(self.client.has_received_data)
+
+    def test_nothing_is_received_without_messages(self):
+        self.assertEqual(self.client.received_messages, [b''])
+
+    def test_messages_exceeding_buffer_are_sent_on_flush(self):
+        self.server.send_message(100 * 'x')
+        first_part = self.client.received_messages[0]
+
+        self.server.flush()
+
+        self.assertEqual(first_part + self.client.received_messages[0], 100 * b'x')
+
+    def test_has_queued_messages_until_buffer_has_room(self):
+        self.server.send_message(100 * 'x')
+        self.assertTrue(self.server.has_queued_messages)
+
+        self.client.received_messages
+        self.server.flush()
+
+        self.assertFalse(self.server.has_queued_messages)
+
+    def test_multibyte_characters_split_by_buffer_are_received_as_bytes(self):
+        # The MessageHandler decodes them once the message is complete
+        self.server.send_message(63 * 'x' + u'\u00e4')
+        first_part = self.client.received_messages[0]
+
+        self.server.flush()
+
+        self.assertEqual(first_part, 63 * b'x' + b'\xc3')
+        self.assertEqual(self.client.received_messages, [b'\xa4'])
+
+    def test_closing_server_connection_removes_buffer_files(self):
+        folder = self.server._folder
+
+        self.server.close()
+
+        self.assertFalse(path.exists(folder))
+
+    @skipIf(SCM_RIGHTS is None, 'File descriptors can\'t be passed')
+    def test_client_does_not_need_access_to_buffer_folder(self):
+        # As when running as another user
+        server_socket, client_socket = socketpair()
+        server = create_shared_memory_server_connection(server_socket, 64)
+        rmtree(server._folder)
+        client = create_shared_memory_client_connection(client_socket)
+
+        server.send_message('Some message')
+        client.send_message('Some answer')
+
+        self.assertEqual(client.received_messages, [b'Some message'])
+        self.assertEqual(server.received_messages, [b'Some answer'])
+        client.close()
+        server.close()
+
+
+sequence_message = lambda number: b'SEQUENCE|%d' % number
+
+
+def _receive_exactly(sock, size):
+    data = b''
+    while len(data) < size:
+        try:
+            part = sock.recv(size - len(data))
+        except timeout:
+            break
+        data += part
+    return data
+
+
+def _tcp_socket_pair():
+    server_socket = socket(AF_INET, SOCK_STREAM)
+    server_socket.bind(('127.0.0.1', 0))
+    server_socket.listen(1)
+    client_socket = socket(AF_INET, SOCK_STREAM)
+    client_socket.connect(server_socket.getsockname())
+    connection_socket, _ = server_socket.accept()
+    server_socket.close()
+    for sock in (client_socket, connection_socket):
+        sock.settimeout(.1)
+    return connection_socket, client_socket
+
+
+class SplitConnectionTests(TestCase):
+
+    def setUp(self):
+        connection_socket, client_socket = _tcp_socket_pair()
+
+        # The server waits for the client to connect its bulk socket
+        result = []
+        thread = Thread(target=lambda: result.append(
+            create_split_server_connection(connection_socket, sequence_message)))
+        thread.start()
+        self.client = create_split_client_connection(client_socket, sequence_message)
+        thread.join()
+        self.server = result[0]
+
+    def tearDown(self):
+        self.client.close()
+        self.server.close()
+
+
+    def receive_on_client(self, size):
+        return _receive_exactly(self.client._socket, size)
+
+    def receive_bulk_on_client(self, size):
+        return _receive_exactly(self.client._bulk_socket, size)
+
+    def test_handshake_creates_split_connections(self):
+        self.assertIsInstance(self.server, SplitConnection)
+        self.assertIsInstance(self.client, SplitConnection)
+
+    def test_control_socket_sends_without_delay(self):
+        self.assertTrue(self.server._socket.getsockopt(IPPROTO_TCP, TCP_NODELAY))
+
+    def test_contents_are_sent_through_bulk_socket(self):
+        self.server.queue_messages([b'Contents'])
+        self.server.queue_messages([b'Cursor'], priority=CURSOR_PRIORITY)
+
+        self.server.flush()
+
+        self.assertEqual(self.receive_on_client(6), b'Cursor')
+        self.assertEqual(self.receive_bulk_on_client(8), b'Contents')
+
+    def test_control_messages_tell_number_of_contents_sent_before(self):
+        self.server.queue_messages([b'First', b'Second'])
+        self.server.flush()
+
+        self.server.queue_messages([b'Control'], priority=CONTROL_PRIORITY)
+        self.server.queue_messages([b'Cursor'], priority=CURSOR_PRIORITY)
+        self.server.flush()
+
+        self.assertEqual(self.receive_on_client(23), b'SEQUENCE|2ControlCursor')
+
+    def test_no_sequence_is_sent_before_any_contents(self):
+        self.server.send_message(b'Control')
+
+        self.assertEqual(self.receive_on_client(7), b'Control')
+
+    def test_received_streams_are_kept_apart(self):
+        self.server.queue_messages([b'Contents'])
+        self.server.queue_messages([b'Cursor'], priority=CURSOR_PRIORITY)
+        self.server.flush()
+
+        self.assertEqual(self.client.received_messages, [b'Cursor'])
+        self.assertEqual(self.client.received_bulk_messages, b'Contents')
+
+    def test_has_received_data_on_either_socket(self):
+        self.assertFalse(self.client.has_received_data)
+
+        self.server.queue_messages([b'Contents'])
+        self.server.flush()
+
+        self.assertTrue(self.client.has_received_data)
+
+    def test_receives_only_from_sockets_with_data(self):
+        self.server.queue_messages([b'Contents'])
+        self.server.flush()
+        select([self.client._bulk_socket], [], [], 1.)
+
+        start = default_timer()
+        received = self.client.receive()
+
+        self.assertEqual(received, ([], b'Contents'))
+        self.assertLess(default_timer() - start, RECEIVE_TIMEOUT)
+
+
+class SplitHandshakeFallbackTests(TestCase):
+
+    def setUp(self):
+        self.server_socket, self.client_socket = _tcp_socket_pair()
+
+    def tearDown(self):
+        self.server_socket.close()
+        self.client_socket.close()
+
+
+    def test_server_falls_back_to_plain_connection_for_plain_client(self):
+        with patch('vimpair.connection.BULK_HANDSHAKE_TIMEOUT', .05):
+            server = create_split_server_connection(self.server_socket, sequence_message)
+        server.send_message(b'Message')
+
+        self.assertNotIsInstance(server, SplitConnection)
+        self.assertTrue(_receive_exactly(self.client_socket, 100).endswith(b'\nMessage'))
+
+    def test_client_falls_back_to_plain_connection_for_plain_server(self):
+        self.server_socket.sendall(b'VIMPAIR_LIMITS|8|67108864')
+
+        client = create_split_client_connection(self.client_socket, sequence_message)
+
+        self.assertNotIsInstance(client, SplitConnection)
+        self.assertEqual(client.received_messages, [b'VIMPAIR_LIMITS|8|67108864'])
+
+
+class ConnectionFactoryTests(TestCase):
+
+    def test_returns_plain_connections_for_socket_transports(self):
+        self.assertIs(connection_factory(UNIX_TRANSPORT, True), Connection)
+
+    def test_returns_plain_connections_without_sequence_message(self):
+        self.assertIs(connection_factory(TCP_TRANSPORT, True), Connection)
+
+    def test_creates_plain_connection_without_bulk_offer(self):
+        sock = Mock()
+        sock.recv.side_effect = timeout
+        create_connection = connection_factory(
+            TCP_TRANSPORT, False, sequence_message=sequence_message)
+
+        with patch('vimpair.connection.BULK_HANDSHAKE_TIMEOUT', 0.):
+            connection = create_connection(sock)
+
+        self.assertNotIsInstance(connection, SplitConnection)
+        sock.close.assert_not_called()
+
+    def test_raises_if_connection_closes_during_bulk_handshake(self):
+        sock = Mock()
+        sock.recv.return_value = b''
+        create_connection = connection_factory(
+            TCP_TRANSPORT, False, sequence_message=sequence_message)
+
+        self.assertRaises(HandshakeError, create_connection, sock)
+
+        sock.close.assert_called_with()
+
+    def test_creates_plain_connection_without_socket(self):
+        create_connection = connection_factory(SHARED_MEMORY_TRANSPORT, True)
+
+        self.assertNotIsInstance(create_connection(None), SharedMemoryConnection)
+
+    def test_raises_if_handshake_fails(self):
+        sock = Mock()
+        sock.recv.side_effect = sock.recvmsg.side_effect = timeout
+        create_connection = connection_factory(SHARED_MEMORY_TRANSPORT, False)
+
+        with patch('vimpair.connection.SHARED_MEMORY_HANDSHAKE_TIMEOUT', 0.):
+            self.assertRaises(HandshakeError, create_connection, sock)
+
+        sock.close.assert_called_with()
+
+    def test_raises_if_buffers_can_not_be_opened(self):
+        server_socket, client_socket = socketpair()
+        server_socket.sendall(b'/nonexistent\n')
+        create_connection = connection_factory(SHARED_MEMORY_TRANSPORT, False)
+
+        self.assertRaises(HandshakeError, create_connection, client_socket)
+        server_socket.close()
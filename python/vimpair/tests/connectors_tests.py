@@ -0,0 +1,187 @@
+from mock import Mock
+from os import path
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import sleep
+from timeit import default_timer
+from unittest import TestCase, skipIf
+import sys
+
+# connectors is imported like the plugin does, from within its folder
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+from ..connection import (
+    AF_UNIX,
+    Connection,
+    UNIX_TRANSPORT,
+    create_client_socket,
+    create_server_socket,
+)
+# Raised as the connectors know it
+from ..connectors import ClientConnector, HandshakeError, ServerConnector
+
+
+MAX_DELAY = .2
+
+
+@skipIf(AF_UNIX is None, 'Unix domain sockets are not available')
+class ClientConnectorTests(TestCase):
+
+    def setUp(self):
+        self.folder = mkdtemp('VimpairTests')
+        self.socket_path = path.join(self.folder, 'test.socket')
+        self.connector = ClientConnector(
+            lambda: create_server_socket(
+                transport=UNIX_TRANSPORT,
+                socket_path=self.socket_path,
+            )
+        )
+        self.client_socket = None
+
+    def tearDown(self):
+        self.connector.disconnect()
+        if self.client_socket:
+            self.client_socket.close()
+        rmtree(self.folder, True)
+
+    def connect_client(self):
+        self.client_socket = create_client_socket(
+            transport=UNIX_TRANSPORT,
+            socket_path=self.socket_path,
+        )
+
+
+    def test_is_waiting_for_connection_without_client(self):
+        self.assertTrue(self.connector.is_waiting_for_connection)
+
+    def test_client_connection_is_accepted_immediately(self):
+        start = default_timer()
+        self.connect_client()
+
+        while self.connector.is_waiting_for_connection:
+            self.assertLess(default_timer() - start, MAX_DELAY)
+            sleep(.001)
+
+    def test_disconnect_returns_immediately_while_waiting(self):
+        start = default_timer()
+
+        self.connector.disconnect()
+
+        self.assertLess(default_timer() - start, MAX_DELAY)
+
+    def test_disconnect_stops_waiting_for_connection(self):
+        self.connector.disconnect()
+
+        self.assertFalse(self.connector.is_waiting_for_connection)
+
+    def test_keeps_waiting_if_handshake_fails(self):
+        self.connector.disconnect()
+        self.connector = ClientConnector(
+            lambda: create_server_socket(
+                transport=UNIX_TRANSPORT,
+                socket_path=self.socket_path,
+            ),
+            Mock(side_effect=[
+                Connection(None),
+                HandshakeError('Some error'),
+                Connection(None),
+            ]),
+        )
+        self.connect_client()
+        sleep(MAX_DELAY)
+
+        self.assertTrue(self.connector.is_waiting_for_connection)
+        self.assertEqual(self.connector.pop_status_messages(),
+                         ['Connecting failed: Some error'])
+
+
+class ServerConnectorTests(TestCase):
+
+    def setUp(self):
+        self.sockets = [None, None, Mock()]
+        self.connector = None
+
+    def tearDown(self):
+        if self.connector:
+            self.connector.disconnect()
+
+    def socket_factory(self):
+        return self.sockets.pop(0) if self.sockets else None
+
+    def create_connector(self, first_retry_delay=.001, connection_factory=Connection):
+        self.connector = ServerConnector(
+            self.socket_factory,
+            connection_factory=connection_factory,
+            first_retry_delay=first_retry_delay,
+        )
+
+    def wait_for_connection(self):
+        start = default_timer()
+        while self.connector.is_waiting_for_connection:
+            self.assertLess(default_timer() - start, MAX_DELAY)
+            sleep(.001)
+
+
+    def test_connection_is_retried_until_server_is_reachable(self):
+        self.create_connector()
+
+        self.wait_for_connection()
+
+        self.assertEqual(self.sockets, [])
+
+    def test_connection_uses_socket_of_successful_attempt(self):
+        connection_socket = self.sockets[-1]
+        self.create_connector()
+        self.wait_for_connection()
+
+        self.connector.connection.send_message('Message')
+
+        connection_socket.sendall.assert_called_with('Message')
+
+    def test_status_messages_report_retries_and_connection(self):
+        self.create_connector()
+        self.wait_for_connection()
+
+        messages = self.connector.pop_status_messages()
+
+        self.assertEqual(len(messages), 3)
+        self.assertTrue(messages[0].startswith('Server not reachable'))
+        self.assertEqual(messages[-1], 'Connected to server')
+        self.assertEqual(self.connector.pop_status_messages(), [])
+
+    def test_connection_is_retried_if_handshake_fails(self):
+        self.sockets = [Mock(), Mock()]
+        self.create_connector(connection_factory=Mock(side_effect=[
+            Connection(None),
+            HandshakeError('Some error'),
+            Connection(self.sockets[-1]),
+            Connection(None),
+        ]))
+        self.wait_for_connection()
+
+        messages = self.connector.pop_status_messages()
+
+        self.assertEqual(messages[0], 'Connecting failed: Some error')
+        self.assertEqual(messages[-1], 'Connected to server')
+
+    def test_retry_delay_grows_exponentially(self):
+        self.sockets = []
+        self.create_connector(first_retry_delay=.01)
+        sleep(.05)
+
+        messages = self.connector.pop_status_messages()
+
+        self.assertEqual(messages[:3], [
+            'Server not reachable, retrying in 0.01s',
+            'Server not reachable, retrying in 0.02s',
+            'Server not reachable, retrying in 0.04s',
+        ])
+
+    def test_disconnect_stops_retrying_immediately(self):
+        self.sockets = []
+        self.create_connector(first_retry_delay=10.)
+        start = default_timer()
+
+        self.connector.disconnect()
+
+        self.assertLess(default_timer() - start, MAX_DELAY)
+        self.assertFalse(self.connector.is_waiting_for_connection)
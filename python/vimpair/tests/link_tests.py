@@ -0,0 +1,244 @@
+from os import path
+from unittest import TestCase
+import sys
+
+# link is imported like the plugin does, from within its folder
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+from ..link import (
+    DEFAULT_SETTINGS,
+    MAX_PENDING_PINGS,
+    MAX_TUNED_CONTENTS_PER_FLUSH,
+    MIN_THROUGHPUT_SAMPLE_SIZE,
+    PING_INTERVAL,
+    LinkMonitor,
+    probe,
+    tune,
+)
+from ..protocol import MESSAGE_LENGTH
+from .util import FakeTimer
+
+
+MB = 1024 * 1024
+
+
+class TuneTests(TestCase):
+
+    def test_defaults_without_throughput(self):
+        self.assertEqual(tune(.05, None), DEFAULT_SETTINGS)
+
+    def test_fast_link_gets_large_parts_without_compression(self):
+        settings = tune(.001, 1000 * MB)
+
+        self.assertEqual(settings.contents_per_flush, MAX_TUNED_CONTENTS_PER_FLUSH)
+        self.assertGreater(settings.part_size, MESSAGE_LENGTH)
+        self.assertEqual(settings.compression_level, 0)
+        self.assertEqual(settings.coalescing_window, 0.)
+
+    def test_slow_link_gets_compression_and_coalescing(self):
+        settings = tune(.08, 100 * 1024)
+
+        self.assertEqual(settings.part_size, MESSAGE_LENGTH)
+        self.assertEqual(settings.compression_level, 9)
+        self.assertEqual(settings.coalescing_window, .08)
+
+    def test_compression_is_lighter_on_faster_links(self):
+        levels = [tune(.01, throughput).compression_level
+                  for throughput in (100 * 1024, 2 * MB, 16 * MB, 64 * MB)]
+
+        self.assertEqual(levels, [9, 6, 1, 0])
+
+    def test_coalescing_window_is_limited(self):
+        self.assertEqual(tune(2., 100 * 1024).coalescing_window, .1)
+        self.assertEqual(tune(None, 100 * 1024).coalescing_window, .02)
+
+    def test_probing_neither_compresses_nor_coalesces(self):
+        settings = probe(MB)
+
+        self.assertEqual(settings.contents_per_flush, MB)
+        self.assertEqual((settings.compression_level, settings.coalescing_window), (0, 0.))
+
+
+class LinkMonitorTests(TestCase):
+
+    def setUp(self):
+        self.timer = FakeTimer()
+        self.monitor = LinkMonitor(timer=self.timer)
+        self.bytes_received = 0
+
+
+    def _pong_after(self, round_trip_time, bytes_received, backlogged=True):
+        ping_id = self.monitor.next_ping()
+        self.monitor.contents_flushed(backlogged)
+        self.timer.now += round_trip_time
+        self.monitor.pong_received(ping_id, bytes_received)
+
+    def _receive_for_a_second(self, throughput, backlogged=True):
+        self.bytes_received += throughput
+        self.timer.now += .99
+        self._pong_after(.01, self.bytes_received, backlogged)
+
+    def test_nothing_is_measured_initially(self):
+        self.assertIsNone(self.monitor.round_trip_time)
+        self.assertIsNone(self.monitor.throughput)
+        self.assertEqual(self.monitor.settings, DEFAULT_SETTINGS)
+
+    def test_ping_is_due_after_interval(self):
+        due_initially = self.monitor.ping_due
+        self.monitor.next_ping()
+        due_right_after = self.monitor.ping_due
+        self.timer.now += PING_INTERVAL
+
+        self.assertEqual((due_initially, due_right_after, self.monitor.ping_due),
+                         (True, False, True))
+
+    def test_round_trip_time_is_measured_from_pong(self):
+        self._pong_after(.05, 0)
+
+        self.assertAlmostEqual(self.monitor.round_trip_time, .05)
+
+    def test_round_trip_time_is_moving_average(self):
+        self._pong_after(.05, 0)
+        self._pong_after(.13, 0)
+
+        self.assertAlmostEqual(self.monitor.round_trip_time, .06)
+
+    def test_unknown_pongs_are_ignored(self):
+        self.monitor.pong_received(5, 0)
+
+        self.assertIsNone(self.monitor.round_trip_time)
+
+    def test_each_ping_is_answered_only_once(self):
+        ping_id = self.monitor.next_ping()
+        self.timer.now += .05
+        self.monitor.pong_received(ping_id, 0)
+        self.timer.now += 1.
+        self.monitor.pong_received(ping_id, 0)
+
+        self.assertAlmostEqual(self.monitor.round_trip_time, .05)
+
+    def test_only_latest_pings_wait_for_pong(self):
+        first_ping_id = self.monitor.next_ping()
+        for _ in range(MAX_PENDING_PINGS):
+            self.monitor.next_ping()
+
+        self.monitor.pong_received(first_ping_id, 0)
+
+        self.assertIsNone(self.monitor.round_trip_time)
+
+    def test_throughput_is_measured_from_bytes_received_between_pongs(self):
+        self._pong_after(.01, 0)
+        self.timer.now += .99
+        self._pong_after(.01, MB)
+
+        self.assertAlmostEqual(self.monitor.throughput, MB)
+
+    def test_small_transfers_are_not_taken_as_throughput(self):
+        self._pong_after(.01, 0)
+        self._pong_after(.01, MIN_THROUGHPUT_SAMPLE_SIZE - 1)
+
+        self.assertIsNone(self.monitor.throughput)
+
+    def test_throughput_is_highest_of_latest_samples(self):
+        self._pong_after(.5, 0)
+        self._pong_after(.5, 4 * MB)
+        self._pong_after(.5, 5 * MB)
+
+        self.assertAlmostEqual(self.monitor.throughput, 8 * MB)
+
+    def test_transfers_without_backlog_are_not_taken_as_throughput(self):
+        self._pong_after(.01, 0)
+        self._receive_for_a_second(MB, backlogged=False)
+
+        self.assertIsNone(self.monitor.throughput)
+
+    def test_backlog_has_to_last_until_pong(self):
+        self._pong_after(.01, 0)
+        self.monitor.contents_flushed(False)
+        self._receive_for_a_second(MB)
+
+        self.assertIsNone(self.monitor.throughput)
+
+    def test_contents_per_flush_are_doubled_while_throughput_rises(self):
+        self._pong_after(.01, 0)
+        self._receive_for_a_second(MB)
+        self._receive_for_a_second(2 * MB)
+
+        self.assertTrue(self.monitor.is_probing)
+        self.assertEqual(
+            self.monitor.settings,
+            probe(4 * DEFAULT_SETTINGS.contents_per_flush),
+        )
+
+    def test_probed_contents_per_flush_are_limited(self):
+        self._pong_after(.01, 0)
+        for power in range(10):
+            self._receive_for_a_second(2 ** power * MB)
+
+        self.assertEqual(self.monitor.settings.contents_per_flush, MAX_TUNED_CONTENTS_PER_FLUSH)
+
+    def test_nothing_is_compressed_while_probing(self):
+        self._pong_after(.08, 0)
+        self._receive_for_a_second(100 * 1024)
+
+        self.assertEqual(self.monitor.settings.compression_level, 0)
+
+    def test_settings_are_tuned_once_link_is_the_limit(self):
+        self._pong_after(.08, 0)
+        self._receive_for_a_second(100 * 1024)
+        self._receive_for_a_second(100 * 1024)
+
+        self.assertFalse(self.monitor.is_probing)
+        self.assertEqual(
+            self.monitor.settings,
+            tune(self.monitor.round_trip_time, self.monitor.throughput),
+        )
+        self.assertEqual(self.monitor.settings.compression_level, 9)
+
+    def test_probes_again_once_queue_drains(self):
+        self._pong_after(.01, 0)
+        self._receive_for_a_second(MB)
+        self._receive_for_a_second(MB)
+        tuned_contents_per_flush = self.monitor.settings.contents_per_flush
+
+        self._receive_for_a_second(MB, backlogged=False)
+
+        self.assertTrue(self.monitor.is_probing)
+        self.assertEqual(
+            self.monitor.settings.contents_per_flush,
+            2 * tuned_contents_per_flush,
+        )
+
+    def test_reset_forgets_measurements(self):
+        self._pong_after(.01, 0)
+        self._pong_after(.01, MB)
+
+        self.monitor.reset()
+
+        self.assertIsNone(self.monitor.round_trip_time)
+        self.assertIsNone(self.monitor.throughput)
+        self.assertEqual(self.monitor.settings, DEFAULT_SETTINGS)
+
+    def test_description_tells_what_has_not_been_measured(self):
+        description = self.monitor.describe()
+
+        self.assertIn('round trip time not measured yet', description)
+        self.assertIn('throughput not measured yet', description)
+
+    def test_description_tells_throughput_is_lower_bound_while_probing(self):
+        self._pong_after(.01, 0)
+        self._receive_for_a_second(MB)
+
+        self.assertIn('throughput at least 1.0 MB/s', self.monitor.describe())
+
+    def test_description_contains_measurements_and_settings(self):
+        self._pong_after(.08, 0)
+        self.timer.now += .92
+        self._pong_after(.08, 100 * 1024)
+        self.timer.now += .92
+        self._pong_after(.08, 200 * 1024)
+
+        description = self.monitor.describe()
+
+        self.assertIn('round trip time 80.0 ms', description)
+        self.assertIn('compression level 9', description)
+        self.assertIn('coalescing for 80 ms', description)
@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+""" Feeds generated message streams to the MessageHandler, split at random
+    positions and mixed with garbage, and checks the results against the
+    stream processed at once, as well as memory and time bounds. """
+from functools import partial
+from random import Random
+from timeit import default_timer
+from unittest import TestCase
+from ddt import data, ddt
+
+from ..protocol import (
+    MessageHandler,
+    generate_block_request_message,
+    generate_contents_update_messages,
+    generate_contents_version_message,
+    generate_cursor_position_message,
+    generate_file_change_message,
+    generate_hash_request_message,
+    generate_inserted_text_message,
+    generate_lines_delta_message,
+    generate_resync_request_message,
+    generate_save_file_message,
+    generate_sync_state_message,
+    generate_visible_lines_message,
+)
+from ..protocol.handle_messages import (
+    NullCallbacks,
+    _MAX_FIELDS_LENGTH,
+    _MAX_PREFIX_LENGTH,
+)
+
+
+SEEDS = (1, 2, 3, 5, 8, 13, 21, 34)
+# Parts of contents, including some which look like messages
+_CONTENTS_ALPHABET = list(u'abc xyz 0123456789|\n\täöü€中') + [
+    u'VIMPAIR_CURSOR_POSITION|1|1|2',
+    u'VIMPAIR_FULL_UPDATE|',
+    u'VIMPAIR_TAKE_CONTROL',
+]
+_GARBAGE_ALPHABET = u'abcxyz 0123456789|\näö€'
+_MALFORMED_MESSAGES = (
+    b'VIMPAIR_CURSOR_POSITION|x',
+    b'VIMPAIR_FULL_UPDATE|-1|',
+    b'VIMPAIR_HASH_REQUEST||',
+    b'VIMPAIR_LINES_DELTA|1|2|x',
+)
+MAX_MESSAGE_SIZE = 64 * 1024
+# Tolerated factor between the measured and the linear processing time
+TIME_TOLERANCE = 3.
+
+
+class RecordingCallbacks(NullCallbacks):
+
+    def __init__(self):
+        super(RecordingCallbacks, self).__init__()
+        self.calls = []
+        self.cursor_position = None
+        for name in list(vars(self)):
+            if name not in ('calls', 'cursor_position'):
+                setattr(self, name, partial(self._record, name))
+
+    def _record(self, name, *args, **kwargs):
+        if name == 'apply_cursor_position':
+            # Only the latest position is applied per call to process
+            self.cursor_position = args
+        else:
+            self.calls.append((name, args, kwargs))
+
+
+def _text(rng, max_length):
+    return u''.join(
+        rng.choice(_CONTENTS_ALPHABET)
+        for _ in range(rng.randint(0, max_length))
+    )
+
+
+def _random_messages(rng, number_of_messages):
+    generators = (
+        lambda: generate_contents_update_messages(_text(rng, 3000)),
+        lambda: [generate_cursor_position_message(
+            rng.randint(0, 500), rng.randint(0, 80))],
+        lambda: [generate_visible_lines_message(
+            rng.randint(0, 100), 3, [_text(rng, 40) for _ in range(3)])],
+        lambda: [generate_file_change_message(u'file_%d.py' % rng.randint(0, 3))],
+        lambda: [generate_lines_delta_message(
+            rng.randint(1, 100), rng.randint(0, 50), rng.randint(0, 3),
+            [_text(rng, 40) for _ in range(rng.randint(0, 3))])],
+        lambda: [generate_inserted_text_message(
+            rng.randint(1, 100), rng.randint(0, 50), rng.randint(0, 80), _text(rng, 2))],
+        lambda: [generate_sync_state_message(rng.randint(1, 100), u'%040x' % rng.getrandbits(160))],
+        lambda: [generate_contents_version_message(rng.randint(1, 100))],
+        lambda: [generate_save_file_message()],
+        lambda: [generate_hash_request_message(rng.randint(0, 5), rng.randint(0, 20))],
+        lambda: [generate_block_request_message(rng.randint(0, 20))],
+        lambda: [generate_resync_request_message()],
+    )
+    messages = []
+    for _ in range(number_of_messages):
+        messages.extend(rng.choice(generators)())
+    # The latest cursor position is applied in any case
+    messages.append(generate_cursor_position_message(1, 1))
+    return messages
+
+
+def _garbage(rng):
+    if rng.random() < .3:
+        return rng.choice(_MALFORMED_MESSAGES)
+    return u''.join(
+        rng.choice(_GARBAGE_ALPHABET) for _ in range(rng.randint(0, 30))
+    ).encode('utf-8')
+
+
+def _split_randomly(rng, stream, max_part_length):
+    parts = []
+    position = 0
+    while position < len(stream):
+        end = position + rng.randint(0, max_part_length)
+        parts.append(stream[position:end])
+        position = end
+    return parts
+
+
+def _process(parts, max_message_size=MAX_MESSAGE_SIZE, check_leftover=None):
+    callbacks = RecordingCallbacks()
+    handler = MessageHandler(callbacks=callbacks, max_message_size=max_message_size)
+    for part in parts:
+        handler.process([part])
+        if check_leftover:
+            check_leftover(handler)
+    return callbacks
+
+
+def _buffered_length(handler):
+    stream = handler._stream
+    return len(stream.leftover) + sum(len(part) for part in stream.pending_parts)
+
+
+@ddt
+class MessageHandlerStreamTests(TestCase):
+
+    def assert_same_results(self, actual, expected):
+        self.assertEqual(actual.calls, expected.calls)
+        self.assertEqual(actual.cursor_position, expected.cursor_position)
+
+    def assert_leftover_is_bounded(self, handler):
+        self.assertLessEqual(
+            _buffered_length(handler),
+            MAX_MESSAGE_SIZE + _MAX_FIELDS_LENGTH + _MAX_PREFIX_LENGTH,
+        )
+
+
+    @data(*SEEDS)
+    def test_random_splits_give_same_results(self, seed):
+        rng = Random(seed)
+        stream = b''.join(_random_messages(rng, 200))
+
+        expected = _process([stream])
+        actual = _process(_split_randomly(rng, stream, 100))
+
+        self.assertNotEqual(expected.calls, [])
+        self.assert_same_results(actual, expected)
+
+    @data(*SEEDS)
+    def test_single_character_parts_give_same_results(self, seed):
+        rng = Random(seed)
+        stream = b''.join(_random_messages(rng, 20))
+
+        expected = _process([stream])
+        actual = _process(_split_randomly(rng, stream, 1))
+
+        self.assert_same_results(actual, expected)
+
+    @data(*SEEDS)
+    def test_garbage_between_messages_is_skipped(self, seed):
+        rng = Random(seed)
+        messages = _random_messages(rng, 200)
+        with_garbage = []
+        for message in messages:
+            with_garbage.append(message)
+            if rng.random() < .2:
+                with_garbage.append(_garbage(rng))
+
+        expected = _process([b''.join(messages)])
+        actual = _process(_split_randomly(rng, b''.join(with_garbage), 100))
+
+        self.assert_same_results(actual, expected)
+
+    @data(*SEEDS)
+    def test_oversized_messages_are_skipped_without_buffering(self, seed):
+        rng = Random(seed)
+        messages = _random_messages(rng, 100)
+        with_oversized = []
+        for message in messages:
+            with_oversized.append(message)
+            if rng.random() < .1:
+                contents = b'x' * rng.randint(MAX_MESSAGE_SIZE, 2 * MAX_MESSAGE_SIZE)
+                with_oversized.append(
+                    b'VIMPAIR_FULL_UPDATE|%d|%s' % (len(contents), contents))
+        oversized = len(with_oversized) - len(messages)
+
+        expected = _process([b''.join(messages)])
+        actual = _process(
+            _split_randomly(rng, b''.join(with_oversized), 5000),
+            check_leftover=self.assert_leftover_is_bounded,
+        )
+
+        discarded = [call for call in actual.calls if call[0] == 'message_discarded']
+        self.assertEqual(len(discarded), oversized)
+        actual.calls = [call for call in actual.calls if call not in discarded]
+        self.assert_same_results(actual, expected)
+
+    @data(*SEEDS)
+    def test_huge_lengths_are_skipped_without_buffering(self, seed):
+        rng = Random(seed)
+        messages = _random_messages(rng, 100)
+
+        callbacks = _process(
+            _split_randomly(rng, b''.join(messages + [
+                b'VIMPAIR_FULL_UPDATE|%d|' % rng.randint(MAX_MESSAGE_SIZE, 10 ** 12)
+            ]), 100) + [b'x' * 1000] * 100,
+            check_leftover=self.assert_leftover_is_bounded,
+        )
+
+        self.assertEqual(callbacks.calls[-1][0], 'message_discarded')
+
+    @data(*SEEDS)
+    def test_leftover_stays_bounded_for_random_garbage(self, seed):
+        rng = Random(seed)
+        garbage = [
+            rng.choice((b'VIMPAIR_FULL_UPDATE|', b'VIMPAIR_HASH_TREE|', b'|', b'9'))
+            for _ in range(20000)
+        ]
+
+        _process(
+            _split_randomly(rng, b''.join(garbage), 1000),
+            check_leftover=self.assert_leftover_is_bounded,
+        )
+
+    def test_endless_fields_are_not_buffered(self):
+        handler = MessageHandler(max_message_size=MAX_MESSAGE_SIZE)
+
+        handler.process([b'VIMPAIR_FULL_UPDATE|'])
+        for _ in range(100):
+            handler.process([b'9' * 100])
+
+        self.assertLessEqual(_buffered_length(handler), _MAX_FIELDS_LENGTH + 100)
+
+
+def _best_time(function, repetitions=3):
+    best = None
+    for _ in range(repetitions):
+        start = default_timer()
+        function()
+        duration = default_timer() - start
+        best = duration if best is None else min(best, duration)
+    return best
+
+
+class MessageHandlerPerformanceTests(TestCase):
+    """ Compares the processing time of an input with that of an input 8
+        times as large; quadratic behavior would take 64 times as long """
+
+    FACTOR = 8
+
+    def assert_linear(self, process_input_of_size, size):
+        small = _best_time(lambda: process_input_of_size(size))
+        large = _best_time(lambda: process_input_of_size(self.FACTOR * size))
+
+        self.assertLess(large, TIME_TOLERANCE * self.FACTOR * small + .01)
+
+
+    def test_time_is_linear_in_size_of_large_message_received_in_parts(self):
+        def process_input_of_size(size):
+            contents = b'x' * size
+            message = b'VIMPAIR_FULL_UPDATE|%d|%s' % (len(contents), contents)
+            _process([message[start:start + 1024] for start in range(0, len(message), 1024)])
+
+        self.assert_linear(process_input_of_size, 256 * 1024)
+
+    def test_time_is_linear_in_number_of_messages(self):
+        rng = Random(1)
+        messages = _random_messages(rng, 400)
+
+        def process_input_of_size(size):
+            stream = b''.join(messages[:size])
+            _process([stream[start:start + 1024] for start in range(0, len(stream), 1024)])
+
+        self.assert_linear(process_input_of_size, 50)
+
+    def test_time_is_linear_in_size_of_generated_contents(self):
+        def generate_input_of_size(size):
+            generate_contents_update_messages(u'x' * size)
+
+        self.assert_linear(generate_input_of_size, 256 * 1024)
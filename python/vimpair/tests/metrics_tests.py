@@ -0,0 +1,157 @@
+from json import loads
+from mock import Mock, patch
+from os import path
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest import TestCase
+import sys
+
+sys.modules.setdefault('vim', Mock())
+# metrics is imported like the plugin does, from within its folder
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+from .. import metrics
+from ..metrics import Histogram, Metrics
+from ..protocol import (
+    CURSOR_POSITION_PREFIX,
+    FULL_UPDATE_PREFIX,
+    LINES_DELTA_PREFIX,
+    TAKE_CONTROL_MESSAGE,
+    generate_contents_update_messages,
+    generate_cursor_position_message,
+    generate_lines_delta_message,
+    generate_take_control_message,
+)
+from .util import FakeTimer
+
+
+class HistogramTests(TestCase):
+
+    def test_durations_are_counted_in_their_buckets(self):
+        histogram = Histogram()
+
+        histogram.record(.00005)
+        histogram.record(.002)
+        histogram.record(1.)
+
+        buckets = histogram.as_dict()['buckets_ms']
+        self.assertEqual(buckets['0.1'], 1)
+        self.assertEqual(buckets['3'], 1)
+        self.assertEqual(buckets['inf'], 1)
+
+    def test_keeps_total_and_max(self):
+        histogram = Histogram()
+
+        histogram.record(.002)
+        histogram.record(.004)
+
+        self.assertEqual(histogram.as_dict()['count'], 2)
+        self.assertAlmostEqual(histogram.as_dict()['total_ms'], 6.)
+        self.assertAlmostEqual(histogram.as_dict()['max_ms'], 4.)
+
+
+class MetricsTests(TestCase):
+
+    def setUp(self):
+        self.folder = mkdtemp('VimpairTests')
+        self.file_path = path.join(self.folder, 'metrics.jsonl')
+        self.timer = FakeTimer()
+        self.metrics = Metrics(
+            self.file_path,
+            interval=10.,
+            timer=self.timer,
+            clock=lambda: 1234.,
+        )
+
+    def tearDown(self):
+        rmtree(self.folder, True)
+
+    def _written_lines(self):
+        with open(self.file_path) as metrics_file:
+            return [loads(line) for line in metrics_file]
+
+
+    def test_counts_sent_messages_by_type(self):
+        self.metrics.message_sent(generate_cursor_position_message(1, 2), .001)
+        self.metrics.message_sent(generate_cursor_position_message(1, 3), .001)
+        self.metrics.message_sent(generate_take_control_message(), .001)
+
+        self.assertEqual(self.metrics.sent, {
+            CURSOR_POSITION_PREFIX: 2,
+            TAKE_CONTROL_MESSAGE: 1,
+        })
+
+    def test_counts_full_and_partial_updates(self):
+        full_update = generate_contents_update_messages('Some contents')[0]
+        self.metrics.message_sent(full_update, .001)
+        self.metrics.message_sent(generate_lines_delta_message(1, 0, 1, ['Line']), .001)
+
+        self.assertEqual(self.metrics.full_updates_sent, 1)
+        self.assertEqual(self.metrics.partial_updates_sent, 1)
+        self.assertEqual(self.metrics.largest_full_update_sent, len(full_update))
+
+    def test_largest_full_update_is_the_sum_of_its_parts(self):
+        messages = generate_contents_update_messages(5000 * 'x', message_length=1024)
+        for message in messages:
+            self.metrics.message_sent(message, .001)
+
+        self.assertEqual(self.metrics.full_updates_sent, 1)
+        self.assertEqual(
+            self.metrics.largest_full_update_sent,
+            sum(len(message) for message in messages),
+        )
+
+    def test_sums_sent_and_received_sizes(self):
+        self.metrics.message_sent(b'VIMPAIR_FULL_UPDATE|4|Text', .001)
+        self.metrics.data_processed(100, .001)
+        self.metrics.data_processed(50, .001)
+
+        self.assertEqual(self.metrics.bytes_sent, 26)
+        self.assertEqual(self.metrics.bytes_received, 150)
+
+    def test_counts_discarded_messages_and_data(self):
+        self.metrics.message_discarded()
+        self.metrics.data_discarded(100)
+        self.metrics.data_discarded(20)
+
+        self.assertEqual(self.metrics.as_dict()['messages_discarded'], 1)
+        self.assertEqual(self.metrics.as_dict()['bytes_discarded'], 120)
+
+    def test_writes_nothing_before_interval_has_passed(self):
+        self.timer.now = 9.
+        self.metrics.write_if_due()
+
+        self.assertFalse(path.exists(self.file_path))
+
+    def test_appends_json_line_once_interval_has_passed(self):
+        self.metrics.message_received(LINES_DELTA_PREFIX)
+        self.metrics.message_received(LINES_DELTA_PREFIX)
+        self.timer.now = 10.
+        self.metrics.write_if_due()
+
+        self.metrics.message_received(FULL_UPDATE_PREFIX)
+        self.timer.now = 25.
+        self.metrics.write_if_due()
+
+        first, second = self._written_lines()
+        self.assertEqual(first['time'], 1234.)
+        self.assertEqual(first['received'], {LINES_DELTA_PREFIX: 2})
+        self.assertEqual(first['received_per_second'], {LINES_DELTA_PREFIX: .2})
+        self.assertEqual(second['received'], {FULL_UPDATE_PREFIX: 1})
+        self.assertEqual(second['interval_s'], 15.)
+
+    def test_failing_to_write_shows_status_message(self):
+        self.metrics.file_path = self.folder
+
+        with patch.object(metrics, 'show_status_message') as show_status_message:
+            self.metrics.write()
+
+        self.assertEqual(show_status_message.call_count, 1)
+        self.assertIn('Could not write metrics', show_status_message.call_args[0][0])
+
+    def test_counters_start_over_after_writing(self):
+        self.metrics.message_sent(b'VIMPAIR_FULL_UPDATE|4|Text', .001)
+
+        self.metrics.write()
+
+        self.assertEqual(self.metrics.sent, {})
+        self.assertEqual(self.metrics.bytes_sent, 0)
@@ -0,0 +1,135 @@
+from os import path
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest import TestCase
+
+from .. import profiling
+from ..profiling import Profiler, profiled, profiled_steps
+from .util import FakeTimer
+
+
+class ProfilerTests(TestCase):
+
+    def setUp(self):
+        self.timer = FakeTimer()
+        self.profiler = Profiler(timer=self.timer)
+        self.original_profiler = profiling.profiler
+        profiling.profiler = self.profiler
+        self.folder = mkdtemp('VimpairTests')
+
+    def tearDown(self):
+        self.profiler.stop()
+        profiling.profiler = self.original_profiler
+        rmtree(self.folder, True)
+
+    def _function_taking(self, duration, name='entry'):
+        @profiled(name)
+        def function(value):
+            self.timer.now += duration
+            return value
+        return function
+
+
+    def test_profiled_function_returns_its_result(self):
+        self.assertEqual(self._function_taking(.1)(42), 42)
+
+    def test_calls_are_not_recorded_without_running_profiler(self):
+        self._function_taking(.1)(42)
+
+        self.assertEqual(self.profiler.entry_points, {})
+
+    def test_calls_are_recorded_while_running(self):
+        function = self._function_taking(.002)
+        self.profiler.start()
+
+        function(1)
+        function(2)
+
+        stats = self.profiler.entry_points['entry']
+        self.assertEqual(stats.calls, 2)
+        self.assertAlmostEqual(stats.total, .004)
+        self.assertAlmostEqual(stats.max, .002)
+
+    def test_calls_raising_are_recorded(self):
+        @profiled('failing')
+        def function():
+            self.timer.now += .001
+            raise ValueError()
+        self.profiler.start()
+
+        with self.assertRaises(ValueError):
+            function()
+
+        self.assertEqual(self.profiler.entry_points['failing'].calls, 1)
+
+    def test_steps_are_recorded_one_at_a_time(self):
+        @profiled_steps('steps')
+        def steps():
+            for duration in (.001, .003):
+                self.timer.now += duration
+                yield
+            self.timer.now += .002
+        self.profiler.start()
+
+        self.assertEqual(len(list(steps())), 2)
+
+        stats = self.profiler.entry_points['steps']
+        # What's left after the last step counts as one more
+        self.assertEqual(stats.calls, 3)
+        self.assertAlmostEqual(stats.total, .006)
+        self.assertAlmostEqual(stats.max, .003)
+
+    def test_calls_after_stopping_are_not_recorded(self):
+        function = self._function_taking(.002)
+        self.profiler.start()
+        function(1)
+        self.profiler.stop()
+
+        function(2)
+
+        self.assertEqual(self.profiler.entry_points['entry'].calls, 1)
+
+    def test_starting_again_clears_recorded_calls(self):
+        function = self._function_taking(.002)
+        self.profiler.start()
+        function(1)
+        self.profiler.stop()
+
+        self.profiler.start()
+
+        self.assertEqual(self.profiler.entry_points, {})
+
+    def test_report_lists_entry_points_by_total_time(self):
+        self.profiler.start()
+        self._function_taking(.001, 'short')(1)
+        self._function_taking(.003, 'long')(1)
+        self.timer.now += .996
+        self.profiler.stop()
+
+        lines = self.profiler.report().splitlines()
+
+        self.assertTrue(lines[0].startswith('Vimpair profile of 1.0 s'))
+        self.assertTrue(lines[3].startswith('long '))
+        self.assertTrue(lines[3].endswith('0.3%'))
+        self.assertTrue(lines[4].startswith('short '))
+
+    def test_dump_writes_report_to_given_file(self):
+        self.profiler.start()
+        self._function_taking(.001)(1)
+        self.profiler.stop()
+        file_path = path.join(self.folder, 'profile.txt')
+
+        self.assertEqual(self.profiler.dump(file_path), file_path)
+        with open(file_path) as report_file:
+            self.assertEqual(report_file.read(), self.profiler.report())
+
+    def test_dump_adds_cprofile_statistics(self):
+        self.profiler.start(with_cprofile=True)
+        self._function_taking(.001)(1)
+        self.profiler.stop()
+        file_path = path.join(self.folder, 'profile.txt')
+
+        self.profiler.dump(file_path)
+
+        with open(file_path) as report_file:
+            self.assertIn('cumulative', report_file.read())
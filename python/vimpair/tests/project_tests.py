@@ -0,0 +1,90 @@
+from base64 import b64decode
+from os import makedirs, path
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest import TestCase
+
+from ..project import (
+    create_project_archive,
+    extract_project_archive,
+    project_files,
+    read_ignore_patterns,
+)
+
+
+class ProjectTests(TestCase):
+
+    def setUp(self):
+        self.folder = mkdtemp('VimpairTests')
+        self.root = path.join(self.folder, 'project')
+        self.destination = path.join(self.folder, 'session')
+        makedirs(self.destination)
+        self.write('main.py', 'print(1)')
+        self.write('lib/util.py', 'pass')
+        self.write('.git/config', '[core]')
+        self.write('lib/util.pyc', '')
+
+    def tearDown(self):
+        rmtree(self.folder, True)
+
+    def write(self, relative_path, contents):
+        file_path = path.join(self.root, relative_path)
+        if not path.exists(path.dirname(file_path)):
+            makedirs(path.dirname(file_path))
+        with open(file_path, 'w') as project_file:
+            project_file.write(contents)
+
+    def relative_project_files(self, *args):
+        return sorted(
+            path.relpath(path.join(folder, name), self.root)
+            for folder, name in project_files(self.root, *args)
+        )
+
+    def archive_and_extract(self, archive_name, **kwargs):
+        archive_path = path.join(self.folder, 'project.tar.gz')
+        with open(archive_path, 'wb') as archive_file:
+            archive_file.write(b64decode(
+                create_project_archive(self.root, archive_name, **kwargs)))
+        extract_project_archive(archive_path, self.destination)
+
+
+    def test_project_files_skip_ignored_files_and_folders(self):
+        self.assertEqual(
+            self.relative_project_files(),
+            ['lib/util.py', 'main.py'],
+        )
+
+    def test_project_files_skip_given_patterns(self):
+        self.assertEqual(self.relative_project_files(['lib', '.git']), ['main.py'])
+
+    def test_reads_simple_patterns_from_gitignore(self):
+        self.write('.gitignore', '# Comment\n/build/\n*.log\n!keep.log\n')
+
+        self.assertEqual(read_ignore_patterns(self.root), ['build', '*.log'])
+
+    def test_missing_gitignore_has_no_patterns(self):
+        self.assertEqual(read_ignore_patterns(self.root), [])
+
+    def test_archive_contains_files_under_given_names(self):
+        self.archive_and_extract(lambda name, folder: path.join('Folder', name))
+
+        with open(path.join(self.destination, 'Folder', 'util.py')) as extracted:
+            self.assertEqual(extracted.read(), 'pass')
+
+    def test_absolute_names_are_extracted_into_destination(self):
+        self.archive_and_extract(lambda name, folder: path.join(folder, name))
+
+        self.assertTrue(path.exists(
+            path.join(self.destination, self.root.lstrip('/'), 'main.py')
+        ))
+
+    def test_files_exceeding_total_size_are_left_out(self):
+        self.archive_and_extract(lambda name, folder: name, max_size=6)
+
+        self.assertTrue(path.exists(path.join(self.destination, 'util.py')))
+        self.assertFalse(path.exists(path.join(self.destination, 'main.py')))
+
+    def test_names_leaving_destination_are_skipped(self):
+        self.archive_and_extract(lambda name, folder: path.join('..', name))
+
+        self.assertFalse(path.exists(path.join(self.folder, 'main.py')))
@@ -1,24 +1,84 @@
 from unittest import TestCase
 from mock import Mock
 from ddt import data, ddt
+from mock import patch
 from os import path
 from hashlib import sha224
+from timeit import default_timer
 
-from .util import TestContext as TC
+from .util import FakeTimer, TestContext as TC
 from ..protocol import (
     CURSOR_POSITION_PREFIX,
+    FileTable,
     FULL_UPDATE_PREFIX,
     generate_contents_update_messages,
     generate_cursor_position_message,
     generate_file_change_message,
+    generate_file_register_message,
+    generate_file_switch_message,
+    generate_visible_lines_message,
     MessageHandler,
     UPDATE_START_PREFIX,
     UPDATE_PART_PREFIX,
     UPDATE_END_PREFIX,
     TAKE_CONTROL_MESSAGE,
+    VISIBLE_LINES_PREFIX,
     FILE_CHANGE_PREFIX,
+    FILE_REGISTER_PREFIX,
+    FILE_SWITCH_PREFIX,
     SAVE_FILE_MESSAGE,
+    HASH_TREE_PREFIX,
+    HASH_REQUEST_PREFIX,
+    HASH_NODES_PREFIX,
+    BLOCK_REQUEST_PREFIX,
+    SIGNATURES_PREFIX,
+    DELTA_PREFIX,
+    PROJECT_PART_PREFIX,
+    PROJECT_END_MESSAGE,
+    PROJECT_EXTRACTED_MESSAGE,
+    CONTENTS_VERSION_PREFIX,
+    LINES_DELTA_PREFIX,
+    SYNC_STATE_PREFIX,
+    RESYNC_REQUEST_MESSAGE,
+    INSERT_TEXT_PREFIX,
+    PEER_JOINED_MESSAGE,
+    LIMITS_PREFIX,
+    SEQUENCE_PREFIX,
+    PING_PREFIX,
+    PONG_PREFIX,
+    COMPRESSED_START_PREFIX,
+    HashTree,
+    MIN_MESSAGE_LENGTH,
+    apply_delta,
+    block_signatures,
+    compute_delta,
+    compute_line_delta,
+    contents_hash,
+    generate_contents_version_message,
+    generate_delta_message,
+    generate_inserted_text_message,
+    generate_join_session_message,
+    generate_limits_message,
+    generate_lines_delta_message,
+    generate_peer_joined_message,
+    generate_ping_message,
+    generate_pong_message,
+    generate_resync_request_message,
+    generate_sequence_message,
+    generate_sync_state_message,
+    generate_project_extracted_message,
+    generate_project_messages,
+    generate_signatures_message,
+    signature_block_size,
+    signatures_checksum,
+    parse_join_session_message,
+    split_complete_messages,
+    generate_block_request_message,
+    generate_hash_nodes_message,
+    generate_hash_request_message,
+    generate_hash_tree_message,
 )
+from ..protocol.delta import MAX_LEADING_UNMATCHED_BLOCKS
 
 
 def first(iterable):
@@ -34,28 +94,41 @@ class GenerateContentsUpdateMessageTests(TestCase):
     def test_returns_one_messages_if_contents_is_empty(self):
         self.assertEqual(
             generate_contents_update_messages(''),
-            ['VIMPAIR_FULL_UPDATE|0|'],
+            [b'VIMPAIR_FULL_UPDATE|0|'],
         )
 
     def test_contents_update_message_starts_with_expected_prefix(self):
         message = first(generate_contents_update_messages('Some contents'))
 
         # not checking for FULL_UPDATE_PREFIX to prevent false positives
-        self.assertTrue(message.startswith('VIMPAIR_FULL_UPDATE'), message)
+        self.assertTrue(message.startswith(b'VIMPAIR_FULL_UPDATE'), message)
 
     def test_contents_update_message_contains_content_length(self):
         length_offset = len(FULL_UPDATE_PREFIX)
 
         message = first(generate_contents_update_messages('Some contents'))
 
-        self.assertTrue(message[length_offset:].startswith('|13|'), message)
+        self.assertTrue(message[length_offset:].startswith(b'|13|'), message)
+
+    def test_length_counts_bytes_of_utf8_encoded_contents(self):
+        message = first(generate_contents_update_messages(u'\u00e4\u4e2d'))
+
+        self.assertEqual(message, b'VIMPAIR_FULL_UPDATE|5|\xc3\xa4\xe4\xb8\xad')
+
+    def test_encoded_contents_are_sent_as_they_are(self):
+        contents = u'Some \u00e4 contents'
+
+        self.assertEqual(
+            generate_contents_update_messages(contents.encode('utf-8')),
+            generate_contents_update_messages(contents),
+        )
 
     def test_linebreaks_are_counted_as_one_character_in_length(self):
         length_offset = len(FULL_UPDATE_PREFIX)
 
         message = first(generate_contents_update_messages('Some\ncontents'))
 
-        self.assertTrue(message[length_offset:].startswith('|13|'), message)
+        self.assertTrue(message[length_offset:].startswith(b'|13|'), message)
 
     def test_contents_update_message_ends_with_contents(self):
         length_offset = len(FULL_UPDATE_PREFIX) + 3
@@ -63,7 +136,7 @@ class GenerateContentsUpdateMessageTests(TestCase):
         message = first(generate_contents_update_messages('Some contents'))
 
         self.assertTrue(
-            message[length_offset:].startswith('|Some contents'),
+            message[length_offset:].startswith(b'|Some contents'),
             message
         )
 
@@ -83,10 +156,21 @@ class GenerateContentsUpdateMessageTests(TestCase):
             actual_num_parts
         )
 
+    def test_parts_contain_all_contents_if_last_part_is_full(self):
+        # 997 characters fit into the first part, 998 into the others
+        contents = ''.join(chr(ord('a') + index % 26) for index in range(2993))
+
+        messages = generate_contents_update_messages(contents)
+
+        self.assertEqual(
+            b''.join(message.split(b'|', 2)[2] for message in messages),
+            contents.encode('utf-8'),
+        )
+
     @data(
-        TC('start', index=0,  expected_prefix='VIMPAIR_CONTENTS_START'),
-        TC('part',  index=1,  expected_prefix='VIMPAIR_CONTENTS_PART'),
-        TC('end',   index=-1, expected_prefix='VIMPAIR_CONTENTS_END'),
+        TC('start', index=0,  expected_prefix=b'VIMPAIR_CONTENTS_START'),
+        TC('part',  index=1,  expected_prefix=b'VIMPAIR_CONTENTS_PART'),
+        TC('end',   index=-1, expected_prefix=b'VIMPAIR_CONTENTS_END'),
     )
     def test_multiple_messages_start_with_special_prefixes(self, context):
         messages = generate_contents_update_messages('#' * 2048)
@@ -99,19 +183,19 @@ class GenerateContentsUpdateMessageTests(TestCase):
             'start',
             index=0,
             length_offset=1 + len(UPDATE_START_PREFIX),
-            expected_length='997|'
+            expected_length=b'997|'
         ),
         TC(
             'part',
             index=1,
             length_offset=1 + len(UPDATE_PART_PREFIX),
-            expected_length='998|'
+            expected_length=b'998|'
         ),
         TC(
             'end',
             index=-1,
             length_offset=1 + len(UPDATE_END_PREFIX),
-            expected_length='55|'
+            expected_length=b'55|'
         ),
     )
     def test_multiple_messages_have_the_correct_length_of_the_contained_part(
@@ -139,26 +223,29 @@ class GenerateContentsUpdateMessageTests(TestCase):
             'start',
             index=0,
             length_offset=5 + len(UPDATE_START_PREFIX),
-            expected_start_and_end=('0','6'),
+            expected_start_and_end=(b'0', b'6'),
         ),
         TC(
             'part',
             index=1,
             length_offset=5 + len(UPDATE_PART_PREFIX),
-            expected_start_and_end=('7','4'),
+            expected_start_and_end=(b'7', b'4'),
         ),
         TC(
             'end',
             index=-1,
             length_offset=4 + len(UPDATE_END_PREFIX),
-            expected_start_and_end=('5','9'),
+            expected_start_and_end=(b'5', b'9'),
         ),
     )
     def test_multiple_messages_have_the_expected_contents(self, context):
         messages = generate_contents_update_messages('0123456789' * 201)
 
         message = messages[context.index]
-        actual_start_and_end = (message[context.length_offset], message[-1])
+        actual_start_and_end = (
+            message[context.length_offset:context.length_offset + 1],
+            message[-1:],
+        )
         self.assertEqual(
             actual_start_and_end,
             context.expected_start_and_end,
@@ -171,14 +258,14 @@ class GenerateCursorPositionMessageTests(TestCase):
     def assert_returns_zero_zero_with(self, line, column):
         message = generate_cursor_position_message(line, column)
 
-        self.assertTrue(message.endswith('|0|0'), message)
+        self.assertTrue(message.endswith(b'|0|1|0'), message)
 
 
     def test_message_starts_with_expected_prefix(self):
         message = generate_cursor_position_message(None, 0)
 
         # not checking for CURSOR_POSITION_PREFIX to prevent false positives
-        self.assertTrue(message.startswith('VIMPAIR_CURSOR_POSITION'), message)
+        self.assertTrue(message.startswith(b'VIMPAIR_CURSOR_POSITION'), message)
 
     def test_returns_zero_zero_if_line_is_none(self):
         self.assert_returns_zero_zero_with(None, 0)
@@ -195,12 +282,36 @@ class GenerateCursorPositionMessageTests(TestCase):
     def test_returned_message_contains_valid_line(self):
         message = generate_cursor_position_message(11, 0)
 
-        self.assertTrue(message.endswith('|11|0'), message)
+        self.assertTrue(message.endswith(b'|11|1|0'), message)
 
     def test_returned_message_contains_valid_column(self):
         message = generate_cursor_position_message(0, 111)
 
-        self.assertTrue(message.endswith('|0|111'), message)
+        self.assertTrue(message.endswith(b'|0|3|111'), message)
+
+
+class GenerateVisibleLinesMessageTests(TestCase):
+
+    def test_message_starts_with_expected_prefix(self):
+        message = generate_visible_lines_message(0, 0, [])
+
+        # not checking for VISIBLE_LINES_PREFIX to prevent false positives
+        self.assertTrue(message.startswith(b'VIMPAIR_VISIBLE_LINES'), message)
+
+    def test_message_contains_first_line_and_number_of_lines(self):
+        message = generate_visible_lines_message(10, 200, ['Line'])
+
+        self.assertTrue(message.endswith(b'|10|200|4|Line'), message)
+
+    def test_lines_are_joined_with_linebreaks(self):
+        message = generate_visible_lines_message(0, 2, ['One', 'Two'])
+
+        self.assertTrue(message.endswith(b'|7|One\nTwo'), message)
+
+    def test_message_has_zero_payload_for_no_lines(self):
+        message = generate_visible_lines_message(None, None, None)
+
+        self.assertTrue(message.endswith(b'|0|0|0|'), message)
 
 
 class GenerateFileChangeMessageTests(TestCase):
@@ -215,20 +326,20 @@ class GenerateFileChangeMessageTests(TestCase):
         message = generate_file_change_message('')
 
         # not checking for FILE_CHANGE_PREFIX to prevent false positives
-        self.assertTrue(message.startswith('VIMPAIR_FILE_CHANGE'), message)
+        self.assertTrue(message.startswith(b'VIMPAIR_FILE_CHANGE'), message)
 
     def test_message_has_zero_payload_for_empty_filename(self):
-        self.assert_filename_leads_to_payload_and_end('', '|0|')
+        self.assert_filename_leads_to_payload_and_end('', b'|0|')
 
     def test_message_has_correct_payload_for_non_empty_filename(self):
         filename = 'SomeFileName.ext'
-        self.assert_filename_leads_to_payload_and_end(filename, '|16|%s' % filename)
+        self.assert_filename_leads_to_payload_and_end(filename, b'|16|' + filename.encode('utf-8'))
 
     def test_message_treats_whitespaces_as_empty(self):
-        self.assert_filename_leads_to_payload_and_end('     ', '|0|')
+        self.assert_filename_leads_to_payload_and_end('     ', b'|0|')
 
     def test_message_treats_none_as_empty(self):
-        self.assert_filename_leads_to_payload_and_end(None, '|0|')
+        self.assert_filename_leads_to_payload_and_end(None, b'|0|')
 
     def test_calling_with_additional_path_adds_full_path_to_message(self):
         filename = 'SomeFileName.ext'
@@ -236,14 +347,17 @@ class GenerateFileChangeMessageTests(TestCase):
 
         message = generate_file_change_message(filename, folderpath=folderpath)
 
-        self.assertTrue(message.endswith(path.join(folderpath, filename)), message)
+        self.assertTrue(
+            message.endswith(path.join(folderpath, filename).encode('utf-8')),
+            message,
+        )
 
     def test_additional_path_not_added_when_filename_is_empty(self):
         folderpath = path.join('path', 'to', 'the', 'file')
 
         message = generate_file_change_message('', folderpath=folderpath)
 
-        self.assertTrue(message.endswith('|0|'), message)
+        self.assertTrue(message.endswith(b'|0|'), message)
 
     def test_path_is_concealed_with_hash_when_specified(self):
         filename = 'SomeFileName.ext'
@@ -256,17 +370,137 @@ class GenerateFileChangeMessageTests(TestCase):
         )
 
         concealed_path = sha224(folderpath.encode('utf-8')).hexdigest()
-        self.assertTrue(message.endswith(path.join(concealed_path, filename)), message)
+        self.assertTrue(
+            message.endswith(path.join(concealed_path, filename).encode('utf-8')),
+            message,
+        )
+
+
+class GenerateFileRegisterMessageTests(TestCase):
+
+    def test_message_starts_with_expected_prefix(self):
+        message = generate_file_register_message(0, '')
+
+        # not checking for FILE_REGISTER_PREFIX to prevent false positives
+        self.assertTrue(message.startswith(b'VIMPAIR_FILE_REGISTER'), message)
+
+    def test_message_contains_file_id_length_and_path(self):
+        message = generate_file_register_message(7, 'SomeFileName.ext')
+
+        self.assertTrue(message.endswith(b'|7|16|SomeFileName.ext'), message)
+
+    def test_message_treats_none_as_empty(self):
+        message = generate_file_register_message(0, None)
+
+        self.assertTrue(message.endswith(b'|0|0|'), message)
+
+
+class GenerateFileSwitchMessageTests(TestCase):
+
+    def test_message_starts_with_expected_prefix(self):
+        message = generate_file_switch_message(0)
+
+        # not checking for FILE_SWITCH_PREFIX to prevent false positives
+        self.assertTrue(message.startswith(b'VIMPAIR_FILE_SWITCH'), message)
+
+    def test_message_contains_only_file_id(self):
+        message = generate_file_switch_message(12)
+
+        self.assertTrue(message.endswith(b'_SWITCH|2|12'), message)
+
+
+class FileTableTests(TestCase):
+
+    def setUp(self):
+        self.table = FileTable()
+
+
+    def test_first_lookup_returns_path_of_file(self):
+        folderpath = path.join('path', 'to', 'the', 'file')
+
+        _, file_path = self.table.lookup('SomeFileName.ext', folderpath=folderpath)
+
+        self.assertEqual(file_path, path.join(folderpath, 'SomeFileName.ext'))
+
+    def test_repeated_lookup_returns_same_id_without_path(self):
+        first_id, _ = self.table.lookup('SomeFileName.ext')
+
+        file_id, file_path = self.table.lookup('SomeFileName.ext')
+
+        self.assertEqual((file_id, file_path), (first_id, None))
+
+    def test_different_files_get_different_ids(self):
+        first_id, _ = self.table.lookup('SomeFileName.ext')
+
+        other_id, _ = self.table.lookup('OtherFileName.ext')
+
+        self.assertNotEqual(first_id, other_id)
+
+    def test_same_filename_in_different_folders_gets_different_ids(self):
+        first_id, _ = self.table.lookup('SomeFileName.ext', folderpath='one')
+
+        other_id, _ = self.table.lookup('SomeFileName.ext', folderpath='two')
+
+        self.assertNotEqual(first_id, other_id)
+
+    def test_path_is_concealed_with_hash_when_specified(self):
+        folderpath = path.join('path', 'to', 'the', 'file')
+
+        _, file_path = self.table.lookup(
+            'SomeFileName.ext',
+            folderpath=folderpath,
+            conceal_path=True,
+        )
+
+        concealed_path = sha224(folderpath.encode('utf-8')).hexdigest()
+        self.assertEqual(file_path, path.join(concealed_path, 'SomeFileName.ext'))
+
+    def test_path_is_concealed_like_in_file_change_message(self):
+        folderpath = path.join('path', 'to', 'the', 'file')
+
+        _, file_path = self.table.lookup(
+            'SomeFileName.ext',
+            folderpath=folderpath,
+            conceal_path=True,
+        )
+
+        message = generate_file_change_message(
+            'SomeFileName.ext',
+            folderpath=folderpath,
+            conceal_path=True,
+        )
+        self.assertTrue(message.endswith(file_path.encode('utf-8')), message)
 
 
 class MockCallbacks(object):
 
     def __init__(self):
         self.update_contents = Mock()
+        self.update_visible_lines = Mock()
         self.apply_cursor_position = Mock()
         self.take_control = Mock()
         self.file_changed = Mock()
         self.save_file = Mock()
+        self.check_hash_tree = Mock()
+        self.compare_hash_nodes = Mock()
+        self.send_hash_nodes = Mock()
+        self.send_block = Mock()
+        self.send_signatures = Mock()
+        self.send_delta = Mock()
+        self.update_contents_from_delta = Mock()
+        self.receive_project_part = Mock()
+        self.extract_project = Mock()
+        self.project_extracted = Mock()
+        self.contents_version = Mock()
+        self.update_lines = Mock()
+        self.check_sync_state = Mock()
+        self.resync = Mock()
+        self.insert_text = Mock()
+        self.peer_joined = Mock()
+        self.peer_limits = Mock()
+        self.ping = Mock()
+        self.pong = Mock()
+        self.message_discarded = Mock()
 
 
 @ddt
@@ -316,16 +550,26 @@ class MessageHandlerFullUpdateTests(TestCase):
         TC('no_markers',         message=FULL_UPDATE_PREFIX + 'Contents.'),
         TC('incomplete_prefix',  message='IMPAIR_FULL_UPDATE|14|Some Contents.'),
         TC('incorrect_prefix',   message='VIMPAIR_DULL_UPDATE|14|Some Contents.'),
-        TC('other_valid_prefix', message=CURSOR_POSITION_PREFIX + '|1|1'),
+        TC('other_valid_prefix', message=CURSOR_POSITION_PREFIX + '|1|1|1'),
     )
     def test_does_not_call_update_contents(self, context):
         self.handler.process(context.message)
 
         self.callbacks.update_contents.assert_not_called()
 
+    def test_calls_update_contents_with_decoded_contents(self):
+        self.handler.process([FULL_UPDATE_PREFIX.encode('ascii') + b'|5|\xc3\xa4\xe4\xb8\xad'])
+
+        self.callbacks.update_contents.assert_called_with(u'\u00e4\u4e2d')
+
+    def test_invalid_utf8_is_replaced(self):
+        self.handler.process([FULL_UPDATE_PREFIX.encode('ascii') + b'|3|a\xffb'])
+
+        self.callbacks.update_contents.assert_called_with(u'a\ufffdb')
+
     def test_calls_update_contents_if_update_is_preceded_by_cursor_position(self):
         self.handler.process(
-            '%s|1|1%s|17|multiline\ncontent'
+            '%s|1|1|1%s|17|multiline\ncontent'
             % (CURSOR_POSITION_PREFIX, FULL_UPDATE_PREFIX)
         )
 
@@ -343,12 +587,12 @@ class MessageHandlerCursorPositionTests(TestCase):
     @data(
         TC(
             'single_digit_coordinates',
-            message=CURSOR_POSITION_PREFIX + '|1|1',
+            message=CURSOR_POSITION_PREFIX + '|1|1|1',
             expected_coordinates=(1,1)
         ),
         TC(
             'double_digit_coordinates',
-            message=CURSOR_POSITION_PREFIX + '|22|33',
+            message=CURSOR_POSITION_PREFIX + '|22|2|33',
             expected_coordinates=(22,33)
         ),
     )
@@ -360,27 +604,106 @@ class MessageHandlerCursorPositionTests(TestCase):
         )
 
     def test_calls_apply_cursor_position_for_multiple_values_in_one_message(self):
-        message = CURSOR_POSITION_PREFIX + '|0|1' \
-                + CURSOR_POSITION_PREFIX + '|0|2'
+        message = CURSOR_POSITION_PREFIX + '|0|1|1' \
+                + CURSOR_POSITION_PREFIX + '|0|1|2'
 
         self.handler.process(message)
 
         self.callbacks.apply_cursor_position.assert_called_with(0, 2)
 
+    def test_calls_apply_cursor_position_once_for_multiple_values_in_one_message(self):
+        message = CURSOR_POSITION_PREFIX + '|0|1|1' \
+                + CURSOR_POSITION_PREFIX + '|0|1|2' \
+                + CURSOR_POSITION_PREFIX + '|0|1|3'
+
+        self.handler.process(message)
+
+        self.callbacks.apply_cursor_position.assert_called_once_with(0, 3)
+
+    def test_applies_cursor_position_after_contents_update(self):
+        order = []
+        self.callbacks.apply_cursor_position.side_effect = \
+            lambda *a: order.append('cursor')
+        self.callbacks.update_contents.side_effect = \
+            lambda *a: order.append('contents')
+
+        self.handler.process(
+            CURSOR_POSITION_PREFIX + '|0|1|1'
+            + FULL_UPDATE_PREFIX + '|5|Short'
+        )
+
+        self.assertEqual(order, ['contents', 'cursor'])
+
+    def test_applies_cursor_position_again_after_contents_received_later(self):
+        applied = []
+        lines = []
+        self.callbacks.apply_cursor_position.side_effect = \
+            lambda line, column: applied.append((line, column, line < len(lines)))
+        self.callbacks.update_contents.side_effect = \
+            lambda contents: lines.extend(contents.split('\n'))
+
+        self.handler.process(CURSOR_POSITION_PREFIX + '|40|1|0')
+        contents = '\n'.join(50 * ['Line'])
+        self.handler.process(FULL_UPDATE_PREFIX + '|%d|%s' % (len(contents), contents))
+
+        self.assertEqual(applied, [(40, 0, False), (40, 0, True)])
+
+    def test_unchanged_cursor_position_is_not_applied_again_without_actions(self):
+        self.handler.process(CURSOR_POSITION_PREFIX + '|0|1|1')
+
+        self.handler.process([])
+
+        self.callbacks.apply_cursor_position.assert_called_once_with(0, 1)
+
+    def test_does_not_apply_cursor_position_received_before_file_change(self):
+        self.handler.process(
+            CURSOR_POSITION_PREFIX + '|0|1|1'
+            + '%s|0|13|ATextFile.txt' % FILE_REGISTER_PREFIX
+        )
+
+        self.callbacks.apply_cursor_position.assert_not_called()
+
+    def test_applies_cursor_position_received_after_file_change(self):
+        self.handler.process(
+            '%s|0|13|ATextFile.txt' % FILE_REGISTER_PREFIX
+            + CURSOR_POSITION_PREFIX + '|0|1|1'
+        )
+
+        self.callbacks.apply_cursor_position.assert_called_once_with(0, 1)
+
+    def test_applies_cursor_position_in_each_call_to_process(self):
+        self.handler.process(CURSOR_POSITION_PREFIX + '|0|1|1')
+
+        self.handler.process(CURSOR_POSITION_PREFIX + '|0|1|1')
+
+        self.assertEqual(self.callbacks.apply_cursor_position.call_count, 2)
+
+    def test_applies_cursor_position_before_taking_control(self):
+        order = []
+        self.callbacks.apply_cursor_position.side_effect = \
+            lambda *a: order.append('cursor')
+        self.callbacks.take_control.side_effect = \
+            lambda *a: order.append('take_control')
+
+        self.handler.process(CURSOR_POSITION_PREFIX + '|0|1|1' + TAKE_CONTROL_MESSAGE)
+
+        self.assertEqual(order, ['cursor', 'take_control'])
+
     @data(
         TC('empty_message',       message=''),
-        TC('nonnumeric_line',     message=CURSOR_POSITION_PREFIX + '|one|1'),
-        TC('nonnumeric_column',   message=CURSOR_POSITION_PREFIX + '|1|one'),
-        TC('empty_line',          message=CURSOR_POSITION_PREFIX + '||1'),
-        TC('empty_column',        message=CURSOR_POSITION_PREFIX + '|1|'),
-        TC('missing_1st_marker',  message=CURSOR_POSITION_PREFIX + '|1'),
-        TC('missing_2nd_marker',  message=CURSOR_POSITION_PREFIX + '|11'),
-        TC('no_markers',          message=CURSOR_POSITION_PREFIX + '11'),
-        TC('incomplete_prefix',   message='IMPAIR_CURSOR_POSITION|1|1'),
-        TC('incorrect_prefix',    message='VIMPAIR_TURSOR_POSITION|1|1'),
-        TC('negative_line',       message=CURSOR_POSITION_PREFIX + '|-1|1'),
-        TC('negative_column',     message=CURSOR_POSITION_PREFIX + '|1|-1'),
-        TC('float_line_number',   message=CURSOR_POSITION_PREFIX + '|1.0|1'),
+        TC('nonnumeric_line',     message=CURSOR_POSITION_PREFIX + '|one|1|1'),
+        TC('nonnumeric_column',   message=CURSOR_POSITION_PREFIX + '|1|3|one'),
+        TC('empty_line',          message=CURSOR_POSITION_PREFIX + '||1|1'),
+        TC('empty_column',        message=CURSOR_POSITION_PREFIX + '|1|0|'),
+        TC('missing_1st_marker',  message=CURSOR_POSITION_PREFIX + '1|1|1'),
+        TC('missing_2nd_marker',  message=CURSOR_POSITION_PREFIX + '|11|1'),
+        TC('missing_3rd_marker',  message=CURSOR_POSITION_PREFIX + '|1|11'),
+        TC('no_markers',          message=CURSOR_POSITION_PREFIX + '111'),
+        TC('incomplete_prefix',   message='IMPAIR_CURSOR_POSITION|1|1|1'),
+        TC('incorrect_prefix',    message='VIMPAIR_TURSOR_POSITION|1|1|1'),
+        TC('negative_line',       message=CURSOR_POSITION_PREFIX + '|-1|1|1'),
+        TC('negative_column',     message=CURSOR_POSITION_PREFIX + '|1|2|-1'),
+        TC('float_line_number',   message=CURSOR_POSITION_PREFIX + '|1.0|1|1'),
         TC('other_valid_prefix',  message=FULL_UPDATE_PREFIX + '|14|Some Contents.'),
     )
     def test_does_not_call_apply_cursor_position(self, context):
@@ -416,6 +739,14 @@ class MessageHandlerSplitContentsTests(TestCase):
 
         self.callbacks.update_contents.assert_called_with('First part of a longer message.')
 
+    def test_characters_split_between_parts_are_joined(self):
+        contents = u'\u00e4\u4e2d' * 1000
+
+        for message in generate_contents_update_messages(contents):
+            self.handler.process([message])
+
+        self.callbacks.update_contents.assert_called_once_with(contents)
+
     def test_calls_update_contents_once_when_receiving_matching_end(self):
         for message in (
             UPDATE_START_PREFIX + '|15|First part of a',
@@ -471,7 +802,6 @@ class MessageHandlerSplitContentsTests(TestCase):
 
     @data(
         TC('full_update', interrupting_message=FULL_UPDATE_PREFIX + '|5|Short'),
-        TC('cursor',      interrupting_message=CURSOR_POSITION_PREFIX + '|1|1'),
         TC('take_control',interrupting_message=TAKE_CONTROL_MESSAGE),
     )
     def test_does_not_call_update_contents_if_other_message_received_before_end(
@@ -490,6 +820,18 @@ class MessageHandlerSplitContentsTests(TestCase):
 
         self.callbacks.update_contents.assert_not_called()
 
+    def test_cursor_position_received_before_end_does_not_cancel_update(self):
+        for message in (
+            UPDATE_START_PREFIX + '|2|1 ',
+            CURSOR_POSITION_PREFIX + '|1|1|1',
+            UPDATE_PART_PREFIX + '|2|2 ',
+            CURSOR_POSITION_PREFIX + '|1|1|2',
+            UPDATE_END_PREFIX + '|1|3',
+        ):
+            self.handler.process(message)
+
+        self.callbacks.update_contents.assert_called_once_with('1 2 3')
+
     def test_previous_end_is_not_used_with_next_start(self):
         message = UPDATE_END_PREFIX + '|1|0' \
             + UPDATE_START_PREFIX + '|2|1 ' \
@@ -518,7 +860,7 @@ class MessageHandlerSplitMessageTests(TestCase):
     def test_interleaved_message_cancels_split_message(self):
         message = FULL_UPDATE_PREFIX + '|5|Short'
         self.handler.process(message[:8])
-        self.handler.process(CURSOR_POSITION_PREFIX + '|1|1')
+        self.handler.process(CURSOR_POSITION_PREFIX + '|1|1|1')
 
         self.handler.process(message[8:])
 
@@ -526,7 +868,7 @@ class MessageHandlerSplitMessageTests(TestCase):
 
     def test_interleaved_split_message_cancels_first_split_message(self):
         message1 = FULL_UPDATE_PREFIX + '|5|Short'
-        message2 = CURSOR_POSITION_PREFIX + '|1|1'
+        message2 = CURSOR_POSITION_PREFIX + '|1|1|1'
         for part in (message1[:8], message2[:8], message2[8:]):
             self.handler.process(part)
 
@@ -557,7 +899,7 @@ class MessageHandlerTakeControlTests(TestCase):
         ),
         TC(
             'cursor',
-            message=CURSOR_POSITION_PREFIX + '|1|1',
+            message=CURSOR_POSITION_PREFIX + '|1|1|1',
             expected_callback=lambda s: s.apply_cursor_position,
         ),
     )
@@ -576,7 +918,7 @@ class MessageHandlerTakeControlTests(TestCase):
         ),
         TC(
             'cursor',
-            message=CURSOR_POSITION_PREFIX + '|1|1',
+            message=CURSOR_POSITION_PREFIX + '|1|1|1',
             expected_callback=lambda s: s.apply_cursor_position,
         ),
     )
@@ -595,7 +937,7 @@ class MessageHandlerTakeControlTests(TestCase):
         ),
         TC(
             'cursor',
-            message=CURSOR_POSITION_PREFIX + '|1|1',
+            message=CURSOR_POSITION_PREFIX + '|1|1|1',
             expected_callback=lambda s: s.apply_cursor_position,
         ),
     )
@@ -607,6 +949,33 @@ class MessageHandlerTakeControlTests(TestCase):
         context.expected_callback(self.callbacks).assert_not_called()
 
 
+class MessageHandlerVisibleLinesTests(TestCase):
+
+    def setUp(self):
+        self.callbacks = MockCallbacks()
+        self.handler = MessageHandler(callbacks=self.callbacks)
+
+
+    def test_calls_update_visible_lines_with_received_values(self):
+        self.handler.process(VISIBLE_LINES_PREFIX + '|10|200|8|One\nTwo.')
+
+        self.callbacks.update_visible_lines.assert_called_with(10, 200, 'One\nTwo.')
+
+    def test_does_not_call_update_visible_lines_for_incomplete_contents(self):
+        self.handler.process(VISIBLE_LINES_PREFIX + '|10|200|80|One\nTwo.')
+
+        self.callbacks.update_visible_lines.assert_not_called()
+
+    def test_following_update_is_applied_after_visible_lines(self):
+        self.handler.process(
+            VISIBLE_LINES_PREFIX + '|0|2|3|One'
+            + UPDATE_START_PREFIX + '|4|One\n'
+            + UPDATE_END_PREFIX + '|3|Two'
+        )
+
+        self.callbacks.update_contents.assert_called_once_with('One\nTwo')
+
+
 class MessageHandlerFileChangeTests(TestCase):
 
     def setUp(self):
@@ -627,6 +996,186 @@ class MessageHandlerFileChangeTests(TestCase):
         self.callbacks.file_changed.assert_called_with(filename=filename)
 
 
+class MessageHandlerFileTableTests(TestCase):
+
+    def setUp(self):
+        self.callbacks = MockCallbacks()
+        self.handler = MessageHandler(callbacks=self.callbacks)
+
+
+    def test_calls_file_changed_with_registered_filename(self):
+        self.handler.process('%s|0|13|ATextFile.txt' % FILE_REGISTER_PREFIX)
+
+        self.callbacks.file_changed.assert_called_with(filename='ATextFile.txt')
+
+    def test_calls_file_changed_with_filename_for_known_file_id(self):
+        self.handler.process(
+            '%s|0|13|ATextFile.txt' % FILE_REGISTER_PREFIX
+            + '%s|1|13|OtherFile.txt' % FILE_REGISTER_PREFIX
+        )
+
+        self.handler.process('%s|1|0' % FILE_SWITCH_PREFIX)
+
+        self.callbacks.file_changed.assert_called_with(filename='ATextFile.txt')
+
+    def test_does_not_call_file_changed_for_unknown_file_id(self):
+        self.handler.process('%s|1|5' % FILE_SWITCH_PREFIX)
+
+        self.callbacks.file_changed.assert_not_called()
+
+    def test_registering_known_file_id_again_replaces_filename(self):
+        self.handler.process('%s|0|13|ATextFile.txt' % FILE_REGISTER_PREFIX)
+        self.handler.process('%s|0|13|OtherFile.txt' % FILE_REGISTER_PREFIX)
+
+        self.handler.process('%s|1|0' % FILE_SWITCH_PREFIX)
+
+        self.callbacks.file_changed.assert_called_with(filename='OtherFile.txt')
+
+    def test_file_id_split_between_receptions_is_read_completely(self):
+        self.handler.process('%s|1|9|File1.txt' % FILE_REGISTER_PREFIX)
+        self.handler.process('%s|12|10|File12.txt' % FILE_REGISTER_PREFIX)
+
+        self.handler.process('%s|2|1' % FILE_SWITCH_PREFIX)
+        self.handler.process('2')
+
+        self.callbacks.file_changed.assert_called_with(filename='File12.txt')
+
+    def test_file_switch_cancels_split_update(self):
+        for message in (
+            UPDATE_START_PREFIX + '|2|1 ',
+            '%s|0|13|ATextFile.txt' % FILE_REGISTER_PREFIX,
+            '%s|1|0' % FILE_SWITCH_PREFIX,
+            UPDATE_END_PREFIX + '|1|3',
+        ):
+            self.handler.process(message)
+
+        self.callbacks.update_contents.assert_not_called()
+
+
+class MessageHandlerTimeBudgetTests(TestCase):
+
+    STEP_DURATION = .01
+
+    def setUp(self):
+        self.clock = FakeTimer()
+        patcher = patch(
+            'vimpair.protocol.handle_messages.default_timer',
+            new=self.clock,
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.applied_parts = []
+        self.callbacks = MockCallbacks()
+        self.callbacks.update_contents_in_steps = self.update_contents_in_steps
+        self.handler = MessageHandler(callbacks=self.callbacks, time_budget=15)
+
+    def update_contents_in_steps(self, contents):
+        for part in contents.split(' '):
+            self.applied_parts.append(part)
+            self.clock.now += self.STEP_DURATION
+            yield
+
+
+    def test_applies_update_partially_when_exceeding_time_budget(self):
+        self.handler.process(FULL_UPDATE_PREFIX + '|5|1 2 3')
+
+        self.assertEqual(self.applied_parts, ['1', '2'])
+
+    def test_continues_update_with_next_call(self):
+        self.handler.process(FULL_UPDATE_PREFIX + '|5|1 2 3')
+
+        self.handler.process([])
+
+        self.assertEqual(self.applied_parts, ['1', '2', '3'])
+
+    def test_update_is_not_applied_with_update_contents(self):
+        self.handler.process(FULL_UPDATE_PREFIX + '|5|1 2 3')
+
+        self.callbacks.update_contents.assert_not_called()
+
+    def test_messages_after_update_wait_for_update_to_finish(self):
+        self.handler.process(
+            FULL_UPDATE_PREFIX + '|5|1 2 3'
+            + '%s|0|13|ATextFile.txt' % FILE_REGISTER_PREFIX
+        )
+
+        self.callbacks.file_changed.assert_not_called()
+
+    def test_messages_after_update_are_applied_once_update_is_finished(self):
+        self.handler.process(
+            FULL_UPDATE_PREFIX + '|5|1 2 3'
+            + '%s|0|13|ATextFile.txt' % FILE_REGISTER_PREFIX
+        )
+
+        self.handler.process([])
+
+        self.callbacks.file_changed.assert_called_with(filename='ATextFile.txt')
+
+    def test_messages_received_later_are_applied_after_pending_update(self):
+        self.handler.process(FULL_UPDATE_PREFIX + '|5|1 2 3')
+
+        self.handler.process(FULL_UPDATE_PREFIX + '|3|4 5')
+
+        self.assertEqual(self.applied_parts, ['1', '2', '3', '4'])
+
+    def test_latest_cursor_position_is_applied_while_update_is_pending(self):
+        self.handler.process(
+            FULL_UPDATE_PREFIX + '|5|1 2 3'
+            + CURSOR_POSITION_PREFIX + '|1|1|1'
+            + CURSOR_POSITION_PREFIX + '|2|1|2'
+        )
+
+        self.callbacks.apply_cursor_position.assert_called_once_with(2, 2)
+
+    def test_is_applying_while_update_is_pending(self):
+        self.handler.process(FULL_UPDATE_PREFIX + '|5|1 2 3')
+        applying_while_pending = self.handler.is_applying
+
+        self.handler.process([])
+
+        self.assertEqual((applying_while_pending, self.handler.is_applying), (True, False))
+
+    def test_applies_all_messages_within_time_budget(self):
+        self.handler.process(
+            FULL_UPDATE_PREFIX + '|1|1'
+            + '%s|0|13|ATextFile.txt' % FILE_REGISTER_PREFIX
+        )
+
+        self.callbacks.file_changed.assert_called_with(filename='ATextFile.txt')
+
+
+class MessageHandlerMetricsTests(TestCase):
+
+    def setUp(self):
+        self.metrics = Mock()
+        self.handler = MessageHandler(callbacks=MockCallbacks(), metrics=self.metrics)
+
+
+    def test_reports_type_of_each_decoded_message(self):
+        self.handler.process([
+            FULL_UPDATE_PREFIX + '|4|Text',
+            CURSOR_POSITION_PREFIX + '|1|1|2',
+        ])
+
+        self.assertEqual(
+            [args[0] for args, _ in self.metrics.message_received.call_args_list],
+            [FULL_UPDATE_PREFIX, CURSOR_POSITION_PREFIX],
+        )
+
+    def test_reports_size_of_processed_data(self):
+        message = FULL_UPDATE_PREFIX + '|4|Text'
+
+        self.handler.process([message])
+
+        self.assertEqual(self.metrics.data_processed.call_args[0][0], len(message))
+
+    def test_incomplete_messages_are_not_reported(self):
+        self.handler.process([FULL_UPDATE_PREFIX + '|4|Te'])
+
+        self.metrics.message_received.assert_not_called()
+
+
 class MessageHandlerSaveFileTests(TestCase):
 
     def setUp(self):
@@ -655,3 +1204,816 @@ class MessageHandlerSaveFileTests(TestCase):
         )
 
         self.callbacks.update_contents.assert_called_once_with('1 2')
+
+
+class GenerateHashMessagesTests(TestCase):
+
+    def test_hash_tree_message_contains_lines_levels_and_root(self):
+        message = generate_hash_tree_message(200, 2, 'abcd')
+
+        # not checking for HASH_TREE_PREFIX to prevent false positives
+        self.assertEqual(message, b'VIMPAIR_HASH_TREE|200|2|4|abcd')
+
+    def test_hash_request_message_contains_level_and_index(self):
+        message = generate_hash_request_message(1, 3)
+
+        # not checking for HASH_REQUEST_PREFIX to prevent false positives
+        self.assertEqual(message, b'VIMPAIR_HASH_REQUEST|1|1|3')
+
+    def test_hash_nodes_message_contains_concatenated_hashes(self):
+        message = generate_hash_nodes_message(1, 0, ['ab', 'cd'])
+
+        # not checking for HASH_NODES_PREFIX to prevent false positives
+        self.assertEqual(message, b'VIMPAIR_HASH_NODES|1|0|4|abcd')
+
+    def test_block_request_message_contains_block_index(self):
+        message = generate_block_request_message(5)
+
+        # not checking for BLOCK_REQUEST_PREFIX to prevent false positives
+        self.assertEqual(message, b'VIMPAIR_BLOCK_REQUEST|1|5')
+
+
+class HashTreeTests(TestCase):
+
+    def lines(self, number_of_lines):
+        return ['Line %d' % index for index in range(number_of_lines)]
+
+
+    def test_single_block_has_single_level(self):
+        tree = HashTree(self.lines(10), block_size=16)
+
+        self.assertEqual(tree.levels, 1)
+        self.assertEqual(tree.number_of_blocks, 1)
+
+    def test_levels_grow_with_number_of_blocks(self):
+        tree = HashTree(self.lines(40), block_size=2, fanout=4)
+
+        # 20 blocks -> 5 nodes -> 2 nodes -> root
+        self.assertEqual(tree.levels, 4)
+
+    def test_same_lines_have_same_root(self):
+        self.assertEqual(
+            HashTree(self.lines(100), block_size=8).root,
+            HashTree(self.lines(100), block_size=8).root,
+        )
+
+    def test_changed_line_changes_root(self):
+        lines = self.lines(100)
+        changed_lines = self.lines(100)
+        changed_lines[50] = 'Changed'
+
+        self.assertNotEqual(
+            HashTree(lines, block_size=8).root,
+            HashTree(changed_lines, block_size=8).root,
+        )
+
+    def test_missing_empty_lines_change_root(self):
+        self.assertNotEqual(
+            HashTree(['a', ''], block_size=8).root,
+            HashTree(['a'], number_of_lines=2, block_size=8).root,
+        )
+
+    def test_lines_beyond_number_of_lines_are_ignored(self):
+        self.assertEqual(
+            HashTree(['a', 'b'], block_size=8).root,
+            HashTree(['a', 'b', 'c'], number_of_lines=2, block_size=8).root,
+        )
+
+    def test_children_of_root_are_nodes_of_level_below(self):
+        tree = HashTree(self.lines(40), block_size=4, fanout=4)
+
+        self.assertEqual(len(tree.children(tree.levels - 1, 0)), 3)
+
+    def test_children_of_leaf_are_empty(self):
+        tree = HashTree(self.lines(40), block_size=4, fanout=4)
+
+        self.assertEqual(tree.children(0, 0), [])
+
+    def test_mismatching_children_point_to_changed_block(self):
+        lines = self.lines(64)
+        changed_lines = self.lines(64)
+        changed_lines[37] = 'Changed'
+        tree = HashTree(lines, block_size=4, fanout=4)
+        changed_tree = HashTree(changed_lines, block_size=4, fanout=4)
+
+        level, index = tree.levels - 1, 0
+        while level > 0:
+            index, = changed_tree.mismatching_children(
+                level, index, tree.children(level, index))
+            level -= 1
+
+        self.assertEqual(changed_tree.block_lines(index), (36, 40))
+
+    def test_missing_hashes_count_as_mismatching(self):
+        tree = HashTree(self.lines(16), block_size=4, fanout=4)
+
+        self.assertEqual(tree.mismatching_children(1, 0, []), [0, 1, 2, 3])
+
+    def test_last_block_ends_with_last_line(self):
+        tree = HashTree(self.lines(10), block_size=4)
+
+        self.assertEqual(tree.block_lines(2), (8, 10))
+
+
+class MessageHandlerHashTreeTests(TestCase):
+
+    def setUp(self):
+        self.callbacks = MockCallbacks()
+        self.handler = MessageHandler(callbacks=self.callbacks)
+
+
+    def test_calls_check_hash_tree_with_lines_levels_and_root(self):
+        self.handler.process(HASH_TREE_PREFIX + '|200|2|4|abcd')
+
+        self.callbacks.check_hash_tree.assert_called_with(200, 2, 'abcd')
+
+    def test_calls_send_hash_nodes_for_hash_request(self):
+        self.handler.process(HASH_REQUEST_PREFIX + '|1|1|3')
+
+        self.callbacks.send_hash_nodes.assert_called_with(1, 3)
+
+    def test_calls_compare_hash_nodes_with_split_hashes(self):
+        first_hash, second_hash = 16 * 'a', 16 * 'b'
+
+        self.handler.process(
+            HASH_NODES_PREFIX + '|1|2|32|' + first_hash + second_hash
+        )
+
+        self.callbacks.compare_hash_nodes.assert_called_with(
+            1, 2, [first_hash, second_hash])
+
+    def test_calls_send_block_for_block_request(self):
+        self.handler.process(BLOCK_REQUEST_PREFIX + '|1|5')
+
+        self.callbacks.send_block.assert_called_with(5)
+
+    def test_block_index_split_between_receptions_is_read_completely(self):
+        self.handler.process(BLOCK_REQUEST_PREFIX + '|2|1')
+        self.handler.process('2')
+
+        self.callbacks.send_block.assert_called_once_with(12)
+
+    def test_hash_tree_is_checked_after_preceding_update(self):
+        calls = []
+        self.callbacks.update_contents.side_effect = \
+            lambda *a: calls.append('update')
+        self.callbacks.check_hash_tree.side_effect = \
+            lambda *a: calls.append('check')
+
+        self.handler.process(
+            FULL_UPDATE_PREFIX + '|3|abc' + HASH_TREE_PREFIX + '|1|1|4|abcd'
+        )
+
+        self.assertEqual(calls, ['update', 'check'])
+
+
+class DeltaTests(TestCase):
+
+    def setUp(self):
+        self.old_contents = ''.join('Line %04d\n' % index for index in range(1000))
+
+    def rebuild(self, contents, block_size=64):
+        signatures = block_signatures(self.old_contents, block_size)
+        delta = compute_delta(contents, block_size, signatures)
+        return delta, apply_delta(self.old_contents, block_size, delta)
+
+
+    def test_block_size_grows_with_square_root_of_length(self):
+        self.assertEqual(signature_block_size(10), 256)
+        self.assertEqual(signature_block_size(1000000), 1000)
+
+    def test_signatures_cover_complete_blocks(self):
+        self.assertEqual(len(block_signatures(130 * 'x', 64)), 2)
+
+    def test_unchanged_contents_are_sent_as_block_references(self):
+        delta, rebuilt = self.rebuild(self.old_contents)
+
+        self.assertEqual(rebuilt, self.old_contents)
+        # All complete blocks in one reference, plus the incomplete last block
+        self.assertTrue(len(delta) < 40, delta)
+
+    def test_inserted_text_is_sent_as_literal(self):
+        contents = self.old_contents[:5000] + u'Inserted \u00e4' + self.old_contents[5000:]
+
+        delta, rebuilt = self.rebuild(contents)
+
+        self.assertEqual(rebuilt, contents)
+        self.assertIn(u'Inserted \u00e4', delta)
+        self.assertTrue(len(delta) < 200, delta)
+
+    def test_removed_text_is_skipped(self):
+        contents = self.old_contents[:3000] + self.old_contents[4000:]
+
+        delta, rebuilt = self.rebuild(contents)
+
+        self.assertEqual(rebuilt, contents)
+        self.assertTrue(len(delta) < 200, delta)
+
+    def test_no_delta_is_computed_without_signatures(self):
+        self.assertIsNone(compute_delta('New contents', 64, []))
+
+    def test_delta_larger_than_max_size_is_dropped(self):
+        signatures = block_signatures(self.old_contents, 64)
+
+        self.assertIsNone(compute_delta(1000 * 'x', 64, signatures, max_size=500))
+
+    def test_no_delta_is_computed_if_first_blocks_dont_match(self):
+        signatures = block_signatures(self.old_contents, 64)
+        contents = (MAX_LEADING_UNMATCHED_BLOCKS + 1) * 64 * 'x' + self.old_contents
+
+        self.assertIsNone(compute_delta(contents, 64, signatures))
+
+    def test_unrelated_contents_are_given_up_on_quickly(self):
+        signatures = block_signatures(self.old_contents, 1024)
+        contents = 1024 * 1024 * 'x'
+        start = default_timer()
+
+        delta = compute_delta(contents, 1024, signatures)
+
+        self.assertIsNone(delta)
+        self.assertLess(default_timer() - start, .1)
+
+    def test_signatures_checksum_tells_signatures_apart(self):
+        signatures = block_signatures(self.old_contents, 64)
+        other_signatures = block_signatures(self.old_contents[1:], 64)
+
+        self.assertEqual(signatures_checksum(signatures), signatures_checksum(list(signatures)))
+        self.assertNotEqual(signatures_checksum(signatures), signatures_checksum(other_signatures))
+
+    def test_malformed_delta_raises_value_error(self):
+        with self.assertRaises(ValueError):
+            apply_delta(self.old_contents, 64, 'X1|')
+
+
+class GenerateDeltaMessagesTests(TestCase):
+
+    def test_signatures_message_contains_file_id_block_size_and_signatures(self):
+        message = generate_signatures_message(3, 256, ['ab', 'cd'])
+
+        # not checking for SIGNATURES_PREFIX to prevent false positives
+        self.assertEqual(message, b'VIMPAIR_SIGNATURES|3|256|4|abcd')
+
+    def test_delta_message_contains_file_id_block_size_checksum_and_delta(self):
+        message = generate_delta_message(3, 256, 42, 'B0,2|')
+
+        # not checking for DELTA_PREFIX to prevent false positives
+        self.assertEqual(message, b'VIMPAIR_DELTA|3|256|42|5|B0,2|')
+
+
+class MessageHandlerDeltaTests(TestCase):
+
+    def setUp(self):
+        self.callbacks = MockCallbacks()
+        self.handler = MessageHandler(callbacks=self.callbacks)
+
+
+    def test_sends_signatures_after_switching_to_known_file(self):
+        self.handler.process('%s|0|13|ATextFile.txt' % FILE_REGISTER_PREFIX)
+        self.callbacks.send_signatures.assert_not_called()
+
+        self.handler.process('%s|1|0' % FILE_SWITCH_PREFIX)
+
+        self.callbacks.send_signatures.assert_called_with(0)
+
+    def test_doesnt_send_signatures_for_unknown_file(self):
+        self.handler.process('%s|1|0' % FILE_SWITCH_PREFIX)
+
+        self.callbacks.send_signatures.assert_not_called()
+
+    def test_calls_send_delta_with_split_signatures(self):
+        first, second = 16 * 'a', 16 * 'b'
+
+        self.handler.process(SIGNATURES_PREFIX + '|1|256|32|' + first + second)
+
+        self.callbacks.send_delta.assert_called_with(1, 256, [first, second])
+
+    def test_calls_update_contents_from_delta(self):
+        self.handler.process(DELTA_PREFIX + '|1|256|42|5|B0,2|')
+
+        self.callbacks.update_contents_from_delta.assert_called_with(1, 256, 42, 'B0,2|')
+
+
+class GenerateProjectMessagesTests(TestCase):
+
+    def test_archive_is_split_into_parts(self):
+        messages = generate_project_messages('abcdefg', 3)
+
+        # not checking for PROJECT_PART_PREFIX to prevent false positives
+        self.assertEqual(messages[:3], [
+            b'VIMPAIR_PROJECT_PART|3|abc',
+            b'VIMPAIR_PROJECT_PART|3|def',
+            b'VIMPAIR_PROJECT_PART|1|g',
+        ])
+
+    def test_last_message_ends_project(self):
+        messages = generate_project_messages('abc', 3)
+
+        # not checking for PROJECT_END_MESSAGE to prevent false positives
+        self.assertEqual(messages[-1], b'VIMPAIR_PROJECT_END')
+
+    def test_project_extracted_message(self):
+        # not checking for PROJECT_EXTRACTED_MESSAGE to prevent false positives
+        self.assertEqual(
+            generate_project_extracted_message(), b'VIMPAIR_PROJECT_EXTRACTED')
+
+
+class MessageHandlerProjectTests(TestCase):
+
+    def setUp(self):
+        self.callbacks = MockCallbacks()
+        self.handler = MessageHandler(callbacks=self.callbacks)
+
+
+    def test_calls_receive_project_part_with_data(self):
+        self.handler.process(PROJECT_PART_PREFIX + '|3|abc')
+
+        self.callbacks.receive_project_part.assert_called_with(b'abc')
+
+    def test_calls_extract_project_at_end(self):
+        self.handler.process(PROJECT_END_MESSAGE)
+
+        self.callbacks.extract_project.assert_called_with()
+
+    def test_calls_project_extracted_for_acknowledgment(self):
+        self.handler.process(PROJECT_EXTRACTED_MESSAGE)
+
+        self.callbacks.project_extracted.assert_called_with()
+
+    def test_sends_signatures_for_registered_file_after_project(self):
+        self.handler.process(PROJECT_END_MESSAGE)
+
+        self.handler.process('%s|0|13|ATextFile.txt' % FILE_REGISTER_PREFIX)
+
+        self.callbacks.send_signatures.assert_called_with(0)
+
+
+class LineDeltaTests(TestCase):
+
+    def test_unchanged_lines_give_empty_delta(self):
+        self.assertEqual(compute_line_delta(['1', '2'], ['1', '2']), (2, 0, []))
+
+    def test_changed_line_is_replaced(self):
+        self.assertEqual(
+            compute_line_delta(['1', '2', '3'], ['1', 'Two', '3']),
+            (1, 1, ['Two']),
+        )
+
+    def test_inserted_lines_remove_nothing(self):
+        self.assertEqual(
+            compute_line_delta(['1', '3'], ['1', '2', '2', '3']),
+            (1, 0, ['2', '2']),
+        )
+
+    def test_removed_lines_add_nothing(self):
+        self.assertEqual(compute_line_delta(['1', '2', '3'], ['1']), (1, 2, []))
+
+    def test_repeated_lines_are_not_counted_twice(self):
+        self.assertEqual(compute_line_delta(['a'], ['a', 'a']), (1, 0, ['a']))
+
+    def test_hash_depends_on_line_breaks(self):
+        self.assertNotEqual(contents_hash(['ab']), contents_hash(['a', 'b']))
+
+
+class GenerateVersionMessagesTests(TestCase):
+
+    def test_contents_version_message_contains_version(self):
+        message = generate_contents_version_message(12)
+
+        # not checking for CONTENTS_VERSION_PREFIX to prevent false positives
+        self.assertEqual(message, b'VIMPAIR_CONTENTS_VERSION|2|12')
+
+    def test_lines_delta_message_contains_version_range_and_lines(self):
+        message = generate_lines_delta_message(3, 1, 2, ['One', 'Two'])
+
+        # not checking for LINES_DELTA_PREFIX to prevent false positives
+        self.assertEqual(message, b'VIMPAIR_LINES_DELTA|3|1|2|2|7|One\nTwo')
+
+    def test_sync_state_message_contains_version_and_hash(self):
+        message = generate_sync_state_message(3, 'abcd')
+
+        # not checking for SYNC_STATE_PREFIX to prevent false positives
+        self.assertEqual(message, b'VIMPAIR_SYNC_STATE|3|4|abcd')
+
+    def test_inserted_text_message_contains_version_position_and_text(self):
+        message = generate_inserted_text_message(3, 1, 4, 'a')
+
+        # not checking for INSERT_TEXT_PREFIX to prevent false positives
+        self.assertEqual(message, b'VIMPAIR_INSERT_TEXT|3|1|4|1|a')
+
+    def test_resync_request_message(self):
+        # not checking for RESYNC_REQUEST_MESSAGE to prevent false positives
+        self.assertEqual(generate_resync_request_message(), b'VIMPAIR_RESYNC_REQUEST')
+
+
+class MessageHandlerVersionTests(TestCase):
+
+    def setUp(self):
+        self.callbacks = MockCallbacks()
+        self.handler = MessageHandler(callbacks=self.callbacks)
+
+
+    def test_calls_contents_version_with_version(self):
+        self.handler.process(CONTENTS_VERSION_PREFIX + '|2|12')
+
+        self.callbacks.contents_version.assert_called_with(12)
+
+    def test_calls_update_lines_with_split_lines(self):
+        self.handler.process(LINES_DELTA_PREFIX + '|3|1|2|2|7|One\nTwo')
+
+        self.callbacks.update_lines.assert_called_with(3, 1, 2, ['One', 'Two'])
+
+    def test_calls_update_lines_with_single_empty_line(self):
+        self.handler.process(LINES_DELTA_PREFIX + '|3|1|0|1|0|')
+
+        self.callbacks.update_lines.assert_called_with(3, 1, 0, [''])
+
+    def test_calls_update_lines_without_lines_for_removal(self):
+        self.handler.process(LINES_DELTA_PREFIX + '|3|1|2|0|0|')
+
+        self.callbacks.update_lines.assert_called_with(3, 1, 2, [])
+
+    def test_calls_check_sync_state_with_version_and_hash(self):
+        self.handler.process(SYNC_STATE_PREFIX + '|3|4|abcd')
+
+        self.callbacks.check_sync_state.assert_called_with(3, 'abcd')
+
+    def test_calls_resync_for_resync_request(self):
+        self.handler.process(RESYNC_REQUEST_MESSAGE)
+
+        self.callbacks.resync.assert_called_with()
+
+    def test_calls_insert_text_with_version_position_and_text(self):
+        self.handler.process(INSERT_TEXT_PREFIX + '|3|1|4|1|a')
+
+        self.callbacks.insert_text.assert_called_with(3, 1, 4, 'a')
+
+    def test_inserted_text_may_contain_separator(self):
+        self.handler.process(INSERT_TEXT_PREFIX + '|3|1|4|1||')
+
+        self.callbacks.insert_text.assert_called_with(3, 1, 4, '|')
+
+
+class LimitsTests(TestCase):
+
+    def setUp(self):
+        self.callbacks = MockCallbacks()
+        self.metrics = Mock()
+        self.handler = MessageHandler(
+            callbacks=self.callbacks,
+            metrics=self.metrics,
+            max_message_size=100,
+        )
+
+
+    def test_limits_message_contains_max_message_size(self):
+        message = generate_limits_message(65536)
+
+        # not checking for LIMITS_PREFIX to prevent false positives
+        self.assertEqual(message, b'VIMPAIR_LIMITS|5|65536')
+
+    def test_calls_peer_limits_with_max_message_size(self):
+        self.handler.process(LIMITS_PREFIX + '|5|65536')
+
+        self.callbacks.peer_limits.assert_called_with(65536)
+
+    def test_oversized_message_is_skipped_as_it_arrives(self):
+        contents = 'x' * 200
+        message = FULL_UPDATE_PREFIX + '|200|' + contents
+
+        self.handler.process([message[:50]])
+        self.handler.process([message[50:150]])
+
+        self.assertEqual(self.handler._stream.leftover, b'')
+        self.assertEqual(b''.join(self.handler._stream.pending_parts), b'')
+        self.callbacks.update_contents.assert_not_called()
+
+    def test_messages_after_oversized_message_are_handled(self):
+        message = FULL_UPDATE_PREFIX + '|200|' + 'x' * 200
+
+        self.handler.process([message[:50]])
+        self.handler.process([message[50:] + FULL_UPDATE_PREFIX + '|4|Text'])
+
+        self.callbacks.update_contents.assert_called_once_with('Text')
+
+    def test_complete_oversized_message_is_skipped(self):
+        self.handler.process([
+            FULL_UPDATE_PREFIX + '|200|' + 'x' * 200,
+            FULL_UPDATE_PREFIX + '|4|Text',
+        ])
+
+        self.callbacks.update_contents.assert_called_once_with('Text')
+
+    def test_counts_discarded_messages_and_data(self):
+        message = FULL_UPDATE_PREFIX + '|200|' + 'x' * 200
+
+        self.handler.process([message[:50]])
+        self.handler.process([message[50:]])
+
+        self.assertEqual(self.handler.discarded_messages, 1)
+        self.assertEqual(self.handler.discarded_size, len(message))
+        self.callbacks.message_discarded.assert_called_once_with(len(message))
+        self.metrics.message_discarded.assert_called_once_with()
+        self.assertEqual(
+            sum(args[0] for args, _ in self.metrics.data_discarded.call_args_list),
+            len(message),
+        )
+
+    def test_messages_within_limit_are_not_counted(self):
+        self.handler.process([FULL_UPDATE_PREFIX + '|4|Text'])
+
+        self.assertEqual(self.handler.discarded_messages, 0)
+        self.assertEqual(self.handler.discarded_size, 0)
+
+
+class BulkStreamTests(TestCase):
+
+    def setUp(self):
+        self.callbacks = MockCallbacks()
+        self.handler = MessageHandler(callbacks=self.callbacks, max_message_size=100)
+        self.calls = []
+
+
+    def _record(self, name):
+        return lambda *args, **kwargs: self.calls.append(name)
+
+    def test_sequence_message_contains_number_of_bulk_messages(self):
+        message = generate_sequence_message(12)
+
+        # not checking for SEQUENCE_PREFIX to prevent false positives
+        self.assertEqual(message, b'VIMPAIR_SEQUENCE|2|12')
+
+    def test_control_messages_wait_for_contents_sent_before_them(self):
+        self.handler.process(SEQUENCE_PREFIX + '|1|1' + TAKE_CONTROL_MESSAGE)
+        self.callbacks.take_control.assert_not_called()
+
+        self.handler.process([], FULL_UPDATE_PREFIX + '|4|Text')
+
+        self.callbacks.update_contents.assert_called_once_with('Text')
+        self.callbacks.take_control.assert_called_once_with()
+
+    def test_control_messages_are_applied_after_contents_received_at_once(self):
+        self.callbacks.update_contents.side_effect = self._record('update_contents')
+        self.callbacks.check_sync_state.side_effect = self._record('check_sync_state')
+
+        self.handler.process(
+            SEQUENCE_PREFIX + '|1|1' + SYNC_STATE_PREFIX + '|3|4|hash',
+            FULL_UPDATE_PREFIX + '|4|Text',
+        )
+
+        self.assertEqual(self.calls, ['update_contents', 'check_sync_state'])
+
+    def test_control_messages_are_applied_before_later_contents(self):
+        self.callbacks.update_contents.side_effect = self._record('update_contents')
+        self.callbacks.check_sync_state.side_effect = self._record('check_sync_state')
+
+        self.handler.process(
+            SEQUENCE_PREFIX + '|1|1' + SYNC_STATE_PREFIX + '|3|4|hash',
+            FULL_UPDATE_PREFIX + '|5|First' + FULL_UPDATE_PREFIX + '|6|Second',
+        )
+
+        self.assertEqual(
+            self.calls,
+            ['update_contents', 'check_sync_state', 'update_contents'],
+        )
+
+    def test_control_messages_are_applied_right_away_without_pending_contents(self):
+        self.handler.process([], FULL_UPDATE_PREFIX + '|4|Text')
+
+        self.handler.process(SEQUENCE_PREFIX + '|1|1' + TAKE_CONTROL_MESSAGE)
+
+        self.callbacks.take_control.assert_called_once_with()
+
+    def test_discarded_contents_count_as_received(self):
+        self.handler.process(SEQUENCE_PREFIX + '|1|1' + TAKE_CONTROL_MESSAGE)
+
+        self.handler.process([], FULL_UPDATE_PREFIX + '|200|' + 'x' * 200)
+
+        self.callbacks.take_control.assert_called_once_with()
+
+    def test_cursor_position_is_applied_right_away_and_after_contents(self):
+        self.handler.process(SEQUENCE_PREFIX + '|1|1' + CURSOR_POSITION_PREFIX + '|5|1|2')
+        self.callbacks.apply_cursor_position.assert_called_once_with(5, 2)
+
+        self.handler.process([], FULL_UPDATE_PREFIX + '|4|Text')
+        self.handler.process([], [])
+
+        self.assertEqual(self.callbacks.apply_cursor_position.call_count, 2)
+
+    def test_cursor_position_sent_after_file_change_is_kept(self):
+        self.handler.process(SEQUENCE_PREFIX + '|1|1' + CURSOR_POSITION_PREFIX + '|5|1|2')
+
+        self.handler.process([], FILE_CHANGE_PREFIX + '|7|File.py')
+
+        self.callbacks.file_changed.assert_called_once_with(filename='File.py')
+        self.callbacks.apply_cursor_position.assert_called_with(5, 2)
+        self.assertEqual(self.callbacks.apply_cursor_position.call_count, 2)
+
+    def test_streams_are_received_independently(self):
+        message = FULL_UPDATE_PREFIX + '|4|Text'
+
+        self.handler.process(CURSOR_POSITION_PREFIX[:10], message[:10])
+        self.handler.process(CURSOR_POSITION_PREFIX[10:] + '|5|1|2', message[10:])
+
+        self.callbacks.update_contents.assert_called_once_with('Text')
+        self.callbacks.apply_cursor_position.assert_called_once_with(5, 2)
+
+
+class PingTests(TestCase):
+
+    def setUp(self):
+        self.callbacks = MockCallbacks()
+        self.handler = MessageHandler(callbacks=self.callbacks)
+
+
+    def test_ping_message_contains_ping_id(self):
+        message = generate_ping_message(7)
+
+        # not checking for PING_PREFIX to prevent false positives
+        self.assertEqual(message, b'VIMPAIR_PING|1|7')
+
+    def test_pong_message_contains_ping_id_and_bytes_received(self):
+        message = generate_pong_message(7, 123456)
+
+        # not checking for PONG_PREFIX to prevent false positives
+        self.assertEqual(message, b'VIMPAIR_PONG|123456|1|7')
+
+    def test_calls_ping_with_ping_id(self):
+        self.handler.process(PING_PREFIX + '|2|42')
+
+        self.callbacks.ping.assert_called_once_with(42)
+
+    def test_calls_pong_with_ping_id_and_bytes_received(self):
+        self.handler.process(PONG_PREFIX + '|123456|2|42')
+
+        self.callbacks.pong.assert_called_once_with(42, 123456)
+
+    def test_ping_is_answered_before_contents_are_applied(self):
+        calls = []
+        self.callbacks.update_contents.side_effect = lambda *a: calls.append('update_contents')
+        self.callbacks.ping.side_effect = lambda *a: calls.append('ping')
+
+        self.handler.process(FULL_UPDATE_PREFIX + '|4|Text' + PING_PREFIX + '|1|1')
+
+        self.assertEqual(calls, ['ping', 'update_contents'])
+
+    def test_ping_does_not_wait_for_contents_of_bulk_stream(self):
+        self.handler.process(SEQUENCE_PREFIX + '|1|1' + PING_PREFIX + '|1|1')
+
+        self.callbacks.ping.assert_called_once_with(1)
+
+
+class CompressedContentsTests(TestCase):
+
+    def setUp(self):
+        self.callbacks = MockCallbacks()
+        self.handler = MessageHandler(callbacks=self.callbacks)
+
+
+    def test_contents_are_compressed_with_compression_level(self):
+        contents = u'Some contents\n' * 1000
+
+        messages = generate_contents_update_messages(contents, compression_level=6)
+
+        self.assertTrue(messages[0].startswith(COMPRESSED_START_PREFIX.encode('ascii')))
+        self.assertLess(sum(len(message) for message in messages), len(contents) // 10)
+
+    def test_short_contents_are_not_compressed(self):
+        messages = generate_contents_update_messages(u'Short', compression_level=6)
+
+        self.assertEqual(messages, [b'VIMPAIR_FULL_UPDATE|5|Short'])
+
+    def test_compressed_contents_are_decompressed(self):
+        contents = u'Some contents \u00e4\u4e2d\n' * 1000
+
+        self.handler.process(generate_contents_update_messages(
+            contents, message_length=100, compression_level=9))
+
+        self.callbacks.update_contents.assert_called_once_with(contents)
+
+    def test_decompressed_contents_exceeding_limit_are_discarded(self):
+        handler = MessageHandler(callbacks=self.callbacks, max_message_size=1000)
+
+        handler.process(generate_contents_update_messages(u'x' * 5000, compression_level=9))
+
+        self.callbacks.update_contents.assert_not_called()
+        self.callbacks.message_discarded.assert_called_once()
+
+    def test_broken_compressed_contents_are_ignored(self):
+        self.handler.process(
+            COMPRESSED_START_PREFIX + '|6|broken' + UPDATE_END_PREFIX + '|0|')
+
+        self.callbacks.update_contents.assert_not_called()
+
+    def test_uncompressed_update_after_interrupted_compressed_one(self):
+        self.handler.process(COMPRESSED_START_PREFIX + '|6|broken')
+
+        self.handler.process(
+            UPDATE_START_PREFIX + '|5|Some ' + UPDATE_END_PREFIX + '|8|contents')
+
+        self.callbacks.update_contents.assert_called_once_with('Some contents')
+
+    def test_message_length_sets_size_of_parts(self):
+        messages = generate_contents_update_messages(u'x' * 10000, message_length=4096)
+
+        self.assertEqual([len(message) for message in messages[:-1]], [4096, 4096])
+
+    def test_smallest_message_length_leaves_contents_in_every_part(self):
+        contents = u'Some contents \u00e4\u4e2d\n' * 100
+
+        for compression_level in (0, 9):
+            messages = generate_contents_update_messages(
+                contents, message_length=MIN_MESSAGE_LENGTH, compression_level=compression_level)
+            self.handler.process(messages)
+
+            self.assertLessEqual(max(len(message) for message in messages), MIN_MESSAGE_LENGTH)
+            self.callbacks.update_contents.assert_called_with(contents)
+
+    def test_smaller_message_lengths_are_raised_to_smallest_one(self):
+        smallest = generate_contents_update_messages(u'x' * 100, message_length=MIN_MESSAGE_LENGTH)
+
+        for message_length in (0, 1, MIN_MESSAGE_LENGTH - 1):
+            self.assertEqual(
+                generate_contents_update_messages(u'x' * 100, message_length=message_length),
+                smallest,
+            )
+
+
+@ddt
+class JoinSessionTests(TestCase):
+
+    def test_join_session_message_contains_role_session_id_and_secret(self):
+        message = generate_join_session_message('pair', True, 'secret')
+
+        # not checking for JOIN_SESSION_PREFIX to prevent false positives
+        self.assertEqual(message, b'VIMPAIR_JOIN_SESSION|1|4|10|pairsecret')
+
+    def test_parses_observer_join_message(self):
+        self.assertEqual(
+            parse_join_session_message('VIMPAIR_JOIN_SESSION|0|4|4|pair'),
+            (31, False, 'pair', ''),
+        )
+
+    def test_parses_secret_after_non_ascii_session_id(self):
+        message = generate_join_session_message(u'caf\xe9', True, u'secr\xe9t')
+
+        self.assertEqual(
+            parse_join_session_message(message),
+            (len(message), True, u'caf\xe9', u'secr\xe9t'),
+        )
+
+    def test_parsing_ignores_following_messages(self):
+        self.assertEqual(
+            parse_join_session_message('VIMPAIR_JOIN_SESSION|1|4|6|pairsecVIMPAIR_TAKE_CONTROL'),
+            (33, True, 'pair', 'se'),
+        )
+
+    @data('VIMPAIR_JOIN', 'VIMPAIR_JOIN_SESSION|1', 'VIMPAIR_JOIN_SESSION|1|4|8|pa')
+    def test_incomplete_join_message_is_not_parsed(self, message):
+        self.assertIsNone(parse_join_session_message(message))
+
+    def test_other_messages_raise(self):
+        with self.assertRaises(MessageHandler.MessageMatchingError):
+            parse_join_session_message('VIMPAIR_TAKE_CONTROL')
+
+    def test_peer_joined_message(self):
+        # not checking for PEER_JOINED_MESSAGE to prevent false positives
+        self.assertEqual(generate_peer_joined_message(), b'VIMPAIR_PEER_JOINED')
+
+    def test_calls_peer_joined_for_peer_joined_message(self):
+        callbacks = MockCallbacks()
+
+        MessageHandler(callbacks=callbacks).process(PEER_JOINED_MESSAGE)
+
+        callbacks.peer_joined.assert_called_with()
+
+
+@ddt
+class SplitCompleteMessagesTests(TestCase):
+
+    def test_complete_messages_are_split_from_incomplete_one(self):
+        self.assertEqual(
+            split_complete_messages(b'VIMPAIR_SAVE_FILEVIMPAIR_PING|1|1VIMPAIR_FULL_UPDATE|8|Som'),
+            (b'VIMPAIR_SAVE_FILEVIMPAIR_PING|1|1', b'VIMPAIR_FULL_UPDATE|8|Som', 5),
+        )
+
+    @data(b'VIMPAIR_FULL', b'VIMPAIR_FULL_UPDATE|', b'VIMPAIR_FULL_UPDATE|8')
+    def test_incomplete_fields_are_kept(self, message):
+        self.assertEqual(split_complete_messages(message), (b'', message, 0))
+
+    def test_data_between_messages_is_dropped(self):
+        self.assertEqual(
+            split_complete_messages(b'garbageVIMPAIR_SAVE_FILE|-1|garbage'),
+            (b'VIMPAIR_SAVE_FILE', b'', 0),
+        )
+
+    def test_messages_split_anywhere_are_put_back_together(self):
+        messages = generate_contents_update_messages(u'x' * 3000, message_length=1024)
+        data = b''.join(messages)
+        complete = b''
+        rest = b''
+        for position in range(0, len(data), 7):
+            part, rest, _ = split_complete_messages(rest + data[position:position + 7])
+            complete += part
+
+        self.assertEqual(complete, data)
+        self.assertEqual(rest, b'')
@@ -0,0 +1,305 @@
+from mock import Mock, call, patch
+from os import path
+from unittest import TestCase
+import sys
+
+sys.modules.setdefault('vim', Mock())
+# registry is imported like the plugin does, from within its folder
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+from .. import registry, vimpair
+from ..registry import SessionRegistry
+
+
+class SessionRegistryTests(TestCase):
+
+    def setUp(self):
+        self.window_id = 1000
+        self.vimpair = Mock(create_session_state=lambda: Mock())
+        self.go_to_window = Mock(side_effect=self._go_to_window)
+        patches = [
+            patch.object(registry, 'vimpair', self.vimpair),
+            patch.object(registry, 'get_current_window_id', lambda: self.window_id),
+            patch.object(registry, 'go_to_window', self.go_to_window),
+        ]
+        for each in patches:
+            each.start()
+            self.addCleanup(each.stop)
+        self.sessions = SessionRegistry()
+
+    def _go_to_window(self, window_id):
+        self.window_id = window_id
+        return True
+
+    def _start_in_window(self, window_id, is_server):
+        self.window_id = window_id
+        return self.sessions.start(is_server)
+
+
+    def test_starting_a_session_activates_its_state(self):
+        session = self._start_in_window(1000, True)
+
+        self.vimpair.activate_session_state.assert_called_with(session.state)
+
+    def test_sessions_get_their_own_state(self):
+        first = self._start_in_window(1000, True)
+        second = self._start_in_window(1001, False)
+
+        self.assertIsNot(first.state, second.state)
+
+    def test_window_can_only_have_one_session(self):
+        self._start_in_window(1000, True)
+
+        self.assertIsNone(self._start_in_window(1000, False))
+        self.assertEqual(len(self.sessions), 1)
+
+    def test_current_session_is_the_one_of_the_current_window(self):
+        self._start_in_window(1000, True)
+        second = self._start_in_window(1001, False)
+
+        self.assertIs(self.sessions.current(), second)
+
+    def test_only_session_is_current_in_any_window(self):
+        session = self._start_in_window(1000, True)
+        self.window_id = 1001
+
+        self.assertIs(self.sessions.current(), session)
+
+    def test_no_session_is_current_in_other_windows_with_several_sessions(self):
+        self._start_in_window(1000, True)
+        self._start_in_window(1001, False)
+        self.window_id = 1002
+
+        self.assertIsNone(self.sessions.current())
+
+    def test_polling_activates_each_session_in_its_window(self):
+        first = self._start_in_window(1000, True)
+        second = self._start_in_window(1001, False)
+        activated = []
+        self.vimpair.activate_session_state.side_effect = \
+            lambda state: activated.append((state, self.window_id))
+        first.poll = lambda: activated.append(('poll', self.window_id))
+        second.poll = lambda: activated.append(('poll', self.window_id))
+
+        self.sessions.poll()
+
+        self.assertEqual(activated, [
+            (first.state, 1001),
+            ('poll', 1000),
+            (second.state, 1001),
+            ('poll', 1001),
+        ])
+        self.assertEqual(self.window_id, 1001)
+
+    def test_polling_a_single_session_keeps_the_current_window(self):
+        session = self._start_in_window(1000, True)
+        session.poll = Mock()
+        self.window_id = 1001
+
+        self.sessions.poll()
+
+        session.poll.assert_called_once_with()
+        self.go_to_window.assert_not_called()
+
+    def test_action_as_editor_runs_for_the_editor_of_the_current_window(self):
+        self._start_in_window(1000, True)
+        action = Mock()
+
+        self.sessions.as_editor(action)
+
+        action.assert_called_once_with()
+
+    def test_action_as_editor_is_skipped_for_observers(self):
+        self._start_in_window(1000, False)
+        action = Mock()
+
+        self.sessions.as_editor(action)
+
+        action.assert_not_called()
+
+    def test_action_as_editor_is_skipped_without_session(self):
+        self._start_in_window(1000, True)
+        self._start_in_window(1001, True)
+        self.window_id = 1002
+        action = Mock()
+
+        self.sessions.as_editor(action)
+
+        action.assert_not_called()
+
+    def test_action_with_current_runs_for_observers_too(self):
+        self._start_in_window(1000, False)
+        action = Mock()
+
+        self.assertTrue(self.sessions.with_current(action))
+        action.assert_called_once_with()
+
+    def test_action_with_current_is_skipped_without_session(self):
+        action = Mock()
+
+        self.assertFalse(self.sessions.with_current(action))
+        action.assert_not_called()
+
+    def test_observer_becomes_editor_when_taking_control(self):
+        session = self._start_in_window(1000, False)
+
+        session.take_control()
+        action = Mock()
+        self.sessions.as_editor(action)
+
+        action.assert_called_once_with()
+
+    def test_editor_becomes_observer_after_handing_over_control(self):
+        session = self._start_in_window(1000, True)
+        self.vimpair.hand_over_control.return_value = True
+
+        session.hand_over_control()
+
+        self.assertFalse(session.is_editor)
+
+    def test_editor_stays_editor_if_control_was_not_handed_over(self):
+        session = self._start_in_window(1000, True)
+        self.vimpair.hand_over_control.return_value = False
+
+        session.hand_over_control()
+
+        self.assertTrue(session.is_editor)
+
+    def test_stopping_a_session_disconnects_it_and_ends_its_folder(self):
+        session = self._start_in_window(1000, False)
+        folder = session.folder = Mock()
+
+        self.sessions.stop(session)
+
+        self.vimpair.connector.disconnect.assert_called_once_with()
+        folder.end.assert_called_once_with()
+        self.assertEqual(len(self.sessions), 0)
+
+    def test_stopping_all_sessions(self):
+        self._start_in_window(1000, True)
+        self._start_in_window(1001, False)
+
+        self.sessions.stop_all()
+
+        self.assertEqual(len(self.sessions), 0)
+        self.assertEqual(self.vimpair.connector.disconnect.call_args_list, [call(), call()])
+
+
+class PairingSessionPollTests(TestCase):
+
+    def setUp(self):
+        self.vimpair = Mock(create_session_state=lambda: Mock())
+        vimpair_patch = patch.object(registry, 'vimpair', self.vimpair)
+        vimpair_patch.start()
+        self.addCleanup(vimpair_patch.stop)
+
+    def _session(self, is_server, is_connected=True):
+        session = registry.PairingSession(1000, is_server)
+        session.is_connected = is_connected
+        session.message_handler = Mock()
+        self.vimpair.connector.connection.receive.return_value = ([], b'')
+        return session
+
+    def test_server_waits_for_client(self):
+        session = self._session(True, is_connected=False)
+        self.vimpair.check_for_new_client.return_value = True
+
+        session.poll()
+
+        self.assertTrue(session.is_connected)
+        session.message_handler.process.assert_not_called()
+
+    def test_client_waits_for_server(self):
+        session = self._session(False, is_connected=False)
+        self.vimpair.check_for_server.return_value = False
+
+        session.poll()
+
+        self.assertFalse(session.is_connected)
+        self.vimpair.check_for_server.assert_called_once_with()
+
+    def test_editor_processes_requests_and_flushes_messages(self):
+        session = self._session(True)
+        self.vimpair.receive_requests.return_value = ([b'Requests'], b'Bulk requests')
+
+        session.poll()
+
+        session.message_handler.process.assert_called_once_with(
+            [b'Requests'], b'Bulk requests')
+        self.vimpair.flush_messages.assert_called_once_with()
+
+    def test_observer_processes_received_messages(self):
+        session = self._session(False)
+        self.vimpair.connector.connection.receive.return_value = (
+            [b'Messages'], b'Bulk messages')
+
+        session.poll()
+
+        session.message_handler.process.assert_called_once_with(
+            [b'Messages'], b'Bulk messages')
+        self.vimpair.flush_messages.assert_not_called()
+
+    def test_observer_acknowledges_extracted_project(self):
+        session = self._session(False)
+
+        session.poll()
+
+        self.vimpair.project_extraction.assert_called_once_with()
+
+
+class SessionStateTests(TestCase):
+    """ Runs the sessions with vimpair's actual state """
+
+    def setUp(self):
+        self.window_id = 1000
+        patches = [
+            patch.object(registry, 'vimpair', vimpair),
+            patch.object(registry, 'get_current_window_id', lambda: self.window_id),
+            patch.object(registry, 'go_to_window', lambda window_id: False),
+        ]
+        for each in patches:
+            each.start()
+            self.addCleanup(each.stop)
+        self.addCleanup(vimpair.activate_session_state, vimpair.create_session_state())
+        self.sessions = SessionRegistry()
+
+    def _start_observer(self, window_id, received_message):
+        self.window_id = window_id
+        session = self.sessions.start(False)
+        session.message_handler = Mock()
+        # Set up like the plugin does, while the new session is active
+        vimpair.connector = Mock(is_waiting_for_connection=False)
+        vimpair.connector.pop_status_messages.return_value = []
+        vimpair.connector.connection.has_queued_contents = False
+        vimpair.connector.connection.receive.return_value = ([received_message], None)
+        return session, vimpair.connector
+
+    def test_state_has_to_be_complete(self):
+        state = vimpair.create_session_state()
+        del state['peer_limits']
+
+        with self.assertRaises(ValueError):
+            vimpair.activate_session_state(state)
+
+    def test_sessions_keep_their_connections_and_file_tables_apart(self):
+        first, first_connector = self._start_observer(1000, b'First')
+        second, second_connector = self._start_observer(1001, b'Second')
+        file_tables = []
+        for session in (first, second):
+            with self.sessions.activated(session):
+                file_tables.append(vimpair.send_file_change._file_table)
+
+        for _ in range(3):
+            self.sessions.poll()
+
+        for session, connector, file_table, message in (
+                (first, first_connector, file_tables[0], b'First'),
+                (second, second_connector, file_tables[1], b'Second')):
+            with self.sessions.activated(session):
+                self.assertIs(vimpair.connector, connector)
+                self.assertIs(vimpair.send_file_change._file_table, file_table)
+            self.assertEqual(connector.connection.queue_messages.call_count, 1)
+            self.assertEqual(
+                session.message_handler.process.call_args_list,
+                [call([message], None), call([message], None)],
+            )
+        self.assertIsNot(file_tables[0], file_tables[1])
@@ -8,3 +8,13 @@ class TestContext(object):
         return self.__named_properties[name] \
                 if name in self.__named_properties \
                 else super(TestContext, self)._getattr__(name)
+
+
+class FakeTimer(object):
+    """ Stands in for default_timer, the tests set the time """
+
+    def __init__(self):
+        self.now = 0.
+
+    def __call__(self):
+        return self.now
@@ -1,19 +1,51 @@
-from mock import Mock
+from mock import Mock, patch
+from os import path
 from unittest import TestCase
 import sys
 
 mock_vim = Mock(current=None, command=Mock(), eval=Mock())
 sys.modules['vim'] = mock_vim
+# vim_interface is imported like the plugin does, from within its folder
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+from .. import vim_interface
 from ..vim_interface import (
     apply_contents_update,
+    apply_contents_update_in_steps,
     apply_cursor_position,
+    apply_lines_update,
+    apply_text_insert,
+    apply_visible_lines_update,
     get_current_contents,
     get_current_filename,
     get_current_path,
+    get_current_window_id,
     get_cursor_position,
+    get_insert_position,
+    get_visible_lines,
+    go_to_window,
     save_current_file,
     switch_to_buffer,
 )
+from ..protocol import MessageHandler, generate_contents_update_messages
+# Python 2 imports vim_interface once for all tests, the first might have
+# been with another vim module
+vim_interface.vim = mock_vim
+
+
+class BufferWithOptions(list):
+
+    def __init__(self, lines, undolevels=None):
+        super(BufferWithOptions, self).__init__(lines)
+        self.options = {'undolevels': undolevels}
+        self.undolevels_while_changing = []
+
+    def __setitem__(self, key, value):
+        self.undolevels_while_changing.append(self.options.get('undolevels'))
+        super(BufferWithOptions, self).__setitem__(key, value)
+
+    def __setslice__(self, start, end, value):
+        # Python 2 assigns slices of lists through this
+        self.__setitem__(slice(start, end), value)
 
 
 def mock_vim_with_contents(contents):
@@ -77,6 +109,146 @@ class GetCursorPositionTests(TestCase):
         self.assertEqual(column, 0)
 
 
+class GetInsertPositionTests(TestCase):
+
+    def test_returns_no_line_without_current(self):
+        mock_vim.current = None
+        self.assertEqual(get_insert_position(), (0, 0, None))
+
+    def test_returns_line_at_cursor(self):
+        mock_vim.current = Mock(window=Mock(cursor=(2, 3)), buffer=['1', 'Two'])
+
+        self.assertEqual(get_insert_position(), (1, 3, 'Two'))
+
+    def test_returns_column_in_characters(self):
+        mock_vim.current = Mock(window=Mock(cursor=(1, 4)), buffer=[u'\xe4\xf6x'])
+
+        self.assertEqual(get_insert_position(), (0, 2, u'\xe4\xf6x'))
+
+
+class GetVisibleLinesTests(TestCase):
+
+    def setUp(self):
+        mock_vim.eval = Mock(return_value='2')
+
+    def tearDown(self):
+        mock_vim.eval = Mock()
+
+
+    def test_returns_no_lines_without_current(self):
+        mock_vim.current = None
+        self.assertEqual(get_visible_lines(), (0, 0, []))
+
+    def test_returns_zero_based_first_visible_line(self):
+        mock_vim.current = Mock(window=Mock(height=2), buffer=['1', '2', '3', '4'])
+
+        first_line, _, _ = get_visible_lines()
+
+        self.assertEqual(first_line, 1)
+
+    def test_returns_number_of_lines_in_buffer(self):
+        mock_vim.current = Mock(window=Mock(height=2), buffer=['1', '2', '3', '4'])
+
+        _, number_of_lines, _ = get_visible_lines()
+
+        self.assertEqual(number_of_lines, 4)
+
+    def test_returns_lines_fitting_into_window(self):
+        mock_vim.current = Mock(window=Mock(height=2), buffer=['1', '2', '3', '4'])
+
+        _, _, lines = get_visible_lines()
+
+        self.assertEqual(lines, ['2', '3'])
+
+
+class ApplyVisibleLinesUpdateTests(TestCase):
+
+    def test_noop_without_current(self):
+        mock_vim.current = None
+        apply_visible_lines_update(0, 1, 'This is one line.')
+
+    def test_noop_without_buffer(self):
+        mock_vim.current = Mock(buffer=None)
+        apply_visible_lines_update(0, 1, 'This is one line.')
+
+    def test_fills_buffer_up_to_given_number_of_lines(self):
+        mock_vim.current = Mock(buffer=[''])
+
+        apply_visible_lines_update(1, 4, '2\n3')
+
+        self.assertEqual(mock_vim.current.buffer, ['', '2', '3', ''])
+
+    def test_removes_superfluous_lines(self):
+        mock_vim.current = Mock(buffer=['1', '2', '3', '4', '5'])
+
+        apply_visible_lines_update(0, 3, 'One\nTwo')
+
+        self.assertEqual(mock_vim.current.buffer, ['One', 'Two', '3'])
+
+    def test_keeps_lines_outside_given_range(self):
+        mock_vim.current = Mock(buffer=['1', '2', '3', '4'])
+
+        apply_visible_lines_update(1, 4, 'Two\nThree')
+
+        self.assertEqual(mock_vim.current.buffer, ['1', 'Two', 'Three', '4'])
+
+    def test_ignores_lines_beyond_given_number_of_lines(self):
+        mock_vim.current = Mock(buffer=['1', '2'])
+
+        apply_visible_lines_update(1, 2, 'Two\nThree')
+
+        self.assertEqual(mock_vim.current.buffer, ['1', 'Two'])
+
+
+class ApplyLinesUpdateTests(TestCase):
+
+    def test_noop_without_current(self):
+        mock_vim.current = None
+        apply_lines_update(0, 1, ['One'])
+
+    def test_replaces_removed_lines(self):
+        mock_vim.current = Mock(buffer=['1', '2', '3'])
+
+        apply_lines_update(1, 1, ['Two', 'Two and a half'])
+
+        self.assertEqual(mock_vim.current.buffer, ['1', 'Two', 'Two and a half', '3'])
+
+    def test_inserts_lines_without_removing(self):
+        mock_vim.current = Mock(buffer=['1', '3'])
+
+        apply_lines_update(1, 0, ['2'])
+
+        self.assertEqual(mock_vim.current.buffer, ['1', '2', '3'])
+
+    def test_removes_lines_without_adding(self):
+        mock_vim.current = Mock(buffer=['1', '2', '3'])
+
+        apply_lines_update(0, 2, [])
+
+        self.assertEqual(mock_vim.current.buffer, ['3'])
+
+
+class ApplyTextInsertTests(TestCase):
+
+    def test_noop_without_current(self):
+        mock_vim.current = None
+        apply_text_insert(0, 0, 'a')
+
+    def test_noop_for_line_outside_buffer(self):
+        mock_vim.current = Mock(buffer=['1'])
+
+        apply_text_insert(1, 0, 'a')
+
+        self.assertEqual(mock_vim.current.buffer, ['1'])
+
+    def test_inserts_text_at_column(self):
+        mock_vim.current = Mock(buffer=['1', 'Tw'])
+
+        apply_text_insert(1, 1, 'x')
+
+        self.assertEqual(mock_vim.current.buffer, ['1', 'Txw'])
+
+
 class ApplyCurrentContentsTests(TestCase):
 
     def test_noop_without_current(self):
@@ -114,6 +286,117 @@ class ApplyCurrentContentsTests(TestCase):
         )
 
 
+class ApplyContentsUpdateInStepsTests(TestCase):
+
+    def test_noop_without_current(self):
+        mock_vim.current = None
+        self.assertEqual(list(apply_contents_update_in_steps('One line.')), [])
+
+    def test_applies_given_number_of_lines_per_step(self):
+        mock_vim.current = Mock(buffer=[''])
+        steps = apply_contents_update_in_steps('1\n2\n3', lines_per_step=2)
+
+        next(steps)
+
+        self.assertEqual(mock_vim.current.buffer, ['1', '2'])
+
+    def test_applies_all_lines_after_last_step(self):
+        mock_vim.current = Mock(buffer=['', '', '', '', ''])
+
+        list(apply_contents_update_in_steps('1\n2\n3', lines_per_step=2))
+
+        self.assertEqual(mock_vim.current.buffer, ['1', '2', '3'])
+
+    def test_yields_once_per_step(self):
+        mock_vim.current = Mock(buffer=[''])
+
+        steps = list(apply_contents_update_in_steps('1\n2\n3', lines_per_step=2))
+
+        self.assertEqual(len(steps), 2)
+
+
+class ProfiledContentsUpdateTests(TestCase):
+
+    def setUp(self):
+        # The profiling module as imported by vim_interface
+        profiling = sys.modules[vim_interface.profiled_steps.__module__]
+        self.profiler = profiling.Profiler()
+        profiler_patch = patch.object(profiling, 'profiler', self.profiler)
+        profiler_patch.start()
+        self.addCleanup(profiler_patch.stop)
+        self.profiler.start()
+        self.addCleanup(self.profiler.stop)
+
+    def test_update_applied_in_steps_within_time_budget_is_profiled(self):
+        mock_vim.current = Mock(buffer=[''])
+        lines = 2500 * ['Line']
+        # The time budget is g:VimpairProcessTimeBudget's default
+        handler = MessageHandler(
+            callbacks=Mock(update_contents_in_steps=apply_contents_update_in_steps),
+            time_budget=50,
+        )
+
+        handler.process(generate_contents_update_messages('\n'.join(lines)))
+
+        self.assertEqual(mock_vim.current.buffer, lines)
+        stats = self.profiler.entry_points['apply_contents_update_step']
+        self.assertEqual(stats.calls, 4)
+
+
+class ApplyUpdatesWithoutUndoHistoryTests(TestCase):
+
+    def test_keeps_undolevels_by_default(self):
+        mock_vim.current = Mock(buffer=BufferWithOptions([''], undolevels=100))
+
+        apply_contents_update('One\nTwo')
+
+        self.assertEqual(mock_vim.current.buffer.undolevels_while_changing, [100])
+
+    def test_disables_undo_while_applying_contents_update(self):
+        mock_vim.current = Mock(buffer=BufferWithOptions([''], undolevels=100))
+
+        apply_contents_update('One\nTwo', keep_undo_history=False)
+
+        self.assertEqual(mock_vim.current.buffer.undolevels_while_changing, [-1])
+
+    def test_disables_undo_while_applying_visible_lines(self):
+        mock_vim.current = Mock(buffer=BufferWithOptions([''], undolevels=100))
+
+        apply_visible_lines_update(0, 3, 'One\nTwo', keep_undo_history=False)
+
+        self.assertEqual(
+            set(mock_vim.current.buffer.undolevels_while_changing),
+            set([-1]),
+        )
+
+    def test_restores_local_undolevels_after_update(self):
+        mock_vim.current = Mock(buffer=BufferWithOptions([''], undolevels=100))
+
+        apply_contents_update('One\nTwo', keep_undo_history=False)
+
+        self.assertEqual(mock_vim.current.buffer.options['undolevels'], 100)
+
+    def test_removes_local_undolevels_if_there_was_none(self):
+        mock_vim.current = Mock(buffer=BufferWithOptions([''], undolevels=None))
+
+        apply_contents_update('One\nTwo', keep_undo_history=False)
+
+        self.assertNotIn('undolevels', mock_vim.current.buffer.options)
+
+    def test_restores_undolevels_when_steps_are_abandoned(self):
+        mock_vim.current = Mock(buffer=BufferWithOptions([''], undolevels=100))
+        steps = apply_contents_update_in_steps(
+            '1\n2\n3',
+            lines_per_step=1,
+            keep_undo_history=False,
+        )
+        next(steps)
+
+        steps.close()
+
+        self.assertEqual(mock_vim.current.buffer.options['undolevels'], 100)
+
+
 class ApplyCursorPositionTests(TestCase):
 
     def test_noop_without_current(self):
@@ -188,6 +471,27 @@ class GetCurrentPathTests(TestCase):
         mock_vim.eval.assert_called_with('expand("%:p:h")')
 
 
+class WindowTests(TestCase):
+
+    def test_window_id_is_aquired_from_vim(self):
+        mock_vim.eval = Mock(return_value='1001')
+
+        self.assertEqual(get_current_window_id(), 1001)
+        mock_vim.eval.assert_called_with('win_getid()')
+
+    def test_going_to_window_doesnt_trigger_autocommands(self):
+        mock_vim.eval = Mock(return_value='1001')
+
+        go_to_window(1001)
+
+        mock_vim.command.assert_called_with('noautocmd call win_gotoid(1001)')
+
+    def test_going_to_closed_window_fails(self):
+        mock_vim.eval = Mock(return_value='1000')
+
+        self.assertFalse(go_to_window(1001))
+
+
 class SaveFileTests(TestCase):
 
     def tests_silently_writes_current_buffer_to_given_path(self):
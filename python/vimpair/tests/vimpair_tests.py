@@ -0,0 +1,41 @@
+from mock import Mock
+from os import path
+from unittest import TestCase
+import sys
+
+sys.modules.setdefault('vim', Mock())
+# vimpair is imported like the plugin does, from within its folder
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+from ..vimpair import MIN_PEER_MESSAGE_SIZE, PeerLimits
+from ..protocol import generate_contents_update_messages
+
+
+class PeerLimitsTests(TestCase):
+
+    def setUp(self):
+        self.limits = PeerLimits()
+
+
+    def test_first_limit_replaces_default(self):
+        self.limits.update(100000)
+
+        self.assertEqual(self.limits.max_message_size, 100000)
+
+    def test_smallest_limit_of_several_observers_is_kept(self):
+        self.limits.update(100000)
+        self.limits.update(200000)
+
+        self.assertEqual(self.limits.max_message_size, 100000)
+
+    def test_smaller_limits_are_raised_to_smallest_size(self):
+        self.limits.update(0)
+
+        self.assertEqual(self.limits.max_message_size, MIN_PEER_MESSAGE_SIZE)
+
+    def test_smallest_size_allows_parts_of_contents_updates(self):
+        self.limits.update(MIN_PEER_MESSAGE_SIZE)
+
+        messages = generate_contents_update_messages(
+            u'x' * 1000, message_length=self.limits.max_message_size // 2)
+
+        self.assertTrue(all(self.limits.allows(message) for message in messages))
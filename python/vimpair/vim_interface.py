@@ -1,6 +1,9 @@
+from contextlib import contextmanager
 from functools import reduce
 import vim
 
+from profiling import profiled, profiled_steps
+
 
 def get_current_contents():
     ''' returns the contents of current buffer/file as one string '''
@@ -12,6 +15,14 @@ def get_current_contents():
     return reduce(lambda l1, l2: l1 + '\n' + l2, lines or [''])
 
 
+def get_current_lines():
+    ''' returns the lines of the current buffer '''
+    try:
+        return vim.current.buffer[:]
+    except (AttributeError, TypeError):
+        return []
+
+
 def get_current_filename():
     ''' returns name and extension of the current file '''
     try:
@@ -28,6 +39,13 @@ def get_current_path():
         return ''
 
 
+def get_working_directory():
+    try:
+        return vim.eval('getcwd()')
+    except AttributeError:
+        return ''
+
+
 def get_cursor_position():
     ''' returns a tuple (line, column) of the cursor position '''
     try:
@@ -39,21 +57,167 @@ def get_cursor_position():
         return (0, 0)
 
 
-def apply_contents_update(contents_string):
+def get_insert_position():
+    ''' returns a tuple (line, column, line_contents) of the cursor position;
+        unlike Vim's, the column counts characters rather than bytes '''
+    line, column = get_cursor_position()
+    try:
+        contents = vim.current.buffer[line]
+    except (AttributeError, IndexError, TypeError):
+        return line, column, None
+    if not isinstance(contents, bytes):
+        column = len(contents.encode('utf-8')[:column].decode('utf-8', 'ignore'))
+    return line, column, contents
+
+
+def get_current_window_id():
+    try:
+        return int(vim.eval('win_getid()'))
+    except (AttributeError, TypeError, ValueError):
+        return 0
+
+
+def go_to_window(window_id):
+    ''' makes the window current without triggering any autocommands,
+        returns whether the window still exists '''
+    try:
+        vim.command('noautocmd call win_gotoid(%d)' % window_id)
+    except AttributeError:
+        return False
+    return get_current_window_id() == window_id
+
+
+def get_visible_lines():
+    ''' returns a tuple (first_line, number_of_lines, lines) with the lines
+        shown in the current window and the buffer's overall line count '''
+    try:
+        current_buffer = vim.current.buffer or []
+        # Vim counts lines 1-based, but we're using 0-based values.
+        first_line = max(0, int(vim.eval('line("w0")')) - 1)
+        last_line = first_line + max(1, vim.current.window.height)
+        return first_line, len(current_buffer), current_buffer[first_line:last_line]
+    except AttributeError:
+        return 0, 0, []
+
+
+APPLY_LINES_PER_STEP = 1000
+
+
+@contextmanager
+def _undo_history(current_buffer, keep_undo_history):
+    ''' disables recording undo information for the buffer if requested;
+        changes made like this also drop the existing undo history '''
+    if keep_undo_history:
+        yield
+        return
+
+    options = current_buffer.options
+    # 'undolevels' is global-local, None means there is no local value
+    undolevels = options['undolevels']
+    options['undolevels'] = -1
+    try:
+        yield
+    finally:
+        if undolevels is None:
+            del options['undolevels']
+        else:
+            options['undolevels'] = undolevels
+
+
+def _contents_update_steps(contents_string, lines_per_step, keep_undo_history):
     try:
         current_buffer = vim.current.buffer
         if current_buffer is not None:
             lines = contents_string.split('\n')
-            for index, line in enumerate(lines):
-                if index < len(current_buffer):
-                    current_buffer[index] = line
-                else:
-                    current_buffer.append(line)
-            del current_buffer[len(lines):]
+            with _undo_history(current_buffer, keep_undo_history):
+                for start in range(0, len(lines), lines_per_step):
+                    end = start + lines_per_step
+                    current_buffer[start:end] = lines[start:end]
+                    yield
+                del current_buffer[len(lines):]
+    except AttributeError:
+        pass
+
+
+@profiled_steps('apply_contents_update_step')
+def apply_contents_update_in_steps(
+    contents_string,
+    lines_per_step=APPLY_LINES_PER_STEP,
+    keep_undo_history=True,
+):
+    ''' applies the update like apply_contents_update, but yields after
+        each lines_per_step lines so the work can be spread over time '''
+    return _contents_update_steps(contents_string, lines_per_step, keep_undo_history)
+
+
+@profiled('apply_contents_update')
+def apply_contents_update(contents_string, keep_undo_history=True):
+    for _ in _contents_update_steps(
+        contents_string,
+        APPLY_LINES_PER_STEP,
+        keep_undo_history,
+    ):
+        pass
+
+
+def apply_visible_lines_update(
+    first_line,
+    number_of_lines,
+    contents_string,
+    keep_undo_history=True,
+):
+    try:
+        current_buffer = vim.current.buffer
+        if current_buffer is not None:
+            with _undo_history(current_buffer, keep_undo_history):
+                _replace_visible_lines(
+                    current_buffer,
+                    first_line,
+                    number_of_lines,
+                    contents_string.split('\n'),
+                )
     except AttributeError:
         pass
 
 
+def apply_lines_update(
+    first_line,
+    number_of_removed_lines,
+    lines,
+    keep_undo_history=True,
+):
+    ''' replaces number_of_removed_lines lines, starting at first_line '''
+    try:
+        current_buffer = vim.current.buffer
+        if current_buffer is not None:
+            with _undo_history(current_buffer, keep_undo_history):
+                current_buffer[first_line:first_line + number_of_removed_lines] = lines
+    except AttributeError:
+        pass
+
+
+def apply_text_insert(line, column, text, keep_undo_history=True):
+    try:
+        current_buffer = vim.current.buffer
+        if current_buffer is not None and line < len(current_buffer):
+            with _undo_history(current_buffer, keep_undo_history):
+                contents = current_buffer[line]
+                current_buffer[line] = contents[:column] + text + contents[column:]
+    except AttributeError:
+        pass
+
+
+def _replace_visible_lines(current_buffer, first_line, number_of_lines, lines):
+    missing_lines = number_of_lines - len(current_buffer)
+    if missing_lines > 0:
+        current_buffer[len(current_buffer):] = missing_lines * ['']
+    elif missing_lines < 0:
+        del current_buffer[number_of_lines:]
+    last_line = min(first_line + len(lines), number_of_lines)
+    if first_line < last_line:
+        current_buffer[first_line:last_line] = lines[:last_line - first_line]
+
+
 def apply_cursor_position(line, column):
     try:
         current_buffer = vim.current.buffer or []
@@ -1,20 +1,75 @@
 import os
+from base64 import b64decode
 from functools import partial
+from tarfile import TarError
+from threading import Thread
+from timeit import default_timer
+
+from connection import (
+    CONTROL_PRIORITY,
+    CONTENTS_PRIORITY,
+    CURSOR_PRIORITY,
+    MAX_CONTENTS_PER_FLUSH,
+)
+from link import LinkMonitor
+from profiling import profiled
+from project import (
+    DEFAULT_IGNORE_PATTERNS,
+    create_project_archive,
+    read_ignore_patterns,
+)
 
 from protocol import (
+    MAX_MESSAGE_SIZE,
+    MIN_MESSAGE_LENGTH,
+    FileTable,
+    HashTree,
+    apply_delta,
+    block_signatures,
+    compute_delta,
+    compute_line_delta,
+    contents_hash,
+    generate_block_request_message,
     generate_contents_update_messages,
+    generate_contents_version_message,
     generate_cursor_position_message,
-    generate_file_change_message,
+    generate_delta_message,
+    generate_file_register_message,
+    generate_file_switch_message,
+    generate_hash_nodes_message,
+    generate_hash_request_message,
+    generate_hash_tree_message,
+    generate_inserted_text_message,
+    generate_limits_message,
+    generate_lines_delta_message,
+    generate_ping_message,
+    generate_pong_message,
+    generate_project_extracted_message,
+    generate_project_messages,
+    generate_resync_request_message,
     generate_take_control_message,
     generate_save_file_message,
+    generate_signatures_message,
+    generate_sync_state_message,
+    generate_visible_lines_message,
+    signature_block_size,
+    signatures_checksum,
 )
 from vim_interface import (
     apply_contents_update,
+    apply_contents_update_in_steps,
     apply_cursor_position,
+    apply_lines_update,
+    apply_text_insert,
+    apply_visible_lines_update,
     get_current_contents,
     get_current_filename,
+    get_current_lines,
     get_current_path,
     get_cursor_position,
+    get_insert_position,
+    get_visible_lines,
+    get_working_directory,
     save_current_file,
     show_status_message,
     switch_to_buffer,
@@ -22,6 +77,38 @@ from vim_interface import (
 
 
 connector = None
+# The largest message accepted from the other participant, see MessageHandler
+max_message_size = MAX_MESSAGE_SIZE
+
+# Updates with more parts are preceded by the lines visible to the Editor
+VISIBLE_LINES_FIRST_MIN_PARTS = 8
+# Streamed insertions between checks of the Observer's contents
+INSERTIONS_PER_SYNC_STATE = 32
+# Smaller limits told by the other participants are raised to this, as
+# contents are sent in parts of half their limit
+MIN_PEER_MESSAGE_SIZE = 2 * MIN_MESSAGE_LENGTH
+# Seconds between the Observer's checks for differences to the Editor's buffer
+CONSISTENCY_CHECK_INTERVAL = 5.
+
+
+class SendCursorPosition(object):
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._last_position = None
+
+    @profiled('send_cursor_position')
+    def __call__(self):
+        position = get_cursor_position()
+        if position != self._last_position:
+            self._last_position = position
+            send_messages(
+                [generate_cursor_position_message(*position)],
+                priority=CURSOR_PRIORITY,
+                replaceable=True,
+            )
 
 
 class SendFileChange(object):
@@ -29,67 +116,466 @@ class SendFileChange(object):
     enabled = True
     should_conceal_path = lambda: True
 
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._file_table = FileTable()
+        self.current_file_id = None
+
     def __call__(self):
         if self.enabled:
-            message = generate_file_change_message(
+            file_id, file_path = self._file_table.lookup(
                 get_current_filename(),
                 folderpath=get_current_path(),
                 conceal_path=self.should_conceal_path(),
             )
-            connector.connection.send_message(message)
-            update_contents_and_cursor()
+            self.current_file_id = file_id
+            # The Observer's cursor is reset when switching files
+            send_cursor_position.reset()
+            shared_contents.reset()
+            # Cursor positions sent before the file change may overtake it
+            # and be dropped, so the position is sent again after it
+            send_messages([
+                generate_file_switch_message(file_id)
+                    if file_path is None
+                    else generate_file_register_message(file_id, file_path)
+            ], on_sent=send_cursor_position.reset)
+            if file_path is None or send_project.completed:
+                # The Observer may have (an older copy of) the file already;
+                # its signatures tell which parts of the contents to send
+                send_visible_lines()
+                send_cursor_position()
+            else:
+                update_contents_and_cursor(visible_lines_first=True)
+
+
+def send_messages(messages, priority=CONTENTS_PRIORITY, replaceable=False,
+                  on_sent=None):
+    connection = connector.connection
+    connection.queue_messages(
+        messages,
+        priority=priority,
+        replaceable=replaceable,
+        on_sent=on_sent,
+    )
+    _flush(connection)
+
+def flush_messages():
+    # Unchanged positions are skipped, unless the cursor has been reset
+    send_cursor_position()
+    send_ping()
+    send_project()
+    send_hash_tree()
+    _flush(connector.connection)
+
+def _flush(connection):
+    settings = link_monitor.settings
+    connection.flush(
+        max_contents_size=settings.contents_per_flush,
+        coalescing_window=settings.coalescing_window,
+    )
+    # Only a backlog tells how much the link carries
+    link_monitor.contents_flushed(connection.has_queued_contents)
+
+link_monitor = LinkMonitor()
+
+def send_ping():
+    ''' lets the Observer tell how fast the link is, see LinkMonitor '''
+    if link_monitor.ping_due and not connector.is_waiting_for_connection:
+        send_messages(
+            [generate_ping_message(link_monitor.next_ping())],
+            priority=CONTROL_PRIORITY,
+        )
+
+def show_link_status():
+    show_status_message(link_monitor.describe())
+
+class PeerLimits(object):
+    """ The largest message the other participants accept; until they
+        tell, the default is assumed """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.max_message_size = MAX_MESSAGE_SIZE
+        self._told = False
+
+    def update(self, max_message_size):
+        if self._told:
+            # With a relay, all Observers have to accept the messages
+            max_message_size = min(self.max_message_size, max_message_size)
+        self.max_message_size = max(MIN_PEER_MESSAGE_SIZE, max_message_size)
+        self._told = True
+
+    def allows(self, message):
+        return len(message) <= self.max_message_size
+
+peer_limits = PeerLimits()
+
+def send_limits():
+    send_messages([generate_limits_message(max_message_size)], priority=CONTROL_PRIORITY)
+
+class SendHashTree(object):
+    """ Lets the Observer check its buffer for differences from time to time;
+        it then requests the hashes and blocks it needs to repair them """
+
+    def __init__(self):
+        self.interval = CONSISTENCY_CHECK_INTERVAL
+        self._lines = None
+        self._tree = None
+        self.reset()
+
+    def reset(self):
+        self._last_sent = default_timer()
+
+    def current_tree(self):
+        ''' returns the current lines and their HashTree, which is only built
+            again once the lines have changed '''
+        lines = get_current_lines()
+        if lines != self._lines:
+            self._lines = lines
+            self._tree = HashTree(lines)
+        return self._lines, self._tree
+
+    def __call__(self):
+        if not self.interval or default_timer() - self._last_sent < self.interval:
+            return
+        connection = connector.connection
+        # The Observer can't be up to date while messages are still queued
+        if connector.is_waiting_for_connection or connection.has_queued_messages:
+            return
+        self._last_sent = default_timer()
+        _, tree = self.current_tree()
+        send_messages([generate_hash_tree_message(
+            tree.number_of_lines,
+            tree.levels,
+            tree.root,
+        )])
+
+send_hash_tree = SendHashTree()
+
+
+class SendProject(object):
+    """ Sends the files in the working directory to the Observer's session
+        folder, so it has (nearly) up to date copies before switching to them """
+
+    enabled = False
+
+    def __init__(self):
+        self._archive = []
+        self._messages = []
+        self._thread = None
+        self.completed = False
+
+    def reset(self):
+        self._messages = []
+        self.completed = False
+        if self.enabled:
+            root = get_working_directory()
+            file_table = FileTable()
+            archive_name = partial(
+                file_table.file_path,
+                conceal_path=send_file_change.should_conceal_path(),
+            )
+            ignore_patterns = DEFAULT_IGNORE_PATTERNS + tuple(read_ignore_patterns(root))
+            # The archive is created in the background, result included
+            self._archive = archive = []
+            self._thread = Thread(target=lambda: archive.append(
+                create_project_archive(root, archive_name, ignore_patterns)
+            ))
+            self._thread.start()
+
+    def __call__(self):
+        if self._archive:
+            self._messages = generate_project_messages(
+                self._archive.pop(),
+                min(MAX_CONTENTS_PER_FLUSH, peer_limits.max_message_size // 2),
+            )
+        # One part per call only, not to delay contents updates too much
+        if self._messages and not connector.connection.has_queued_messages:
+            send_messages([self._messages.pop(0)])
+        # Completed once the Observer acknowledges having extracted the files,
+        # see MessageCallbacks.project_extracted
+
+send_project = SendProject()
+
+
+class ProjectExtraction(object):
+    """ Extracts the received project files in the background; once they
+        are in place, the Editor is told so """
+
+    def __init__(self):
+        self._thread = None
+        self._outcome = None
+
+    def start(self, session, archive_path):
+        self._thread = Thread(target=self._extract, args=(session, archive_path))
+        self._thread.start()
+
+    def _extract(self, session, archive_path):
+        try:
+            session.extract_project(archive_path)
+            self._outcome = 'Received project files'
+        except (EnvironmentError, TarError) as e:
+            # The Editor then sends the files' contents in full
+            self._outcome = 'Extracting project files failed: %s' % e
+
+    def __call__(self):
+        if self._thread is not None and not self._thread.is_alive():
+            self._thread = None
+            show_status_message(self._outcome)
+            send_messages([generate_project_extracted_message()])
+
+project_extraction = ProjectExtraction()
+
+def receive_requests():
+    ''' returns the messages the Observer has sent without waiting for more,
+        and those sent on the bulk connection, see MessageHandler.process '''
+    return connector.connection.receive()
+
+def send_visible_lines():
+    first_line, number_of_lines, lines = get_visible_lines()
+    message = generate_visible_lines_message(first_line, number_of_lines, lines)
+    send_messages([message])
+
+class SharedContents(object):
+    """ The version of the contents both participants have in common; the
+        Editor's updates are deltas from this version, if possible """
+
+    def __init__(self):
+        self._last_version = 0
+        self.reset()
+
+    def reset(self):
+        self.version = None
+        self.lines = None
+
+    def next_version(self, lines):
+        self._last_version += 1
+        self.set(self._last_version, lines)
+        return self.version
+
+    def set(self, version, lines=None):
+        self._last_version = max(self._last_version, version)
+        self.version = version
+        self.lines = lines
+
+shared_contents = SharedContents()
+
+
+class SendContentsUpdate(object):
+
+    @profiled('send_contents_update')
+    def __call__(self, visible_lines_first=False):
+        lines = get_current_lines()
+        previous_lines = shared_contents.lines
+        if lines == previous_lines:
+            return
+        if previous_lines is not None:
+            first_line, number_of_removed_lines, added_lines = \
+                compute_line_delta(previous_lines, lines)
+            if 2 * len(added_lines) <= len(lines):
+                message = generate_lines_delta_message(
+                    shared_contents.next_version(lines),
+                    first_line,
+                    number_of_removed_lines,
+                    added_lines,
+                )
+                # Otherwise, the lines are sent in parts below
+                if peer_limits.allows(message):
+                    send_messages([message])
+                    return
+        self.send_all(lines, visible_lines_first=visible_lines_first)
 
+    def send_all(self, lines, visible_lines_first=False):
+        settings = link_monitor.settings
+        messages = generate_contents_update_messages(
+            '\n'.join(lines),
+            message_length=min(settings.part_size, peer_limits.max_message_size // 2),
+            compression_level=settings.compression_level,
+        )
+        if visible_lines_first and len(messages) >= VISIBLE_LINES_FIRST_MIN_PARTS:
+            send_visible_lines()
+            send_cursor_position()
+        self.confirm(lines, messages)
 
-def send_contents_update():
-    contents = get_current_contents()
-    messages = generate_contents_update_messages(contents)
-    for message in messages:
-        connector.connection.send_message(message)
+    def confirm(self, lines, messages=None):
+        ''' sends messages giving the Observer the lines, followed by their version '''
+        version = shared_contents.next_version(lines)
+        # Contents not sent yet are outdated by the next update
+        send_messages(
+            (messages or []) + [generate_contents_version_message(version)],
+            replaceable=True,
+        )
 
-def send_cursor_position():
-    line, column = get_cursor_position()
-    connector.connection.send_message(generate_cursor_position_message(line, column))
+send_contents_update = SendContentsUpdate()
 
-def update_contents_and_cursor():
-    send_contents_update()
+
+class SendInsertedText(object):
+    """ Streams text typed in insert mode as it is typed; the Observer's
+        contents are verified against a hash every few insertions """
+
+    def __init__(self):
+        self._insertions_since_check = 0
+
+    def __call__(self, text):
+        lines = shared_contents.lines
+        line, column, current_line = get_insert_position()
+        if lines is None or line >= len(lines) or lines[line] != current_line:
+            # Not in sync, the next contents update catches up
+            return
+        lines[line] = current_line[:column] + text + current_line[column:]
+        version = shared_contents.next_version(lines)
+        messages = [generate_inserted_text_message(version, line, column, text)]
+        self._insertions_since_check += 1
+        if self._insertions_since_check >= INSERTIONS_PER_SYNC_STATE:
+            self._insertions_since_check = 0
+            messages.append(generate_sync_state_message(version, contents_hash(lines)))
+        send_messages(messages)
+
+send_inserted_text = SendInsertedText()
+
+send_cursor_position = SendCursorPosition()
+
+def update_contents_and_cursor(visible_lines_first=False):
+    send_contents_update(visible_lines_first=visible_lines_first)
     send_cursor_position()
 
 def send_save_file():
-    message = generate_save_file_message()
-    connector.connection.send_message(message)
+    send_messages([generate_save_file_message()])
 
 send_file_change = SendFileChange()
 
+def create_session_state():
+    ''' returns new objects keeping track of a session, for
+        activate_session_state; the connector has to be set up later '''
+    return dict(
+        connector=None,
+        max_message_size=MAX_MESSAGE_SIZE,
+        shared_contents=SharedContents(),
+        send_contents_update=SendContentsUpdate(),
+        send_inserted_text=SendInsertedText(),
+        send_cursor_position=SendCursorPosition(),
+        send_file_change=SendFileChange(),
+        send_hash_tree=SendHashTree(),
+        send_project=SendProject(),
+        project_extraction=ProjectExtraction(),
+        peer_limits=PeerLimits(),
+        link_monitor=LinkMonitor(),
+    )
+
+# Objects not named here would be shared by all sessions
+_SESSION_STATE_NAMES = frozenset(create_session_state())
+_active_session_state = None
+
+def activate_session_state(state):
+    ''' makes this module's functions work with the given session's objects '''
+    global _active_session_state
+    if set(state) != _SESSION_STATE_NAMES:
+        raise ValueError('Not a session state: %s' % ', '.join(sorted(state)))
+    if _active_session_state is not None:
+        # Objects may have been replaced, e.g. the connector
+        for name in _active_session_state:
+            _active_session_state[name] = globals()[name]
+    _active_session_state = state
+    globals().update(state)
+
+def send_initial_state():
+    ''' starts over with a new Observer '''
+    send_limits()
+    send_file_change.reset()
+    send_cursor_position.reset()
+    send_hash_tree.reset()
+    send_project.reset()
+    shared_contents.reset()
+    update_contents_and_cursor(visible_lines_first=True)
+
 def check_for_new_client():
+    for message in connector.pop_status_messages():
+        show_status_message(message)
     if not connector.is_waiting_for_connection:
-        update_contents_and_cursor()
+        # The new participant tells its own limits
+        peer_limits.reset()
+        send_initial_state()
         return True
     return False
 
+def check_for_server():
+    for message in connector.pop_status_messages():
+        show_status_message(message)
+    if connector.is_waiting_for_connection:
+        return False
+    peer_limits.reset()
+    send_limits()
+    return True
+
 def hand_over_control():
     if connector.is_waiting_for_connection:
         show_status_message('No client connected')
         return False
     else:
         show_status_message('Handing over control')
-        connector.connection.send_message(generate_take_control_message())
+        # The Observer has to be up to date before taking over
+        send_contents_update()
+        connector.connection.flush(max_contents_size=None)
+        # With the same version, it can continue with deltas right away
+        send_messages([
+            generate_sync_state_message(
+                shared_contents.version,
+                contents_hash(shared_contents.lines),
+            ),
+            generate_take_control_message(),
+        ], priority=CONTROL_PRIORITY)
+        send_cursor_position.reset()
         return True
 
 
 class MessageCallbacks(object):
 
-    def __init__(self, take_control=None, session=None):
+    def __init__(self, take_control=None, session=None, keep_undo_history=True):
         self._take_control = take_control
         self._session = session
-        self.update_contents = apply_contents_update
+        self._session_paths = {}
+        self._hash_tree = None
+        self._signed_contents = None
+        self._project_file = None
+        self._resync_requested = False
+        self._skip_contents_version = False
+        self.update_contents = partial(
+            apply_contents_update,
+            keep_undo_history=keep_undo_history,
+        )
+        self.update_contents_in_steps = partial(
+            apply_contents_update_in_steps,
+            keep_undo_history=keep_undo_history,
+        )
+        self.update_visible_lines = partial(
+            apply_visible_lines_update,
+            keep_undo_history=keep_undo_history,
+        )
+        self.update_lines_of_buffer = partial(
+            apply_lines_update,
+            keep_undo_history=keep_undo_history,
+        )
+        self.insert_text_into_buffer = partial(
+            apply_text_insert,
+            keep_undo_history=keep_undo_history,
+        )
         self.apply_cursor_position = apply_cursor_position
 
     def take_control(self):
         show_status_message('You are in control now!')
+        send_cursor_position.reset()
+        send_hash_tree.reset()
         self._take_control()
 
     def file_changed(self, filename=None):
-        switch_to_buffer(self._session.prepend_folder(filename))
+        shared_contents.reset()
+        if filename not in self._session_paths:
+            self._session_paths[filename] = self._session.prepend_folder(filename)
+        switch_to_buffer(self._session_paths[filename])
 
     def save_file(self):
         filename = get_current_filename()
@@ -100,3 +586,164 @@ class MessageCallbacks(object):
             filename_and_path = os.path.join(path, filename)
             show_status_message('Saving file "%s"' % filename_and_path)
             save_current_file(filename_and_path)
+
+    def check_hash_tree(self, number_of_lines, levels, root_hash):
+        lines = get_current_lines()
+        self._hash_tree = HashTree(lines, number_of_lines)
+        if self._hash_tree.levels != levels:
+            return
+        if self._hash_tree.root != root_hash:
+            self._request_hashes(levels - 1, 0)
+        elif len(lines) != number_of_lines:
+            # Only superfluous lines at the end, the last block removes them
+            self._request_hashes(0, self._hash_tree.number_of_blocks - 1)
+
+    def compare_hash_nodes(self, level, index, hashes):
+        if self._hash_tree is not None:
+            for child in self._hash_tree.mismatching_children(level, index, hashes):
+                self._request_hashes(level - 1, child)
+
+    @staticmethod
+    def _request_hashes(level, index):
+        send_messages([
+            generate_hash_request_message(level, index)
+                if level > 0
+                else generate_block_request_message(index)
+        ])
+
+    def send_hash_nodes(self, level, index):
+        _, tree = send_hash_tree.current_tree()
+        hashes = tree.children(level, index)
+        send_messages([generate_hash_nodes_message(level, index, hashes)])
+
+    def send_block(self, index):
+        lines, tree = send_hash_tree.current_tree()
+        first_line, last_line = tree.block_lines(index)
+        send_messages([generate_visible_lines_message(
+            first_line,
+            tree.number_of_lines,
+            lines[first_line:last_line],
+        )])
+
+    def send_signatures(self, file_id):
+        contents = get_current_contents()
+        block_size = signature_block_size(len(contents))
+        signatures = block_signatures(contents, block_size)
+        message = generate_signatures_message(file_id, block_size, signatures)
+        if not peer_limits.allows(message):
+            # Without signatures, the Editor sends the whole contents
+            signatures = []
+            message = generate_signatures_message(file_id, block_size, signatures)
+        self._signed_contents = (
+            file_id, block_size, signatures_checksum(signatures), contents)
+        send_messages([message])
+
+    def send_delta(self, file_id, block_size, signatures):
+        if file_id != send_file_change.current_file_id:
+            # The Editor has switched files again in the meantime
+            return
+        contents = get_current_contents()
+        delta = compute_delta(
+            contents,
+            block_size,
+            signatures,
+            max_size=len(contents) // 2,
+        )
+        lines = contents.split('\n')
+        message = None if delta is None else generate_delta_message(
+            file_id, block_size, signatures_checksum(signatures), delta)
+        if message is None or not peer_limits.allows(message):
+            send_contents_update.send_all(lines)
+        else:
+            send_contents_update.confirm(lines, [message])
+        # The cursor may have been outside of the Observer's old contents
+        send_cursor_position.reset()
+        send_cursor_position()
+
+    def update_contents_from_delta(self, file_id, block_size, checksum, delta):
+        if self._signed_contents and self._signed_contents[:3] == (file_id, block_size, checksum):
+            self.update_contents(
+                apply_delta(self._signed_contents[3], block_size, delta)
+            )
+        else:
+            # Through a relay, the deltas for the other Observers' contents
+            # arrive as well; the version following them isn't ours either
+            self._skip_contents_version = True
+            self._request_resync()
+
+    def _project_archive_path(self):
+        return self._session.prepend_folder('project.tar.gz')
+
+    def receive_project_part(self, data):
+        if self._project_file is None:
+            self._project_file = open(self._project_archive_path(), 'wb')
+        self._project_file.write(b64decode(data))
+
+    def extract_project(self):
+        if self._project_file is not None:
+            self._project_file.close()
+            self._project_file = None
+            project_extraction.start(self._session, self._project_archive_path())
+
+    def project_extracted(self):
+        send_project.completed = True
+
+    def contents_version(self, version):
+        if self._skip_contents_version:
+            self._skip_contents_version = False
+            return
+        self._resync_requested = False
+        shared_contents.set(version)
+
+    def _request_resync(self):
+        if shared_contents.version is not None or not self._resync_requested:
+            self._resync_requested = True
+            shared_contents.reset()
+            send_messages([generate_resync_request_message()])
+
+    def _is_next_version(self, version):
+        if shared_contents.version is None or shared_contents.version + 1 != version:
+            # A delta from a version we don't have, the next one won't fit either
+            self._request_resync()
+            return False
+        return True
+
+    def update_lines(self, version, first_line, number_of_removed_lines, lines):
+        if self._is_next_version(version):
+            self.update_lines_of_buffer(first_line, number_of_removed_lines, lines)
+            shared_contents.set(version)
+
+    def insert_text(self, version, line, column, text):
+        if self._is_next_version(version):
+            self.insert_text_into_buffer(line, column, text)
+            shared_contents.set(version)
+
+    def check_sync_state(self, version, expected_hash):
+        lines = get_current_lines()
+        if contents_hash(lines) == expected_hash:
+            shared_contents.set(version, lines)
+        else:
+            shared_contents.reset()
+
+    def resync(self):
+        send_contents_update.send_all(get_current_lines())
+
+    def peer_limits(self, max_message_size):
+        peer_limits.update(max_message_size)
+
+    def ping(self, ping_id):
+        send_messages(
+            [generate_pong_message(ping_id, connector.connection.bytes_received)],
+            priority=CONTROL_PRIORITY,
+        )
+
+    def pong(self, ping_id, bytes_received):
+        link_monitor.pong_received(ping_id, bytes_received)
+
+    def message_discarded(self, size):
+        show_status_message('Discarded a message of %d bytes, the limit is %d' % (
+            size, max_message_size))
+
+    def peer_joined(self):
+        # Another Observer has joined the session through a relay
+        send_initial_state()